@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Offline benchmark of the APS harvester.
+
+Starts a local stand-in for harvest.aps.org in a separate process, serving
+the articles API (with Link pagination) and a bagit archive for every
+article, and runs bst_apsharvest end to end against it in devmode. The
+bagit archives contain a generated fulltext.xml and the files of
+test/test.zip as payload.
+
+Reports the number of records harvested per second and the metrics
+collected by the harvester for every stage of the harvest.
+
+Run it from the apsharvest source directory, next to test/test.zip:
+
+Usage: python apsharvest_benchmark.py [options]
+
+ -n, --records=NUM      number of articles to harvest (default: 200)
+ -p, --page-size=NUM    number of articles per API page (default: 100)
+ -l, --latency=SECONDS  artificial latency of every response (default: 0.05)
+ -j, --parallel=NUM     number of parallel downloads (default: configured)
+ -r, --rate=NUM         bagit requests per second, 0 for no limit
+                        (default: configured)
+ -m, --metadata         also convert the metadata (needs saxon and the XSLT)
+ -k, --keep             keep the working directory and log of the run
+ -h, --help             print this help and exit
+"""
+
+import os
+import sys
+import time
+import getopt
+import shutil
+import zipfile
+import hashlib
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+import cgi
+import urlparse
+
+from cStringIO import StringIO
+from tempfile import mkdtemp
+
+from invenio.jsonutils import json
+from invenio.bibsched_tasklets import bst_apsharvest
+
+BENCHMARK_DOI = "10.5555/PhysRevBenchmark.%d"
+
+FULLTEXT_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE article PUBLIC "-//American Physical Society//DTD Archival Article 1.0//EN" "article.dtd">
+<article><meta><doi>%(doi)s</doi>
+<title>Benchmark article %(number)d</title>
+<history><received date="2013-01-02"/><published date="2013-03-04"/></history>
+</meta><body>Text</body></article>
+"""
+
+
+def create_payload_archive(payload_file):
+    """
+    Returns a zipped archive (as a string) containing the files of the
+    given zipped file inside the data directory of a bag.
+    """
+    source = zipfile.ZipFile(payload_file)
+    output = StringIO()
+    archive = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+    archive.writestr("bag/bagit.txt", "BagIt-Version: 0.96\n")
+    for name in source.namelist():
+        if not name.endswith("/"):
+            archive.writestr("bag/data/payload/%s" % (name,), source.read(name))
+    archive.close()
+    source.close()
+    return output.getvalue()
+
+
+def create_bag(payload_archive, number):
+    """
+    Returns the bagit archive of the benchmark article with given number,
+    adding its fulltext and manifest to the payload archive.
+    """
+    doi = BENCHMARK_DOI % (number,)
+    fulltext = FULLTEXT_XML % {'doi': doi, 'number': number}
+    output = StringIO()
+    output.write(payload_archive)
+    archive = zipfile.ZipFile(output, 'a', zipfile.ZIP_DEFLATED)
+    archive.writestr("bag/manifest-md5.txt", "%s data/fulltext.xml\n" %
+                     (hashlib.md5(fulltext).hexdigest(),))
+    archive.writestr("bag/data/fulltext.xml", fulltext)
+    archive.close()
+    return output.getvalue()
+
+
+class BenchmarkAPSRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in for harvest.aps.org. The configuration is set on the server.
+    """
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if self.path.startswith("/content/journals/articles"):
+            self.send_articles()
+        elif self.path.startswith("/bagit/articles/"):
+            self.send_bag()
+        else:
+            self.send_error(404)
+
+    def send_articles(self):
+        query = cgi.parse_qs(urlparse.urlparse(self.path)[4])
+        page = int(query["page"][0])
+        perpage = int(query["per_page"][0])
+        number_of_articles = self.server.number_of_articles
+        last_page = max((number_of_articles - 1) // perpage + 1, 1)
+        articles = [{"doi": BENCHMARK_DOI % (i,),
+                     "last_modified_at": self.server.last_modified}
+                    for i in range((page - 1) * perpage,
+                                   min(page * perpage, number_of_articles))]
+        url = "http://localhost:%d%s" % (self.server.server_port,
+                                         self.path.split("?")[0])
+        links = ['<%s?page=%d&per_page=%d>; rel="last"' % (url, last_page, perpage)]
+        if page < last_page:
+            links.append('<%s?page=%d&per_page=%d>; rel="next"' % (url, page + 1, perpage))
+        data = json.dumps(articles)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Link", ", ".join(links))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_bag(self):
+        doi = "/".join(self.path.split("/")[3:5])
+        try:
+            number = int(doi.split(".")[-1])
+        except ValueError:
+            self.send_error(404)
+            return
+        data = create_bag(self.server.payload_archive, number)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class BenchmarkAPSServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server, so that parallel downloads are served in parallel.
+    """
+    daemon_threads = True
+
+
+def serve_benchmark_articles(port_queue, number_of_articles, latency,
+                             payload_file):
+    """
+    Runs the stand-in for harvest.aps.org, sending its port to the queue.
+    """
+    server = BenchmarkAPSServer(("localhost", 0), BenchmarkAPSRequestHandler)
+    server.number_of_articles = number_of_articles
+    server.latency = latency
+    server.last_modified = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    server.payload_archive = create_payload_archive(payload_file)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def run_benchmark(number_of_articles=200, perpage=100, latency=0.05,
+                  max_parallel="", rate=None, metadata=False, keep=False):
+    """
+    Runs bst_apsharvest against a local stand-in for harvest.aps.org.
+
+    @return: tuple of (elapsed seconds, summary of the HarvestMetrics of
+             the run)
+    """
+    payload_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "test", "test.zip")
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_benchmark_articles,
+                                     args=(port_queue, number_of_articles,
+                                           latency, payload_file))
+    server.daemon = True
+    server.start()
+    url = "http://localhost:%d" % (port_queue.get(True, 60),)
+
+    workdir = mkdtemp(prefix="apsharvest_benchmark_")
+    # Where the records are moved to instead of being sent by e-mail
+    results_directory = os.path.join(workdir, "results")
+    os.mkdir(results_directory)
+
+    def limit_rate(download_records):
+        def limited(*args, **kwargs):
+            if rate is not None:
+                kwargs["rate"] = rate
+            return download_records(*args, **kwargs)
+        return limited
+
+    patched = {"CFG_APSHARVEST_API_URL": url + "/content/journals/articles",
+               "CFG_APSHARVEST_FULLTEXT_URL": url + "/bagit/articles/%(doi)s/apsxml",
+               "CFG_APSHARVEST_PAGE_SIZE": perpage,
+               "CFG_APSHARVEST_APS_DIR": results_directory,
+               "CFG_WORKDIR": workdir,
+               "CFG_APSHARVEST_PROMETHEUS_FILE": "",
+               "download_records":
+               limit_rate(bst_apsharvest.download_records)}
+    originals = {}
+    for name, value in patched.items():
+        originals[name] = getattr(bst_apsharvest, name)
+        setattr(bst_apsharvest, name, value)
+
+    # The tasklet is very verbose in devmode
+    log_file = os.path.join(workdir, "apsharvest_benchmark.log")
+    log = open(log_file, "w")
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = log
+    start = time.time()
+    try:
+        bst_apsharvest.bst_apsharvest(from_date="2013-01-01",
+                                      metadata=metadata and "yes" or "no",
+                                      devmode="yes",
+                                      max_parallel=str(max_parallel or ""))
+        elapsed = time.time() - start
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        log.close()
+        for name, value in originals.items():
+            setattr(bst_apsharvest, name, value)
+        server.terminate()
+        if keep:
+            print "Working directory and log kept in %s" % (workdir,)
+        else:
+            shutil.rmtree(workdir, True)
+    return elapsed, bst_apsharvest.HARVEST_METRICS.get_summary()
+
+
+def print_report(elapsed, summary):
+    count = summary.get("records_harvested", 0)
+    print "Harvested %d records in %.2f s: %.2f records/s (%d failed)" % \
+          (count, elapsed, elapsed and count / elapsed or 0.0,
+           summary.get("records_failed", 0))
+    print "%-16s %10s %12s %10s %8s %12s" % ("stage", "time (s)", "bytes",
+                                              "succeeded", "failed", "ms/item")
+    for stage, totals in sorted(summary["stages"].items()):
+        items = totals["succeeded"] + totals["failed"]
+        print "%-16s %10.2f %12d %10d %8d %12.1f" % \
+              (stage, totals["seconds"], totals["bytes"], totals["succeeded"],
+               totals["failed"], items and 1000 * totals["seconds"] / items or 0.0)
+
+
+def usage(exitcode=1, msg=""):
+    if msg:
+        sys.stderr.write("Error: %s\n" % (msg,))
+    sys.stderr.write(__doc__[__doc__.index("Usage"):])
+    sys.exit(exitcode)
+
+
+def main():
+    try:
+        opts, dummy = getopt.getopt(sys.argv[1:], "n:p:l:j:r:mkh",
+                                    ["records=", "page-size=", "latency=",
+                                     "parallel=", "rate=", "metadata", "keep",
+                                     "help"])
+    except getopt.GetoptError, e:
+        usage(1, str(e))
+
+    options = {"number_of_articles": 200, "perpage": 100, "latency": 0.05,
+               "max_parallel": "", "rate": None, "metadata": False,
+               "keep": False}
+    try:
+        for opt, value in opts:
+            if opt in ("-n", "--records"):
+                options["number_of_articles"] = int(value)
+            elif opt in ("-p", "--page-size"):
+                options["perpage"] = int(value)
+            elif opt in ("-l", "--latency"):
+                options["latency"] = float(value)
+            elif opt in ("-j", "--parallel"):
+                options["max_parallel"] = int(value)
+            elif opt in ("-r", "--rate"):
+                options["rate"] = float(value)
+            elif opt in ("-m", "--metadata"):
+                options["metadata"] = True
+            elif opt in ("-k", "--keep"):
+                options["keep"] = True
+            elif opt in ("-h", "--help"):
+                usage(0)
+    except ValueError, e:
+        usage(1, str(e))
+
+    elapsed, summary = run_benchmark(**options)
+    print_report(elapsed, summary)
+
+
+if __name__ == "__main__":
+    main()
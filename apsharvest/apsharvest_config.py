@@ -1,10 +1,18 @@
+CFG_APSHARVEST_API_URL = "http://harvest.aps.org/content/journals/articles"
 CFG_APSHARVEST_FULLTEXT_URL = "http://harvest.aps.org/bagit/articles/%(doi)s/apsxml"
-CFG_APSHARVEST_REQUEST_TIMEOUT = 7.5
+CFG_APSHARVEST_PAGE_SIZE = 100
+CFG_APSHARVEST_MAX_PARALLEL = 4
+CFG_APSHARVEST_REQUESTS_PER_SECOND = 2.0
+CFG_APSHARVEST_CACHE_SIZE = 2 * 1024 * 1024 * 1024
 CFG_APSHARVEST_SEARCH_COLLECTION = "HEP"
 CFG_APSHARVEST_RECORD_DOI_TAG = "0247_a"
 CFG_APSHARVEST_MD5_FILE = "manifest-md5.txt"
 CFG_APSHARVEST_FFT_DOCTYPE = "APS"
 CFG_APSHARVEST_BUNCH_SIZE = 100
+CFG_APSHARVEST_SUBMISSION_BACKLOG = 2
+CFG_APSHARVEST_JOURNAL_BATCH_SIZE = 100
+CFG_APSHARVEST_PROMETHEUS_FILE = ""
+CFG_APSHARVEST_XSLT_BATCH_SIZE = 50
 CFG_APSHARVEST_XSLT = "/afs/cern.ch/project/inspire/xslt/aps.xsl"
 CFG_APSHARVEST_EMAIL = "desydoc@desy.de"
 CFG_APSHARVEST_APS_DIR = "/afs/cern.ch/project/inspire/uploads/aps"
@@ -78,6 +78,75 @@ def get_all_modified_records(since, last_recid):
     return run_sql(sql, (since.isoformat(), last_recid))
 
 
+def _get_bibxxx_tables(tag):
+    """
+    Returns the names of the bibXXx and bibrec_bibXXx tables for given tag.
+    """
+    bibxxx = "bib%sx" % (tag[:2],)
+    return bibxxx, "bibrec_%s" % (bibxxx,)
+
+
+def _chunks(values, chunk_size):
+    """
+    Splits given list of values in chunks of at most chunk_size values.
+    """
+    values = list(values)
+    for i in xrange(0, len(values), chunk_size):
+        yield values[i:i + chunk_size]
+
+
+def get_dois_from_recids(recids, doi_tag, chunk_size=1000):
+    """
+    Get the first DOI found in the given DOI tag (ex. 0247_a) of each of the
+    given records, with one query per chunk_size records. Only fields with
+    subfield $2 set to "DOI" are considered.
+
+    @return: dictionary of recid -> DOI for records having a DOI.
+    """
+    bibxxx, bibrec_bibxxx = _get_bibxxx_tables(doi_tag)
+    dois = {}
+    for chunk in _chunks(recids, chunk_size):
+        sql = "SELECT ra.id_bibrec, a.value FROM %(bibrec_bibxxx)s AS ra " \
+            "JOIN %(bibxxx)s AS a ON a.id = ra.id_bibxxx " \
+            "JOIN %(bibrec_bibxxx)s AS r2 ON r2.id_bibrec = ra.id_bibrec " \
+            "AND r2.field_number = ra.field_number " \
+            "JOIN %(bibxxx)s AS b2 ON b2.id = r2.id_bibxxx " \
+            "WHERE a.tag = %%s AND b2.tag = %%s AND b2.value = 'DOI' " \
+            "AND ra.id_bibrec IN (%(recids)s) " \
+            "ORDER BY ra.id_bibrec, ra.field_number" % \
+            {'bibxxx': bibxxx,
+             'bibrec_bibxxx': bibrec_bibxxx,
+             'recids': ", ".join(["%s"] * len(chunk))}
+        params = [doi_tag, doi_tag[:-1] + "2"] + [int(recid) for recid in chunk]
+        for recid, doi in run_sql(sql, params):
+            if recid not in dois:
+                dois[recid] = doi
+    return dois
+
+
+def get_recids_from_dois(dois, doi_tag, chunk_size=1000):
+    """
+    Get the records having the given DOIs in the given DOI tag
+    (ex. 0247_a), with one query per chunk_size DOIs.
+
+    @return: dictionary of DOI -> sorted list of recids, for DOIs found.
+    """
+    bibxxx, bibrec_bibxxx = _get_bibxxx_tables(doi_tag)
+    recids = {}
+    for chunk in _chunks(dois, chunk_size):
+        sql = "SELECT a.value, ra.id_bibrec FROM %(bibxxx)s AS a " \
+            "JOIN %(bibrec_bibxxx)s AS ra ON ra.id_bibxxx = a.id " \
+            "WHERE a.tag = %%s AND a.value IN (%(dois)s)" % \
+            {'bibxxx': bibxxx,
+             'bibrec_bibxxx': bibrec_bibxxx,
+             'dois': ", ".join(["%s"] * len(chunk))}
+        for doi, recid in run_sql(sql, [doi_tag] + list(chunk)):
+            recids.setdefault(doi, set()).add(recid)
+    for doi in recids:
+        recids[doi] = sorted(recids[doi])
+    return recids
+
+
 def can_launch_bibupload(taskid):
     """
     Checks if task can be launched.
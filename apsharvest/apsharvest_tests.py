@@ -25,17 +25,40 @@ The tests will not modifiy the database.
 
 import unittest
 import zipfile
+import threading
+import time
+import BaseHTTPServer
 from invenio.config import CFG_TMPSHAREDDIR
 import os
+import sys
+import cgi
+import urlparse
+import hashlib
+import shutil
+from tempfile import mkdtemp
+from invenio.jsonutils import json
 from invenio.testutils import make_test_suite, run_test_suite
 from invenio.apsharvest_utils import (unzip,
                                       find_and_validate_md5_checksums,
+                                      read_zip_validating_md5_checksums,
+                                      remove_dtd_information_from_string,
+                                      get_xml_attribute_values,
+                                      InvenioFileChecksumError,
                                       get_temporary_file,
                                       validate_date,
                                       get_file_modified_date,
-                                      compare_datetime_to_iso8601_date)
+                                      compare_datetime_to_iso8601_date,
+                                      convert_xml_using_saxon_batch,
+                                      HarvestJournal,
+                                      HarvestMetrics,
+                                      download_url_conditionally)
 from invenio.bibdocfile import calculate_md5_external
-from invenio.bibsched_tasklets.bst_apsharvest import APSRecord, APSRecordList
+from invenio.bibsched_tasklets import bst_apsharvest
+from invenio.bibsched_tasklets.bst_apsharvest import (APSRecord,
+                                                      APSRecordList,
+                                                      download_records,
+                                                      harvest_aps,
+                                                      process_harvested_records)
 
 
 def get_files_and_folders(in_folder):
@@ -103,17 +126,432 @@ class FileTest(unittest.TestCase):
         self.assertTrue(len(res) == 1)
 
 
+FULLTEXT_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE article PUBLIC "-//American Physical Society//DTD Archival Article 1.0//EN" "article.dtd">
+<article><meta><doi>10.1103/PhysRevTest.1</doi>
+<history><received date="2013-01-02"/><published date="2013-03-04"/></history>
+</meta><body>Text</body></article>
+"""
+
+
+def create_test_bag(zipped_file, fulltext=FULLTEXT_XML, checksum=None):
+    """
+    Creates a zipped bagit archive like the ones delivered by APS.
+    """
+    checksum = checksum or hashlib.md5(fulltext).hexdigest()
+    z = zipfile.ZipFile(zipped_file, 'w')
+    z.writestr("bag/bagit.txt", "BagIt-Version: 0.96\n")
+    z.writestr("bag/manifest-md5.txt", "%s data/fulltext.xml\n" % (checksum,))
+    z.writestr("bag/data/fulltext.xml", fulltext)
+    z.close()
+    return zipped_file
+
+
+class LocalAPSRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in for harvest.aps.org serving test/test.zip for any bagit request
+    and a paginated list of 25 articles for the articles API.
+    """
+    number_of_articles = 25
+    bag_requests = []
+
+    def do_GET(self):
+        if self.path.startswith("/content/journals/articles"):
+            self.send_articles()
+            return
+        if not self.path.startswith("/bagit/articles/"):
+            self.send_error(404)
+            return
+        fd = open("./test/test.zip", "rb")
+        data = fd.read()
+        fd.close()
+        etag = '"%s"' % (hashlib.md5(data).hexdigest(),)
+        if self.headers.get("If-None-Match") == etag:
+            self.bag_requests.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.bag_requests.append(200)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_articles(self):
+        query = cgi.parse_qs(urlparse.urlparse(self.path)[4])
+        page = int(query["page"][0])
+        perpage = int(query["per_page"][0])
+        last_page = (self.number_of_articles - 1) // perpage + 1
+        articles = [{"doi": "10.1103/PhysRevTest.%d" % (i,),
+                     "last_modified_at": "2013-07-18T16:31:46Z"}
+                    for i in range((page - 1) * perpage,
+                                   min(page * perpage, self.number_of_articles))]
+        url = "http://localhost:%d%s" % (self.server.server_port,
+                                         self.path.split("?")[0])
+        links = ['<%s?page=%d&per_page=%d>; rel="last"' % (url, last_page, perpage)]
+        if page < last_page:
+            links.append('<%s?page=%d&per_page=%d>; rel="next"' % (url, page + 1, perpage))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Link", ", ".join(links))
+        self.end_headers()
+        self.wfile.write(json.dumps(articles))
+
+    def log_message(self, *args):
+        pass
+
+
+class DroppingAPSRequestHandler(LocalAPSRequestHandler):
+    """
+    Closes the connection without answering the first request of every
+    bagit archive.
+    """
+    dropped = []
+
+    def do_GET(self):
+        if self.path.startswith("/bagit/articles/") and \
+           self.path not in self.dropped:
+            self.dropped.append(self.path)
+            self.close_connection = 1
+            return
+        LocalAPSRequestHandler.do_GET(self)
+
+
+def start_local_aps_server(handler=LocalAPSRequestHandler):
+    """
+    Starts a local HTTP server in a thread and returns it. The URL of the
+    server is http://localhost:<server.server_port>.
+    """
+    server = BaseHTTPServer.HTTPServer(("localhost", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_local_aps_server()
+        self.url_template = "http://localhost:%d/bagit/articles/%%(doi)s/apsxml" % \
+                            (self.server.server_port,)
+        self.directory = mkdtemp(prefix="apsharvest_test_")
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.directory, True)
+
+    def test_parallel_download(self):
+        """
+        Test that all records are downloaded by the download pool.
+        """
+        records = [APSRecord(None, "10.1103/PhysRevTest.%d" % (i,))
+                   for i in range(10)]
+        results = list(download_records(records,
+                                        max_parallel=4,
+                                        url_template=self.url_template,
+                                        directory=self.directory,
+                                        rate=0))
+        self.assertEqual(10, len(results))
+        self.assertEqual(set([r.doi for r in records]),
+                         set([r.doi for r, dummy1, dummy2 in results]))
+        for dummy, result_file, error_message in results:
+            self.assertEqual("", error_message)
+            self.assertTrue(zipfile.is_zipfile(result_file))
+
+    def test_download_errors(self):
+        """
+        Test that failed downloads are reported per record.
+        """
+        records = [APSRecord(None, "10.1103/PhysRevTest.1"),
+                   APSRecord(None, "10.1103/PhysRevTest.2")]
+        # Record without DOI
+        records[1].doi = ""
+        url_template = self.url_template.replace("/bagit/", "/missing/")
+        results = list(download_records(records,
+                                        max_parallel=2,
+                                        url_template=url_template,
+                                        directory=self.directory,
+                                        rate=0))
+        self.assertEqual(2, len(results))
+        for dummy, result_file, error_message in results:
+            self.assertEqual(None, result_file)
+            self.assertTrue(error_message)
+
+    def test_conditional_download(self):
+        """
+        Test that cached archives are only downloaded again when changed.
+        """
+        del LocalAPSRequestHandler.bag_requests[:]
+        record = APSRecord(None, "10.1103/PhysRevTest.1",
+                           last_modified="2013-07-18T16:31:46Z")
+        for dummy in range(2):
+            results = list(download_records([record],
+                                            url_template=self.url_template,
+                                            directory=self.directory,
+                                            rate=0))
+            self.assertEqual("", results[0][2])
+        # Same last modification date: no second request
+        self.assertEqual([200], LocalAPSRequestHandler.bag_requests)
+
+        record.last_modified = "2013-07-19T16:31:46Z"
+        results = list(download_records([record],
+                                        url_template=self.url_template,
+                                        directory=self.directory,
+                                        rate=0))
+        self.assertEqual([200, 304], LocalAPSRequestHandler.bag_requests)
+        self.assertTrue(zipfile.is_zipfile(results[0][1]))
+
+    def test_cache_eviction(self):
+        """
+        Test that least recently used archives are removed from the cache.
+        """
+        size = os.path.getsize("./test/test.zip")
+        records = [APSRecord(None, "10.1103/PhysRevTest.%d" % (i,))
+                   for i in range(3)]
+        for record in records:
+            list(download_records([record],
+                                  url_template=self.url_template,
+                                  directory=self.directory,
+                                  rate=0,
+                                  cache_size=2 * size))
+        self.assertFalse(os.path.exists(os.path.join(self.directory,
+                                                     "10.1103_PhysRevTest.0.zip")))
+        self.assertTrue(os.path.exists(os.path.join(self.directory,
+                                                    "10.1103_PhysRevTest.2.zip")))
+
+    def test_rate_limit(self):
+        """
+        Test that requests to the same host are rate limited.
+        """
+        records = [APSRecord(None, "10.1103/PhysRevTest.%d" % (i,))
+                   for i in range(4)]
+        start = time.time()
+        list(download_records(records,
+                              max_parallel=4,
+                              url_template=self.url_template,
+                              directory=self.directory,
+                              rate=10))
+        # Burst of 4 tokens allowed, no need to wait
+        self.assertTrue(time.time() - start < 2.0)
+        records = [APSRecord(None, "10.1103/PhysRevTest.%d" % (i,))
+                   for i in range(4, 10)]
+        start = time.time()
+        list(download_records(records,
+                              max_parallel=1,
+                              url_template=self.url_template,
+                              directory=self.directory,
+                              rate=5))
+        # Bucket of 1 token refilled at 5/s: 5 waits of 0.2 seconds
+        self.assertTrue(time.time() - start >= 0.9)
+
+    def test_dropped_connection(self):
+        """
+        Test that a download is retried when the connection is dropped.
+        """
+        server = start_local_aps_server(DroppingAPSRequestHandler)
+        try:
+            url = "http://localhost:%d/bagit/articles/10.1103/PhysRevTest.1/apsxml" % \
+                  (server.server_port,)
+            download_file = os.path.join(self.directory, "dropped.zip")
+            downloaded, dummy = download_url_conditionally(url, download_file,
+                                                           retry_count=2)
+            self.assertTrue(downloaded)
+            self.assertTrue(zipfile.is_zipfile(download_file))
+            self.assertEqual(1, len(DroppingAPSRequestHandler.dropped))
+        finally:
+            server.shutdown()
+
+
+class HarvestAPSTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_local_aps_server()
+        self.api_url = bst_apsharvest.CFG_APSHARVEST_API_URL
+        bst_apsharvest.CFG_APSHARVEST_API_URL = \
+            "http://localhost:%d/content/journals/articles" % (self.server.server_port,)
+
+    def tearDown(self):
+        bst_apsharvest.CFG_APSHARVEST_API_URL = self.api_url
+        self.server.shutdown()
+
+    def test_pages_in_order(self):
+        """
+        Test that records of all pages are yielded in page order.
+        """
+        records = harvest_aps("2013-01-01", None, 4, max_parallel=3)
+        self.assertFalse(isinstance(records, list))
+        self.assertEqual(["10.1103/PhysRevTest.%d" % (i,) for i in range(25)],
+                         [record.doi for record in records])
+
+
+class BagTest(unittest.TestCase):
+    def setUp(self):
+        self.bag_file = get_temporary_file(directory="/tmp", suffix=".zip")
+
+    def tearDown(self):
+        if os.path.exists(self.bag_file):
+            os.remove(self.bag_file)
+
+    def test_read_and_validate(self):
+        """
+        Test reading and validating a bag without extracting it.
+        """
+        bag = create_test_bag(self.bag_file)
+        files = read_zip_validating_md5_checksums(bag, "manifest-md5.txt")
+        self.assertEqual([("bag/data/fulltext.xml", FULLTEXT_XML)], files)
+
+    def test_checksum_mismatch(self):
+        """
+        Test that a wrong checksum is detected.
+        """
+        bag = create_test_bag(self.bag_file,
+                              checksum="54b0c58c7ce9f2a8b551351102ee0938")
+        self.assertRaises(InvenioFileChecksumError,
+                          read_zip_validating_md5_checksums,
+                          bag, "manifest-md5.txt")
+
+    def test_remove_dtd(self):
+        """
+        Test that the article DTD declaration is removed.
+        """
+        cleaned = remove_dtd_information_from_string(FULLTEXT_XML)
+        self.assertFalse("DOCTYPE" in cleaned)
+        self.assertEqual(len(FULLTEXT_XML.splitlines()), len(cleaned.splitlines()))
+
+    def test_published_date(self):
+        """
+        Test finding the published date in the fulltext.
+        """
+        self.assertEqual(["2013-03-04"],
+                         get_xml_attribute_values(FULLTEXT_XML,
+                                                  "meta/history/published"))
+        self.assertEqual(None,
+                         get_xml_attribute_values(FULLTEXT_XML,
+                                                  "meta/history/revised"))
+
+
+# Stand-in for saxon9he-xslt: converts every source file to a record named
+# after its DOI, except the files containing FAIL, printing messages like
+# saxon does.
+FAKE_SAXON = """#!%s
+import os, re, sys
+options = dict([arg[1:].split(":", 1) for arg in sys.argv[1:] if ":" in arg])
+failed = False
+for name in sorted(os.listdir(options["s"])):
+    text = open(os.path.join(options["s"], name)).read()
+    if "WARN" in text:
+        sys.stderr.write("Warning: at article on line 1 of %%s: ignored\\n" %% (name,))
+    if "FAIL" in text:
+        sys.stderr.write("Error on line 3 of %%s:\\n  XTDE0640: failed\\n" %% (name,))
+        sys.stderr.write("Error at xsl:value-of on line 12 of aps.xsl:\\n")
+        failed = True
+        continue
+    doi = re.search("<doi>(.*)</doi>", text).group(1)
+    output = open(os.path.join(options["o"], doi.replace("/", "_") + ".xml"), "w")
+    output.write('<record><controlfield tag="001">1</controlfield></record>')
+    output.close()
+if failed:
+    sys.stderr.write("Transformation failed: Run-time errors were reported\\n")
+    sys.exit(2)
+""" % (sys.executable,)
+
+
+class ConversionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp(prefix="apsharvest_test_")
+        saxon = os.path.join(self.directory, "saxon9he-xslt")
+        fd = open(saxon, "w")
+        fd.write(FAKE_SAXON)
+        fd.close()
+        os.chmod(saxon, 0755)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = self.directory + os.pathsep + self.path
+        self.template = os.path.join(self.directory, "aps.xsl")
+        open(self.template, "w").close()
+        self.xslt = bst_apsharvest.CFG_APSHARVEST_XSLT
+        bst_apsharvest.CFG_APSHARVEST_XSLT = self.template
+        self.workdir = os.path.join(CFG_TMPSHAREDDIR, "apsharvest")
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        self.workdir_entries = set(os.listdir(self.workdir))
+        # The middle file fails, the first one only gets a warning
+        self.files = []
+        for i, marker in enumerate(("WARN", "FAIL", "")):
+            source_file = os.path.join(self.directory, "source_%d.xml" % (i,))
+            fd = open(source_file, "w")
+            fd.write("<article><doi>10.1103/PhysRevTest.%d</doi>%s</article>"
+                     % (i, marker))
+            fd.close()
+            self.files.append(source_file)
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        bst_apsharvest.CFG_APSHARVEST_XSLT = self.xslt
+        shutil.rmtree(self.directory, True)
+        # Converted files
+        for entry in set(os.listdir(self.workdir)) - self.workdir_entries:
+            shutil.rmtree(os.path.join(self.workdir, entry), True)
+
+    def test_failing_file_in_batch(self):
+        """
+        Test that saxon messages are only attributed to the files they name.
+        """
+        output_directory, messages = \
+            convert_xml_using_saxon_batch(self.files, self.template)
+        self.assertEqual(["10.1103_PhysRevTest.0.xml",
+                          "10.1103_PhysRevTest.2.xml"],
+                         sorted(os.listdir(output_directory)))
+        self.assertEqual(sorted(self.files[:2]), sorted(messages.keys()))
+        self.assertTrue("Warning" in messages[self.files[0]])
+        self.assertTrue("XTDE0640" in messages[self.files[1]])
+        self.assertFalse("Transformation failed" in messages[self.files[1]])
+
+    def test_failing_record_in_batch(self):
+        """
+        Test that only the record whose converted file is missing fails.
+        """
+        records = [APSRecord(i + 1, "10.1103/PhysRevTest.%d" % (i,))
+                   for i in range(3)]
+        batch = [(record, source_file, source_file)
+                 for record, source_file in zip(records, self.files)]
+        errors = {}
+        for record, error_message in process_harvested_records(batch, True,
+                                                               False, True):
+            if error_message:
+                errors[record.doi] = error_message
+        self.assertEqual(["10.1103/PhysRevTest.1"], errors.keys())
+        self.assertTrue("XTDE0640" in errors["10.1103/PhysRevTest.1"])
+        self.assertTrue(records[0].record is not None)
+        self.assertTrue(records[2].record is not None)
+
+
 class APSRecordTest(unittest.TestCase):
     def test_adding_record(self):
         l = APSRecordList()
-        r1 = APSRecord(1, doi=["dummy"])
+        r1 = APSRecord(1, doi="dummy")
         l.append(r1)
         self.assertEqual(1, len(l))
 
-        r2 = APSRecord(1, doi=["dummy2"])
+        r2 = APSRecord(1, doi="dummy2")
         l.append(r2)
         self.assertEqual(1, len(l))
 
+        # Records without record ID are told apart by their DOI
+        l.append(APSRecord(None, doi="dummy3"))
+        l.append(APSRecord(None, doi="dummy4"))
+        l.append(APSRecord(None, doi="dummy3"))
+        l.append(APSRecord(2, doi="dummy"))
+        self.assertEqual(["dummy", "dummy3", "dummy4"],
+                         [record.doi for record in l])
+
+    def test_lazy_record(self):
+        r = APSRecord(1, doi="dummy")
+        self.assertEqual(None, r._record)
+        r.add_fft("/tmp/fulltext.xml")
+        self.assertTrue(r._record is not None)
+        self.assertTrue("FFT__" in r.record)
+
 
 class APSUtilsTest(unittest.TestCase):
     def test_date_validation(self):
@@ -135,7 +573,69 @@ class APSUtilsTest(unittest.TestCase):
         self.assertFalse(compare_datetime_to_iso8601_date(file_last_modified,
                                                           comparison_date))
 
-TEST_SUITE = make_test_suite(FileTest, APSRecordTest, APSUtilsTest)
+    def test_harvest_journal(self):
+        journal_file = get_temporary_file(prefix="apsharvest_journal_",
+                                          directory="/tmp")
+        try:
+            journal = HarvestJournal(journal_file, batch_size=2)
+            journal.mark("10.1103/A", "downloaded")
+            self.assertEqual(os.path.getsize(journal_file), 0)
+            journal.mark("10.1103/A", "converted", metadata="a.xml")
+            journal.mark("10.1103/B", "submitted")
+            journal.mark("10.1103/B", "downloaded")
+            journal.flush()
+            # A line left incomplete by a killed run
+            fd = open(journal_file, 'a')
+            fd.write('{"key": "10.1103/C", "sta')
+            fd.close()
+
+            journal = HarvestJournal(journal_file)
+            self.assertEqual(len(journal), 2)
+            self.assertEqual(journal.get_stage("10.1103/A"), "converted")
+            self.assertEqual(journal.get_value("10.1103/A", "metadata"), "a.xml")
+            self.assertTrue(journal.has_reached("10.1103/A", "downloaded"))
+            self.assertFalse(journal.has_reached("10.1103/A", "submitted"))
+            self.assertTrue(journal.has_reached("10.1103/B", "submitted"))
+            self.assertFalse(journal.has_reached("10.1103/C", "downloaded"))
+            journal.mark("10.1103/C", "downloaded")
+            journal.flush()
+            self.assertTrue(HarvestJournal(journal_file).has_reached("10.1103/C",
+                                                                      "downloaded"))
+            journal.remove()
+            self.assertFalse(os.path.exists(journal_file))
+        finally:
+            if os.path.exists(journal_file):
+                os.remove(journal_file)
+
+    def test_harvest_metrics(self):
+        metrics = HarvestMetrics()
+        metrics.add("download", 1.5, 100)
+        metrics.add("download", 0.5, succeeded=0, failed=1)
+        metrics.set_value("records_harvested", 1)
+        summary = metrics.get_summary()
+        self.assertEqual(summary["records_harvested"], 1)
+        self.assertEqual(summary["stages"]["download"],
+                         {"seconds": 2.0, "bytes": 100,
+                          "succeeded": 1, "failed": 1})
+
+        metrics_file = get_temporary_file(directory="/tmp")
+        try:
+            metrics.write_json(metrics_file)
+            self.assertEqual(json.load(open(metrics_file))["stages"],
+                             summary["stages"])
+            metrics.write_prometheus(metrics_file)
+            lines = open(metrics_file).read().splitlines()
+            self.assertTrue('apsharvest_stage_bytes{stage="download"} 100' in lines)
+            self.assertTrue('apsharvest_stage_items{stage="download",'
+                            'result="failed"} 1' in lines)
+        finally:
+            os.remove(metrics_file)
+
+        metrics.reset()
+        self.assertEqual(metrics.get_summary()["stages"], {})
+
+TEST_SUITE = make_test_suite(FileTest, DownloadTest, HarvestAPSTest, BagTest,
+                             ConversionTest, APSRecordTest, APSUtilsTest)
 
 if __name__ == '__main__':
     run_test_suite(TEST_SUITE)
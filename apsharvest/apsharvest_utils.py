@@ -20,12 +20,23 @@
 import os
 import fnmatch
 import zipfile
-import codecs
+import hashlib
+import posixpath
 import re
 import datetime
 import time
+import threading
+import urllib2
+import httplib
+import socket
+import shutil
+
+from cStringIO import StringIO
+from lxml import etree
 
 from invenio.config import CFG_TMPSHAREDDIR
+from invenio.jsonutils import json
+from invenio.filedownloadutils import InvenioFileDownloadError
 from tempfile import mkdtemp, mkstemp
 from invenio.bibdocfile import calculate_md5_external
 from invenio.shellutils import run_shell_command
@@ -140,6 +151,66 @@ def find_and_validate_md5_checksums(in_folder, md5key_filename):
     return validated_files
 
 
+def read_zip_validating_md5_checksums(zipped_file, md5key_filename,
+                                      chunk_size=65536):
+    """
+    Reads the files listed in the MD5 key file(s) called md5key_filename
+    inside the given zipped file, without extracting anything to disk.
+
+    Each file is hashed while it is being read and compared with the
+    hashkey from the key file, which is expected to follow the same
+    structure as for find_and_validate_md5_checksums:
+
+    hashkey filepath
+
+    @raise: InvenioFileChecksumError if a file is missing or not matching
+            its checksum.
+
+    @return: list of (path inside the zipped file, contents) tuples of the
+             validated files.
+    """
+    validated_files = []
+    z = zipfile.ZipFile(zipped_file)
+    try:
+        names = z.namelist()
+        for key_file in names:
+            if not fnmatch.fnmatch(posixpath.basename(key_file), md5key_filename):
+                continue
+            for line in z.read(key_file).splitlines():
+                split_line = line.strip().split(None, 1)
+                if len(split_line) != 2:
+                    continue
+                hashkey, hashkey_target = split_line
+                hashkey_target = posixpath.normpath(
+                    posixpath.join(posixpath.dirname(key_file), hashkey_target))
+                if hashkey_target not in names:
+                    raise InvenioFileChecksumError("Error matching checksum of %s:"
+                                                   " file not found in %s" %
+                                                   (hashkey_target, zipped_file))
+                md5 = hashlib.md5()
+                contents = []
+                member = z.open(hashkey_target)
+                try:
+                    chunk = member.read(chunk_size)
+                    while chunk:
+                        md5.update(chunk)
+                        contents.append(chunk)
+                        chunk = member.read(chunk_size)
+                finally:
+                    member.close()
+                found_hashkey = md5.hexdigest()
+                if found_hashkey != hashkey.lower():
+                    raise InvenioFileChecksumError("Error matching checksum of %s:"
+                                                   " %s is not equal to %s" %
+                                                   (hashkey_target,
+                                                    found_hashkey,
+                                                    hashkey))
+                validated_files.append((hashkey_target, "".join(contents)))
+    finally:
+        z.close()
+    return validated_files
+
+
 def get_temporary_file(prefix="apsharvest_test_", suffix="", directory=""):
     """
     Using a similar interface as tempfile.mkstemp, this function wraps
@@ -159,22 +230,35 @@ def get_temporary_file(prefix="apsharvest_test_", suffix="", directory=""):
     return filepath
 
 
-def remove_dtd_information(fulltext_file):
+def remove_dtd_information_from_string(xml_data):
     """
-    Removes any DTD schema validation of "article.dtd" in file.
+    Removes any DTD schema validation of "article.dtd" from given XML data.
     """
-    # Remove DTD line
-    cleaned_lines = []
-    for line in codecs.open(fulltext_file, "r", "utf-8"):
-        line = RE_ARTICLE_DTD.sub('', line)
-        cleaned_lines.append(line)
+    return RE_ARTICLE_DTD.sub('', xml_data)
 
-    # Overwrite file
-    new_file = os.path.splitext(fulltext_file)[0] + "_cleaned.xml"
-    fulltext_file = codecs.open(new_file, 'w', "utf-8")
-    fulltext_file.writelines(cleaned_lines)
-    fulltext_file.close()
-    return new_file
+
+def get_xml_attribute_values(xml_data, path):
+    """
+    Returns the attribute values of the first element found at given path
+    (relative to the root element, ex. 'meta/history/published') in given
+    XML data, or None if there is no such element.
+
+    The data is parsed incrementally and parsing stops as soon as the
+    element is found.
+    """
+    wanted = path.split('/')
+    current = []
+    context = etree.iterparse(StringIO(xml_data), events=("start", "end"))
+    for event, element in context:
+        if event == "end":
+            if current:
+                current.pop()
+            continue
+        # The root element is not part of the path
+        current.append(element.tag)
+        if current[1:] == wanted:
+            return element.values()
+    return None
 
 
 def convert_xml_using_saxon(source_file, template_file):
@@ -207,6 +291,518 @@ def convert_xml_using_saxon(source_file, template_file):
                                           stdout_buffer))
 
 
+def convert_xml_using_saxon_batch(source_files, template_file,
+                                  output_directory=None):
+    """
+    Converts all given source files (full paths) with a single run of the
+    XSLT 2.0 Java libraries, so that the JVM is started and the stylesheet
+    compiled only once for the whole batch.
+
+    The source files are linked into a temporary batch directory which is
+    transformed as a whole into output_directory (a new temporary directory
+    inside CFG_TMPSHAREDDIR/apsharvest if not given). Like with
+    convert_xml_using_saxon, the names of the converted files are decided
+    inside the template file.
+
+    A failing file does not stop the conversion of the other files in the
+    batch. Every message printed by saxon (a line and its indented
+    continuation lines) is attributed to the files it names. Since warnings
+    are reported too, and runtime errors may only name the stylesheet, a
+    file has only failed if its converted file is missing.
+
+    @raise: APSHarvesterConversionError if the batch could not be converted
+            at all.
+
+    @return: tuple of (output_directory, messages) where messages is a
+             dictionary of source file -> lines printed by saxon naming it.
+    """
+    if not os.path.isabs(template_file):
+        template_file = CFG_BIBCONVERT_XSL_PATH + os.sep + template_file
+    workdir = os.path.join(CFG_TMPSHAREDDIR, 'apsharvest')
+    batch_directory = mkdtemp(prefix="apsharvest_batch_", dir=workdir)
+    if not output_directory:
+        output_directory = mkdtemp(prefix="apsharvest_converted_", dir=workdir)
+
+    # Batch file name -> source file
+    batch_files = {}
+    for index, source_file in enumerate(source_files):
+        batch_name = "apsharvest_source_%05d.xml" % (index,)
+        os.symlink(os.path.abspath(source_file),
+                   os.path.join(batch_directory, batch_name))
+        batch_files[batch_name] = source_file
+
+    command = "saxon9he-xslt -s:%s -xsl:%s -o:%s -dtd:off" % \
+              (batch_directory, template_file, output_directory)
+    exit_code, stdout_buffer, stderr_buffer = run_shell_command(cmd=command)
+
+    messages = {}
+    unattributed = []
+    named_files = []
+    for line in (stdout_buffer + stderr_buffer).splitlines():
+        if not line[:1].isspace():
+            # A new message
+            named_files = [source_file for name, source_file
+                           in batch_files.iteritems() if name in line]
+        for source_file in named_files:
+            messages.setdefault(source_file, []).append(line)
+        if not named_files:
+            unattributed.append(line)
+    messages = dict([(source_file, "\n".join(lines))
+                     for source_file, lines in messages.iteritems()])
+
+    for batch_name in batch_files:
+        os.remove(os.path.join(batch_directory, batch_name))
+    os.rmdir(batch_directory)
+
+    if exit_code and not messages and not os.listdir(output_directory):
+        # Nothing was converted, saxon did not even start
+        raise APSHarvesterConversionError("%s: %s" %
+                                          (exit_code, "\n".join(unattributed)))
+    return output_directory, messages
+
+
+def download_url_conditionally(url, download_to_file, headers=None,
+                               content_type=None, retry_count=5,
+                               timeout=60.0):
+    """
+    Downloads given URL to given file, sending the given (conditional)
+    request headers, ex. If-None-Match or If-Modified-Since.
+
+    The file is only replaced once the download is complete.
+
+    @raise: InvenioFileDownloadError if the URL could not be downloaded, or
+            is not of the expected content type.
+
+    @return: tuple of (downloaded, response headers) where downloaded is
+             False if the server answered 304 Not Modified.
+    """
+    request = urllib2.Request(url, headers=headers or {})
+    error = None
+    for dummy in range(max(retry_count, 1)):
+        try:
+            response = urllib2.urlopen(request, timeout=timeout)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                return False, e.info()
+            error = e
+            if e.code < 500:
+                # Client errors will not go away by retrying
+                break
+            continue
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            error = e
+            continue
+
+        try:
+            if content_type and content_type not in \
+                    response.info().get('Content-Type', ''):
+                raise InvenioFileDownloadError("URL could not be opened: %s"
+                                               " is not of type %s" %
+                                               (url, content_type))
+            partial_file = "%s.part" % (download_to_file,)
+            fd = open(partial_file, 'wb')
+            try:
+                shutil.copyfileobj(response, fd)
+            finally:
+                fd.close()
+            os.rename(partial_file, download_to_file)
+            return True, response.info()
+        finally:
+            response.close()
+    raise InvenioFileDownloadError("URL could not be opened: %s (%s)" %
+                                   (url, error))
+
+
+class DownloadCache(object):
+    """
+    Persistent, size-bounded cache of downloaded files, keyed by an
+    identifier such as a DOI.
+
+    For every file the ETag and Last-Modified headers of the response are
+    stored, so that the file is only downloaded again when it has changed.
+    When the cache is larger than max_size bytes, the least recently used
+    files are removed.
+
+    The index is stored as JSON in the cache directory.
+    """
+    def __init__(self, directory, max_size, index_filename="download_cache.json"):
+        self.directory = directory
+        self.max_size = max_size
+        self.index_file = os.path.join(directory, index_filename)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.index_file):
+            try:
+                fd = open(self.index_file)
+                try:
+                    self.entries = json.load(fd)
+                finally:
+                    fd.close()
+            except ValueError:
+                # Corrupted index, start from scratch
+                self.entries = {}
+
+    def get_path(self, key, filename):
+        """
+        Returns the path to the cached file of given key if it exists.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if not entry or entry["file"] != filename:
+                return None
+            path = os.path.join(self.directory, filename)
+            if not os.path.exists(path):
+                del self.entries[key]
+                return None
+            return path
+        finally:
+            self.lock.release()
+
+    def get_value(self, key, name):
+        """
+        Returns a stored value of the entry of given key, or None.
+        """
+        self.lock.acquire()
+        try:
+            return self.entries.get(key, {}).get(name)
+        finally:
+            self.lock.release()
+
+    def get_conditional_headers(self, key):
+        """
+        Returns the conditional request headers for given key.
+        """
+        headers = {}
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key, {})
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        finally:
+            self.lock.release()
+        return headers
+
+    def touch(self, key):
+        """
+        Marks the file of given key as used.
+        """
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self.entries[key]["last_used"] = time.time()
+        finally:
+            self.lock.release()
+
+    def store(self, key, filename, response_headers=None, **values):
+        """
+        Adds the (already downloaded) file of given key to the cache,
+        together with the validators found in the response headers and any
+        other given values. Evicts old files if needed.
+        """
+        path = os.path.join(self.directory, filename)
+        entry = {"file": filename,
+                 "size": os.path.getsize(path),
+                 "last_used": time.time()}
+        if response_headers is not None:
+            entry["etag"] = response_headers.get("ETag")
+            entry["last_modified"] = response_headers.get("Last-Modified")
+        entry.update(values)
+        self.lock.acquire()
+        try:
+            self.entries[key] = entry
+            self._evict()
+        finally:
+            self.lock.release()
+
+    def _evict(self):
+        """
+        Removes least recently used files until the cache is below 90% of
+        its maximum size. The lock must be held.
+        """
+        total_size = sum([entry["size"] for entry in self.entries.itervalues()])
+        if total_size <= self.max_size:
+            return
+        by_last_use = sorted(self.entries.items(),
+                             key=lambda item: item[1]["last_used"])
+        for key, entry in by_last_use:
+            if total_size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, entry["file"]))
+            except OSError:
+                pass
+            total_size -= entry["size"]
+            del self.entries[key]
+
+    def save(self):
+        """
+        Writes the index of the cache to disk.
+        """
+        self.lock.acquire()
+        try:
+            data = json.dumps(self.entries)
+        finally:
+            self.lock.release()
+        temporary_file = "%s.tmp" % (self.index_file,)
+        fd = open(temporary_file, 'w')
+        try:
+            fd.write(data)
+        finally:
+            fd.close()
+        os.rename(temporary_file, self.index_file)
+
+
+class HarvestJournal(object):
+    """
+    Checkpoint journal of a harvest run, recording which stage (see STAGES)
+    every item, identified by a key such as a DOI, has reached, so that a
+    restarted run can skip the work already done.
+
+    Entries are appended to the journal file as JSON lines, in batches of
+    batch_size entries. A line left incomplete by a killed run is ignored.
+    """
+    STAGES = ("downloaded", "converted", "submitted")
+
+    def __init__(self, filename, batch_size=100):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.pending = []
+        # Whether the last line of the file was left incomplete
+        self.incomplete = False
+        if os.path.exists(filename):
+            fd = open(filename)
+            try:
+                for line in fd:
+                    self.incomplete = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._update(entry)
+            finally:
+                fd.close()
+
+    def _update(self, entry):
+        key = entry.pop("key")
+        current = self.entries.setdefault(key, {})
+        if self.STAGES.index(entry["stage"]) < \
+                self.STAGES.index(current.get("stage", self.STAGES[0])):
+            # Never go back to an earlier stage
+            del entry["stage"]
+        current.update(entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_stage(self, key):
+        """
+        Returns the last stage reached by given key, or None.
+        """
+        self.lock.acquire()
+        try:
+            return self.entries.get(key, {}).get("stage")
+        finally:
+            self.lock.release()
+
+    def has_reached(self, key, stage):
+        """
+        Returns True if given key has reached given stage or a later one.
+        """
+        current = self.get_stage(key)
+        return current is not None and \
+            self.STAGES.index(current) >= self.STAGES.index(stage)
+
+    def get_value(self, key, name):
+        """
+        Returns a value stored together with a stage of given key, or None.
+        """
+        self.lock.acquire()
+        try:
+            return self.entries.get(key, {}).get(name)
+        finally:
+            self.lock.release()
+
+    def mark(self, key, stage, **values):
+        """
+        Records that given key has reached given stage, together with any
+        given values. The journal file is written every batch_size entries.
+        """
+        entry = {"key": key, "stage": stage}
+        entry.update(values)
+        self.lock.acquire()
+        try:
+            self.pending.append(json.dumps(entry))
+            self._update(entry)
+            if len(self.pending) >= self.batch_size:
+                self._write()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """
+        Writes any pending entries to the journal file.
+        """
+        self.lock.acquire()
+        try:
+            self._write()
+        finally:
+            self.lock.release()
+
+    def _write(self):
+        """
+        Appends pending entries to the journal file. The lock must be held.
+        """
+        if not self.pending:
+            return
+        fd = open(self.filename, 'a')
+        try:
+            if self.incomplete:
+                fd.write("\n")
+                self.incomplete = False
+            fd.write("\n".join(self.pending) + "\n")
+            fd.flush()
+            os.fsync(fd.fileno())
+        finally:
+            fd.close()
+        self.pending = []
+
+    def remove(self):
+        """
+        Removes the journal once the harvest run is complete.
+        """
+        self.lock.acquire()
+        try:
+            self.entries = {}
+            self.pending = []
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+        finally:
+            self.lock.release()
+
+
+class HarvestMetrics(object):
+    """
+    Collects the time spent, the number of bytes processed and the number
+    of succeeded and failed items of every stage of a harvest run, together
+    with any other values describing the run.
+
+    Stages running in parallel threads are timed individually, so the total
+    time of a stage can be larger than the duration of the run.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Starts collecting metrics for a new run.
+        """
+        self.lock.acquire()
+        try:
+            self.started = time.time()
+            self.stages = {}
+            self.values = {}
+        finally:
+            self.lock.release()
+
+    def add(self, stage, seconds=0.0, size=0, succeeded=1, failed=0):
+        """
+        Adds the given time, size in bytes and number of items to the given
+        stage.
+        """
+        self.lock.acquire()
+        try:
+            totals = self.stages.setdefault(stage, {"seconds": 0.0,
+                                                    "bytes": 0,
+                                                    "succeeded": 0,
+                                                    "failed": 0})
+            totals["seconds"] += seconds
+            totals["bytes"] += size
+            totals["succeeded"] += succeeded
+            totals["failed"] += failed
+        finally:
+            self.lock.release()
+
+    def set_value(self, name, value):
+        """
+        Sets a numeric value describing the run, ex. the number of records.
+        """
+        self.lock.acquire()
+        try:
+            self.values[name] = value
+        finally:
+            self.lock.release()
+
+    def get_summary(self):
+        """
+        Returns a dictionary summarizing the run so far.
+        """
+        self.lock.acquire()
+        try:
+            stages = {}
+            for stage, totals in self.stages.iteritems():
+                stages[stage] = dict(totals)
+            summary = {"started": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                                time.localtime(self.started)),
+                       "duration": time.time() - self.started,
+                       "stages": stages}
+            summary.update(self.values)
+            return summary
+        finally:
+            self.lock.release()
+
+    def write_json(self, filename):
+        """
+        Writes the summary of the run as JSON to given file.
+        """
+        _write_file_atomically(filename,
+                               json.dumps(self.get_summary(), indent=2,
+                                          sort_keys=True))
+
+    def write_prometheus(self, filename, prefix="apsharvest"):
+        """
+        Writes the summary of the run to given file in the Prometheus text
+        format, as read by the textfile collector of the node exporter.
+        """
+        summary = self.get_summary()
+        lines = ["# TYPE %s_last_run_timestamp_seconds gauge" % (prefix,),
+                 "%s_last_run_timestamp_seconds %d" % (prefix, self.started),
+                 "# TYPE %s_run_duration_seconds gauge" % (prefix,),
+                 "%s_run_duration_seconds %f" % (prefix, summary["duration"])]
+        for name, value in sorted(self.values.items()):
+            lines.append("# TYPE %s_%s gauge" % (prefix, name))
+            lines.append("%s_%s %s" % (prefix, name, value))
+        for metric, key, labels in (("stage_seconds", "seconds", ""),
+                                    ("stage_bytes", "bytes", ""),
+                                    ("stage_items", "succeeded", ',result="succeeded"'),
+                                    ("stage_items", "failed", ',result="failed"')):
+            if key != "failed":
+                lines.append("# TYPE %s_%s gauge" % (prefix, metric))
+            for stage, totals in sorted(summary["stages"].items()):
+                lines.append('%s_%s{stage="%s"%s} %s' %
+                             (prefix, metric, stage, labels, totals[key]))
+        _write_file_atomically(filename, "\n".join(lines) + "\n")
+
+
+def _write_file_atomically(filename, data):
+    """
+    Writes data to a temporary file which then replaces the given file,
+    so that readers never see a partially written file.
+    """
+    temporary_file = "%s.tmp" % (filename,)
+    fd = open(temporary_file, 'w')
+    try:
+        fd.write(data)
+    finally:
+        fd.close()
+    os.rename(temporary_file, filename)
+
+
 def create_records_from_file(path_to_file):
     """
     Wrapping function using docextract_record.create_record function to return a
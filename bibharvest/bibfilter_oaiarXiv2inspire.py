@@ -10,12 +10,23 @@ import os
 import sys
 import getopt
 import re
+import itertools
+import multiprocessing
+import cPickle
+import hashlib
+import anydbm
+import time
+import zlib
 
-from invenio.bibupload import open_marc_file
-from invenio.config import CFG_ETCDIR
-from invenio.bibrecord import (create_records,
+from invenio.config import CFG_ETCDIR, CFG_CACHEDIR, CFG_VERSION, \
+     CFG_OAI_ID_FIELD, CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE, \
+     CFG_BIBUPLOAD_EXTERNAL_SYSNO_TAG, \
+     CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG, \
+     CFG_BIBUPLOAD_EXTERNAL_OAIID_PROVENANCE_TAG
+from invenio.dbquery import run_sql, deserialize_via_marshal
+from invenio.bibrecord import (create_record,
                                record_get_field_instances,
-                               record_add_field, record_xml_output,
+                               record_add_field,
                                field_get_subfield_values,
                                record_get_field_values,
                                field_get_subfield_instances,
@@ -23,11 +34,21 @@ from invenio.bibrecord import (create_records,
                                create_field,
                                record_replace_field)
 from invenio.search_engine import get_record
-from invenio.bibmerge_differ import record_diff, match_subfields
-from invenio.bibupload import retrieve_rec_id
+from invenio.marcxmlutils import MARCXMLWriter
 from invenio.textutils import wash_for_xml, wash_for_utf8
-from invenio.search_engine import perform_request_search
+from invenio.search_engine import get_field_tags
 from invenio.refextract_api import extract_journal_reference
+from invenio.refextract_config import CFG_REFEXTRACT_KBS
+
+# Actions configuration used by filter_record, see set_action_dict
+ACTION_DICT = {}
+# Number of records matched against the database at once
+RECORDS_BLOCK_SIZE = 1000
+# Cache of the publication notes parsed by refextract, kept across runs
+PUBNOTE_CACHE_FILE = os.path.join(CFG_CACHEDIR, "bibharvest", "arXiv_pubnotes.cache")
+PUBNOTE_CACHE_SIZE = 100000
+# Index of the arXiv records already filtered, to skip unchanged ones
+HARVESTED_RECORDS_INDEX_FILE = os.path.join(CFG_CACHEDIR, "bibharvest", "arXiv_records.db")
 
 
 def parse_actions(action_line):
@@ -141,21 +162,30 @@ def create_record_from_list(recid, field_list):
     return new_rec
 
 
-def write_record_to_file(filename, record_list):
+def get_records_from_file(filename, chunk_size=1024 * 1024):
     """
-    Writes a new MARCXML file to specified path from a list of records.
+    Yields the records of the given MARCXML file one at a time, as
+    returned by create_record, reading the file in chunks of chunk_size
+    bytes and washing every record for UTF-8 and XML.
     """
-    if len(record_list) > 0:
-        out = []
-        out.append("<collection>")
-        for record in record_list:
-            if record != {}:
-                out.append(record_xml_output(record))
-        out.append("</collection>")
-        if len(out) > 2:
-            file_fd = open(filename, 'w')
-            file_fd.write("\n".join(out))
-            file_fd.close()
+    # Same regular expression as create_records
+    regex = re.compile('<record.*?>.*?</record>', re.DOTALL)
+    marc_file = open(filename)
+    try:
+        data = ""
+        while True:
+            chunk = marc_file.read(chunk_size)
+            data += chunk
+            end = 0
+            for match in regex.finditer(data):
+                yield create_record(wash_for_xml(wash_for_utf8(match.group())))
+                end = match.end()
+            # Keep what may be the beginning of the next record
+            data = data[end:]
+            if not chunk:
+                break
+    finally:
+        marc_file.close()
 
 
 def has_field_origin(field_list, origin, code):
@@ -169,20 +199,86 @@ def has_field_origin(field_list, origin, code):
     return False
 
 
+class FieldMatcher(object):
+    """
+    Hashed list of fields, answering has_field without comparing the
+    given field with every field of the list, which is quadratic for
+    records with thousands of authors.
+
+    Every field is filed under its indicators, value and one of its
+    subfields (the anchor): a matching field must have the same indicators
+    and value, and all its subfields, so the anchor, in the given field.
+    """
+    def __init__(self, field_list=()):
+        # (ind1, ind2, value) -> anchor subfield -> list of sets of subfields
+        self._fields = {}
+        for field in field_list:
+            self.add(field)
+
+    def add(self, field):
+        """
+        Adds the given field to the list.
+        """
+        subfields = frozenset(field[0])
+        anchor = None
+        if subfields:
+            anchor = min(subfields)
+        self._fields.setdefault(field[1:4], {}).setdefault(anchor, []).append(subfields)
+
+    def has_field(self, field):
+        """
+        Checks if the list contains a field identical to the given field,
+        as has_field does.
+        """
+        anchors = self._fields.get(field[1:4])
+        if not anchors:
+            return False
+        if None in anchors:
+            # A field without subfields matches any field
+            return True
+        subfields = frozenset(field[0])
+        for subfield in subfields:
+            for candidate in anchors.get(subfield, ()):
+                if candidate <= subfields:
+                    return True
+        return False
+
+
 def has_field(field, field_list):
     """
     This function checks if the given list of fields contains an field
     identical to passed field.
     """
-    if len(field_list) > 0:
-        for subfields, ind1, ind2, value, dummy in field_list:
-            if (ind1, ind2, value) == field[1:4]:
-                for sub in subfields:
-                    if sub not in field[0]:
-                        break
-                else:
-                    return True
-    return False
+    return FieldMatcher(field_list).has_field(field)
+
+
+def record_diff_codes(rec1, rec2):
+    """
+    Compares two records tag by tag, as record_diff does, returning only
+    the kind of every difference, which is all the filter needs:
+
+     tag: None - if the fields of the tag are the same for both records
+     tag: ('r',) - if the tag exists in rec1 but not in rec2
+     tag: ('a',) - if the tag exists in rec2 but not in rec1
+     tag: ('c',) - if the fields of the tag have changed
+
+    The fields are not aligned, which record_diff does with a quadratic
+    number of fuzzy subfield comparisons for changed tags. The dictionary
+    is built in the same order as record_diff builds it, so it is iterated
+    in the same order too.
+    """
+    result = {}
+    for tag in rec1:
+        if tag not in rec2:
+            result[tag] = ('r',)
+        elif rec1[tag] == rec2[tag]:
+            result[tag] = None
+        else:
+            result[tag] = ('c',)
+    for tag in rec2:
+        if tag not in rec1:
+            result[tag] = ('a',)
+    return result
 
 
 def get_minimal_arxiv_id(record):
@@ -197,6 +293,366 @@ def get_minimal_arxiv_id(record):
             return value.split(':')[-1]
 
 
+def get_arxiv_version(record, arxiv_id):
+    """
+    Returns the version of the arXiv paper found in the fulltext URLs of
+    the record (ex. 2 for http://arxiv.org/pdf/1234.1234v2), or "".
+    """
+    regex = re.compile(re.escape(arxiv_id) + r"v(\d+)")
+    for url in record_get_field_values(record, "FFT", code="a"):
+        match = regex.search(url)
+        if match:
+            return match.group(1)
+    return ""
+
+
+def get_record_hash(record):
+    """
+    Returns a hash of the content of the given record, whatever the order
+    of its tags.
+    """
+    return hashlib.md5(repr(sorted(record.items()))).hexdigest()
+
+
+class HarvestedRecordIndex(object):
+    """
+    Persistent index of arXiv ID -> (date last seen, version, content hash)
+    of the records given to the filter, telling which re-delivered records
+    have not changed since they were last filtered.
+
+    The OAI datestamp is not part of the MARCXML given to the filter, so
+    the date the filter last saw a record is used instead.
+
+    New entries are only written by save, so that nothing is recorded for
+    a run which fails.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = None
+        self._pending = {}
+
+    def open(self):
+        """
+        Opens the index, creating it if needed.
+        """
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._db = anydbm.open(self.filename, "c")
+
+    def is_unchanged(self, record):
+        """
+        Checks if the given record was already filtered with the same
+        content, and records it as seen.
+        """
+        arxiv_id = get_minimal_arxiv_id(record)
+        if not arxiv_id:
+            return False
+        content_hash = get_record_hash(record)
+        self._pending[arxiv_id] = "%s %s %s" % (time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                                                get_arxiv_version(record, arxiv_id) or "-",
+                                                content_hash)
+        try:
+            entry = self._db[arxiv_id]
+        except KeyError:
+            return False
+        return entry.split(" ")[2] == content_hash
+
+    def save(self):
+        """
+        Writes the records seen since the index was opened and closes it.
+        """
+        for arxiv_id, entry in self._pending.iteritems():
+            self._db[arxiv_id] = entry
+        self.close()
+
+    def close(self):
+        """
+        Closes the index without writing the records seen since it was
+        opened.
+        """
+        self._pending = {}
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def get_field_values_by_tag(record, tag):
+    """
+    Returns the values of a full tag (ex. 035__a) in the given record.
+    """
+    return record_get_field_values(record, tag[:3], ind1=tag[3], ind2=tag[4],
+                                   code=tag[5:6])
+
+
+def chunks(values, chunk_size=1000):
+    """
+    Splits given values in lists of at most chunk_size values, consuming
+    the values only as the lists are needed.
+    """
+    values = iter(values)
+    while True:
+        chunk = list(itertools.islice(values, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def get_recids_from_values(values, tags):
+    """
+    Returns a dictionary of value -> set of record IDs having the value in
+    one of the given tags (ex. 037__a), with one query per bibxxx table and
+    chunk of values, instead of one search per value.
+    """
+    tables = {}
+    for tag in tags:
+        tables.setdefault(tag[:2], []).append(tag)
+    found = {}
+    values = set([value for value in values if value])
+    for prefix, table_tags in tables.iteritems():
+        for chunk in chunks(values):
+            query = "SELECT b.value, bb.id_bibrec FROM bib%(prefix)sx AS b " \
+                "JOIN bibrec_bib%(prefix)sx AS bb ON bb.id_bibxxx = b.id " \
+                "WHERE (%(tags)s) AND b.value IN (%(values)s)" % \
+                {'prefix': prefix,
+                 'tags': " OR ".join([('%' in tag and "b.tag LIKE %s" or "b.tag = %s")
+                                      for tag in table_tags]),
+                 'values': ", ".join(["%s"] * len(chunk))}
+            for value, recid in run_sql(query, table_tags + chunk):
+                found.setdefault(value, set()).add(recid)
+    return found
+
+
+def get_recids_from_field_values(values, tag, provenance_tag):
+    """
+    Returns a dictionary of value -> set of (provenance, record ID) of the
+    records having the value in the given tag (ex. 035__a), where
+    provenance is the value of provenance_tag (ex. 035__9) in the same
+    field, or None. Both tags must be in the same field.
+    """
+    prefix = tag[:2]
+    found = {}
+    for chunk in chunks(set([value for value in values if value])):
+        query = "SELECT a.value, s.value, ra.id_bibrec FROM bib%(prefix)sx AS a " \
+            "JOIN bibrec_bib%(prefix)sx AS ra ON ra.id_bibxxx = a.id " \
+            "LEFT JOIN (bibrec_bib%(prefix)sx AS rs " \
+            "JOIN bib%(prefix)sx AS s ON s.id = rs.id_bibxxx AND s.tag = %%s) " \
+            "ON rs.id_bibrec = ra.id_bibrec AND rs.field_number = ra.field_number " \
+            "WHERE a.tag = %%s AND a.value IN (%(values)s)" % \
+            {'prefix': prefix, 'values': ", ".join(["%s"] * len(chunk))}
+        for value, provenance, recid in run_sql(query, [provenance_tag, tag] + chunk):
+            found.setdefault(value, set()).add((provenance, recid))
+    return found
+
+
+def get_field_value_pairs(record, tag, provenance_tag):
+    """
+    Returns the list of (value, provenance) of the given tag (ex. 035__a)
+    in the record, where provenance is the first value of provenance_tag
+    (ex. 035__9) in the same field, or None.
+    """
+    pairs = []
+    for field in record_get_field_instances(record, tag[:3], ind1=tag[3],
+                                            ind2=tag[4]):
+        values = field_get_subfield_values(field, tag[5])
+        provenances = field_get_subfield_values(field, provenance_tag[5])
+        if values:
+            pairs.append((values[0], provenances and provenances[0] or None))
+    return pairs
+
+
+def get_existing_recids(recids):
+    """
+    Returns the set of given record IDs which exist and are not deleted.
+    """
+    existing = set()
+    for chunk in chunks(set(recids)):
+        query = "SELECT id FROM bibrec WHERE id IN (%s)" % \
+            (", ".join(["%s"] * len(chunk)),)
+        existing.update([row[0] for row in run_sql(query, chunk)])
+    for chunk in chunks(existing):
+        query = "SELECT bb.id_bibrec FROM bib98x AS b " \
+            "JOIN bibrec_bib98x AS bb ON bb.id_bibxxx = b.id " \
+            "WHERE b.tag = '980__c' AND b.value = 'DELETED' " \
+            "AND bb.id_bibrec IN (%s)" % (", ".join(["%s"] * len(chunk)),)
+        existing.difference_update([row[0] for row in run_sql(query, chunk)])
+    return existing
+
+
+def match_existing_records(records, skip_recid_check=False):
+    """
+    Finds the existing records matching every given record, resolving the
+    identifiers of all the records at once.
+
+    A record is matched like bibupload's retrieve_rec_id does: by its
+    record ID (001), else by its system number
+    (CFG_BIBUPLOAD_EXTERNAL_SYSNO_TAG), else by its external OAI
+    identifier together with its provenance in the same field
+    (CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG and its provenance tag), else by its
+    local OAI identifier (CFG_OAI_ID_FIELD), else by its DOI (0247_a with
+    0247_2:DOI). If none matches, it is matched by its arXiv ID as report
+    number. When skip_recid_check is True, only the arXiv ID is used.
+
+    @return: list of sorted lists of the matching record IDs, one for each
+             given record. More than one record ID means the match is
+             ambiguous.
+    """
+    identifiers = []
+    for record in records:
+        record_identifiers = {'recids': [], 'sysnos': [], 'oai_ids': [],
+                              'local_oai_ids': [], 'dois': [],
+                              'arxiv_id': get_minimal_arxiv_id(record)}
+        if not skip_recid_check:
+            record_identifiers['recids'] = [int(value.strip()) for value in record_get_field_values(record, '001')
+                                            if value.strip().isdigit()]
+            record_identifiers['sysnos'] = get_field_values_by_tag(record, CFG_BIBUPLOAD_EXTERNAL_SYSNO_TAG)
+            record_identifiers['oai_ids'] = get_field_value_pairs(record, CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG,
+                                                                  CFG_BIBUPLOAD_EXTERNAL_OAIID_PROVENANCE_TAG)
+            record_identifiers['local_oai_ids'] = get_field_values_by_tag(record, CFG_OAI_ID_FIELD)
+            record_identifiers['dois'] = [doi for doi, source in get_field_value_pairs(record, '0247_a', '0247_2')
+                                          if source and source.lower() == 'doi']
+        identifiers.append(record_identifiers)
+
+    def get_all(key):
+        """ Returns the given identifiers of all the records """
+        return [value for record_identifiers in identifiers
+                for value in record_identifiers[key]]
+
+    sysno_matches = get_recids_from_values(get_all('sysnos'),
+                                           [CFG_BIBUPLOAD_EXTERNAL_SYSNO_TAG])
+    oai_matches = get_recids_from_field_values(
+        [oai_id for oai_id, dummy in get_all('oai_ids')],
+        CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG, CFG_BIBUPLOAD_EXTERNAL_OAIID_PROVENANCE_TAG)
+    local_oai_matches = get_recids_from_values(get_all('local_oai_ids'),
+                                               [CFG_OAI_ID_FIELD])
+    doi_matches = get_recids_from_field_values(get_all('dois'), '0247_a', '0247_2')
+    # New style arXiv IDs are stored with the arXiv: prefix
+    report_numbers = []
+    for record_identifiers in identifiers:
+        arxiv_id = record_identifiers['arxiv_id']
+        if arxiv_id:
+            report_numbers.extend([arxiv_id, "arXiv:%s" % (arxiv_id,)])
+    report_number_matches = get_recids_from_values(report_numbers,
+                                                   get_field_tags("reportnumber"))
+
+    all_recids = set(get_all('recids'))
+    for matches in (sysno_matches, local_oai_matches, report_number_matches):
+        for recids in matches.itervalues():
+            all_recids.update(recids)
+    for matches in (oai_matches, doi_matches):
+        for pairs in matches.itervalues():
+            all_recids.update([recid for dummy, recid in pairs])
+    existing = get_existing_recids(all_recids)
+
+    results = []
+    for record_identifiers in identifiers:
+        matches = set(record_identifiers['recids']) & existing
+        if not matches:
+            for sysno in record_identifiers['sysnos']:
+                matches.update(sysno_matches.get(sysno, set()) & existing)
+        if not matches:
+            for oai_id, source in record_identifiers['oai_ids']:
+                matches.update([recid for provenance, recid in oai_matches.get(oai_id, ())
+                                if provenance == source and recid in existing])
+        if not matches:
+            for oai_id in record_identifiers['local_oai_ids']:
+                matches.update(local_oai_matches.get(oai_id, set()) & existing)
+        if not matches:
+            for doi in record_identifiers['dois']:
+                matches.update([recid for provenance, recid in doi_matches.get(doi, ())
+                                if provenance and provenance.lower() == 'doi'
+                                and recid in existing])
+        arxiv_id = record_identifiers['arxiv_id']
+        if not matches and arxiv_id:
+            for report_number in (arxiv_id, "arXiv:%s" % (arxiv_id,)):
+                matches.update(report_number_matches.get(report_number, set()) &
+                               existing)
+        results.append(sorted(matches))
+    return results
+
+
+def get_records(recids):
+    """
+    Returns a dictionary of record ID -> record structure of the given
+    existing records, reading their serialized structures in chunks
+    instead of fetching the records one by one. As get_record does, the
+    serialized structures are only trusted if bibupload keeps them up to
+    date (CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE). Records without a
+    usable serialized structure are fetched with get_record.
+    """
+    recids = set(recids)
+    records = {}
+    if CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE:
+        for chunk in chunks(recids):
+            query = "SELECT id_bibrec, value FROM bibfmt WHERE format = 'recstruct' " \
+                "AND id_bibrec IN (%s)" % (", ".join(["%s"] * len(chunk)),)
+            for recid, value in run_sql(query, chunk):
+                try:
+                    records[recid] = deserialize_via_marshal(value)
+                except (zlib.error, ValueError, EOFError, TypeError):
+                    # Corrupted structure, get_record rebuilds it
+                    pass
+    for recid in recids:
+        if recid not in records:
+            records[recid] = get_record(recid)
+    return records
+
+
+def get_field_key(field):
+    """
+    Returns a hashable key of the given field, leaving out its position.
+    """
+    subfields, ind1, ind2, value = field[:4]
+    return (tuple(subfields), ind1, ind2, value)
+
+
+class RecordFieldIndex(object):
+    """
+    Per-tag index of the fields of a record, whatever their indicators.
+    The lookups done for every tag while comparing two records are
+    computed once per tag and record.
+    """
+    def __init__(self, record):
+        self.record = record
+        self._origins = {}
+        self._keys = {}
+        self._matchers = {}
+
+    def get_fields(self, tag):
+        """
+        Returns the fields with given tag. The list must not be modified.
+        """
+        return self.record.get(tag, [])
+
+    def has_origin(self, tag, origin="arXiv", code="9"):
+        """
+        Checks if any of the fields with given tag has origin in the given
+        subfield code. See has_field_origin.
+        """
+        key = (tag, origin, code)
+        if key not in self._origins:
+            self._origins[key] = has_field_origin(self.get_fields(tag), origin, code)
+        return self._origins[key]
+
+    def get_field_matcher(self, tag):
+        """
+        Returns a FieldMatcher of the fields with given tag.
+        """
+        if tag not in self._matchers:
+            self._matchers[tag] = FieldMatcher(self.get_fields(tag))
+        return self._matchers[tag]
+
+    def has_identical_field(self, tag, field):
+        """
+        Checks if there is a field with given tag identical to the given
+        field, positions aside.
+        """
+        if tag not in self._keys:
+            self._keys[tag] = set([get_field_key(existing_field)
+                                   for existing_field in self.get_fields(tag)])
+        return get_field_key(field) in self._keys[tag]
+
+
 def record_get_value_with_provenence(record, tag, ind1=" ", ind2=" ", value_code="", provenence_code="9", provenence_value="arXiv"):
     """
     Retrieves the value of the field with given provenence.
@@ -218,6 +674,336 @@ def record_get_value_with_provenence(record, tag, ind1=" ", ind2=" ", value_code
     return final_values
 
 
+def parse_pubnote(pubnote):
+    """
+    Parses the given free-text publication note with refextract.
+
+    @return: tuple of (title, volume, year, page), with False for missing
+             values, or None if no journal reference was found
+    """
+    extract = extract_journal_reference(pubnote)
+    if not extract:
+        return None
+    return (extract.get('title', False), extract.get('volume', False),
+            extract.get('year', False), extract.get('page', False))
+
+
+def get_refextract_kbs_version():
+    """
+    Returns a version string of the refextract knowledge bases, which
+    changes whenever one of the knowledge base files is modified.
+    """
+    version = hashlib.md5(CFG_VERSION)
+    for name, path in sorted(CFG_REFEXTRACT_KBS.items()):
+        version.update("%s=%s" % (name, path))
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            version.update(":%d:%d" % (stat.st_mtime, stat.st_size))
+    return version.hexdigest()
+
+
+class PubnoteCache(object):
+    """
+    Persistent cache of the publication notes parsed by parse_pubnote,
+    invalidated when the refextract knowledge bases change. At most size
+    entries are kept, dropping the least recently used ones.
+    """
+    def __init__(self, filename, version, size=PUBNOTE_CACHE_SIZE):
+        self.filename = filename
+        self.version = version
+        self.size = size
+        # pubnote -> [last use, parsed pubnote]
+        self.entries = {}
+        self.uses = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """
+        Loads the cache file, if any and made with the same version.
+        """
+        try:
+            cache_file = open(self.filename, "rb")
+            try:
+                data = cPickle.load(cache_file)
+            finally:
+                cache_file.close()
+        except (IOError, EOFError, cPickle.UnpicklingError, ValueError,
+                TypeError, AttributeError, ImportError, KeyError, IndexError):
+            # No usable cache, start afresh
+            return
+        if isinstance(data, dict) and data.get("version") == self.version and \
+                isinstance(data.get("entries"), dict) and "uses" in data:
+            self.entries = data["entries"]
+            self.uses = data["uses"]
+
+    def save(self):
+        """
+        Writes the cache file, keeping the most recently used entries.
+        """
+        if len(self.entries) > self.size:
+            recent = sorted(self.entries.iteritems(),
+                            key=lambda item: item[1][0])[-self.size:]
+            self.entries = dict(recent)
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        cache_file = open(self.filename + ".tmp", "wb")
+        try:
+            cPickle.dump({"version": self.version, "uses": self.uses,
+                          "entries": self.entries}, cache_file, -1)
+        finally:
+            cache_file.close()
+        os.rename(self.filename + ".tmp", self.filename)
+
+    def get(self, pubnotes):
+        """
+        Returns a dictionary of pubnote -> parsed pubnote of the given
+        pubnotes which are in the cache, counting hits and misses.
+        """
+        found = {}
+        for pubnote in pubnotes:
+            entry = self.entries.get(pubnote)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.uses += 1
+                entry[0] = self.uses
+                found[pubnote] = entry[1]
+        return found
+
+    def add(self, parsed_pubnotes):
+        """
+        Adds the given dictionary of pubnote -> parsed pubnote.
+        """
+        for pubnote, parsed in parsed_pubnotes.iteritems():
+            self.uses += 1
+            self.entries[pubnote] = [self.uses, parsed]
+
+    def get_hit_rate(self):
+        """
+        Returns the percentage of the lookups found in the cache.
+        """
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return 100.0 * self.hits / lookups
+
+
+def set_action_dict(action_dict):
+    """
+    Sets the actions configuration used by filter_record. Used as
+    initializer of the worker processes.
+    """
+    global ACTION_DICT
+    ACTION_DICT = action_dict
+
+
+def filter_record(task):
+    """
+    Determines the action to be taken for a harvested record: insertion,
+    holding pen or appending and correcting fields of the matched existing
+    record. Does not access the database, so that records can be filtered
+    in worker processes.
+
+    @param task: tuple of (record, list of matching record IDs, existing
+                 record or None, dictionary of already parsed pubnotes)
+    @return: tuple of the lists of records to insert, append, correct and
+             send to the holding pen, the list of messages to report and
+             the dictionary of the pubnotes parsed meanwhile
+    """
+    record, matches, existing_record, pubnotes = task
+    insert_records = []
+    append_records = []
+    correct_records = []
+    holdingpen_records = []
+    messages = []
+    parsed_pubnotes = {}
+
+    # Perform various checks to determine an suitable action to be taken for
+    # that particular record. Whether it will be inserted, discarded or replacing
+    # existing records
+    recid = None
+    if len(matches) == 1:
+        recid = matches[0]
+
+    # 773 RefExtract PubNote extraction
+    for field in record_get_field_instances(record, '773'):
+        for value in field_get_subfield_values(field, 'x'):
+            if value in pubnotes:
+                parsed = pubnotes[value]
+            else:
+                parsed = parse_pubnote(value)
+                parsed_pubnotes[value] = parsed
+            if parsed:
+                title, volume, year, page = parsed
+                subfields = [('x', value)]
+                if volume:
+                    subfields.append(('v', str(volume)))
+                if title:
+                    subfields.append(('p', str(title)))
+                if year:
+                    subfields.append(('y', str(year)))
+                if page:
+                    subfields.append(('c', str(page)))
+                new_field = create_field(subfields, global_position=field[4])
+                record_replace_field(record, '773', new_field, field[4])
+                break
+
+    if len(matches) > 1:
+        # Ambiguous match, needs manual oversight
+        messages.append("Ambiguous match for %s: records %s. Sent to holding pen.\n" %
+                        (get_minimal_arxiv_id(record) or "record",
+                         ", ".join([str(match) for match in matches])))
+        if "FFT" in record:
+            del record["FFT"]
+        holdingpen_records.append(record)
+    elif not recid:
+        # Record (probably) does not exist, flag for inserting into database
+        # FIXME: Add some automatic deny/accept parameters, perhaps also bibmatch call
+        insert_records.append(record)
+    else:
+        # Record exists, fetch existing record
+        if existing_record is None:
+            # Did not find existing record in database
+            holdingpen_records.append(record)
+            return (insert_records, append_records, correct_records,
+                    holdingpen_records, messages, parsed_pubnotes)
+
+        # We remove 500 field temporary/brief entry from revision if record already exists
+        new_index = RecordFieldIndex(record)
+        fields_500 = new_index.get_fields('500')
+        if fields_500 is not None:
+            field_positions = []
+            for field in fields_500:
+                subfields = field_get_subfield_instances(field)
+                for subfield in subfields:
+                    if re.match("^.?((temporary|brief) entry).?$", subfield[1].lower(), re.IGNORECASE):
+                        field_positions.append((field[1], field[2], field[4]))
+
+            for ind1, ind2, pos in field_positions:
+                record_delete_field(record, '500', ind1=ind1, ind2=ind2, field_position_global=pos)
+
+        # Now compare new version with existing one, returning a diff[tag] = (diffcode, [..])
+        # None - if field is the same for both records
+        # ('r',) - field missing from input record, ignored ATM
+        # ('a',) - new field added, should be updated with append
+        # ('c', difference_comparison) -> if field field_id exists in both records, but it's value has changed
+        #                              -> uploaded with correct if accepted
+        fields_to_add = []
+        fields_to_correct = []
+        holdingpen = False
+
+        existing_index = RecordFieldIndex(existing_record)
+
+        difference = record_diff_codes(existing_record, record)
+        for tag, diff in difference.iteritems():
+            if diff is None:
+                # No difference in tag
+                continue
+            diff_code = diff[0]
+            new_field_list = new_index.get_fields(tag)
+            existing_field_list = existing_index.get_fields(tag)
+            if tag == "245" and diff_code == "c":
+                # Special handling of field 245. We add title to 245 iff origin and original is arXiv
+                field = new_field_list[0]
+                if new_index.has_origin(tag) and existing_index.has_origin(tag):
+                    fields_to_correct.append((tag, [field]))
+                else:
+                    holdingpen = True
+                # Check for duplicates and add title update as 246
+                if not existing_index.get_field_matcher("246").has_field(field):
+                    fields_to_add.append(("246", [field]))
+            else:
+                corrected_fields = []
+                if new_index.has_origin(tag) and existing_index.has_origin(tag):
+                    for field in existing_field_list:
+                        if not "arXiv" in field_get_subfield_values(field, "9"):
+                            corrected_fields.append(field)
+                    corrected_matcher = FieldMatcher(corrected_fields)
+                    for field in new_field_list:
+                        if not corrected_matcher.has_field(field):
+                            corrected_fields.append(field)
+                            corrected_matcher.add(field)
+
+                action = get_action(tag, diff_code, ACTION_DICT)
+                if action == 'holdingpen' and not holdingpen:
+                    holdingpen = True
+
+                if action == 'correct' or len(corrected_fields) > 0:
+                    if len(corrected_fields) == 0:
+                        corrected_fields = new_field_list
+                    fields_to_correct.append((tag, corrected_fields))
+
+                if action == 'append':
+                    # Before appending we are checking if there are any duplicate fields already
+                    # FIXME: Not needed when BibUpload treats duplicate fields nicely
+                    # We need to remove position from the picture before comparison
+                    added_fields = [field[:-1] for field in new_field_list
+                                    if not existing_index.has_identical_field(tag, field)]
+
+                    fields_to_add.append((tag, added_fields))
+
+        # Lets add any extracted 'append' or 'correct' fields
+        if len(fields_to_add) > 0:
+            #Check if DOI is included in fields_to_add
+            fields_without_DOI = []
+            record_with_DOI = {}
+            for tag, value in fields_to_add:
+                if tag == '024':
+                    DOI_field = [(tag, value)]
+                    #Create record just with DOI field
+                    record_with_DOI = create_record_from_list(recid, DOI_field)
+                else:
+                    fields_without_DOI.append((tag, value))
+            # Append extra DOI record
+            append_records.append(create_record_from_list(recid, fields_without_DOI))
+            if record_with_DOI:
+                append_records.append(record_with_DOI)
+
+        if len(fields_to_correct) > 0:
+            correct_records.append(create_record_from_list(recid, fields_to_correct))
+        if holdingpen:
+            if "FFT" in record:
+                del record["FFT"]
+            holdingpen_records.append(record)
+
+    return (insert_records, append_records, correct_records,
+            holdingpen_records, messages, parsed_pubnotes)
+
+
+def filter_records(records, skip_recid_check=False, pool=None,
+                   pubnote_cache=None):
+    """
+    Matches the given records against the existing ones and classifies
+    them with filter_record, in the given process pool if any. The
+    pubnotes found in the cache are given to filter_record.
+
+    @return: iterator over the results of filter_record, in the order of
+             the records
+    """
+    # Firstly, are the records already in the database?
+    matched_recids = match_existing_records(records, skip_recid_check)
+    # Existing records are only fetched for unambiguous matches
+    existing_records = get_records([matches[0] for matches in matched_recids
+                                    if len(matches) == 1])
+
+    tasks = []
+    for record, matches in zip(records, matched_recids):
+        existing_record = None
+        if len(matches) == 1:
+            existing_record = existing_records.get(matches[0])
+        pubnotes = {}
+        if pubnote_cache is not None:
+            pubnotes = pubnote_cache.get(record_get_field_values(record, '773', code='x'))
+        tasks.append((record, matches, existing_record, pubnotes))
+
+    if pool is not None:
+        return pool.imap(filter_record, tasks, 10)
+    return itertools.imap(filter_record, tasks)
+
+
 def main():
     usage = """
     name:           bibfilter_oaiarXiv2inspire
@@ -225,7 +1011,7 @@ def main():
                     harvested from external OAI sources, in order to determine
                     which action needs to be taken (insert, holdingpen, etc)
     usage:
-                    bibfilter_oaiarXiv2inspire [-nhc:] MARCXML-FILE
+                    bibfilter_oaiarXiv2inspire [-nhfc:j:] MARCXML-FILE
     options:
                     source_id is the optional parameter indicating the
                     Invenio harvesting source identifier. This value is
@@ -236,9 +1022,15 @@ def main():
                 -n
                     forces the script not to check if the record exists in the database
                     (useful when re-harvesting existing record)
+                -j N
+                    number of processes comparing and classifying the records.
+                    Defaults to 1
+                -f
+                    forces the script to filter records which have not changed
+                    since they were last filtered, instead of skipping them
     """
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "c:nh", [])
+        opts, args = getopt.getopt(sys.argv[1:], "c:nhj:f", [])
     except getopt.GetoptError, err_obj:
         sys.stderr.write("Error:" + err_obj + "\n")
         print usage
@@ -246,12 +1038,22 @@ def main():
 
     config_path = CFG_ETCDIR + "/bibharvest/" + "oaiarXiv_bibfilter_actions.cfg"
     skip_recid_check = False
+    processes = 1
+    force = False
 
     for opt, opt_value in opts:
         if opt in ['-c']:
             config_path = opt_value
         if opt in ['-n']:
             skip_recid_check = True
+        if opt in ['-j']:
+            try:
+                processes = int(opt_value)
+            except ValueError:
+                sys.stderr.write("Error: -j expects a number of processes\n")
+                sys.exit(1)
+        if opt in ['-f']:
+            force = True
         if opt in ['-h']:
             print usage
             sys.exit(0)
@@ -270,182 +1072,77 @@ def main():
         sys.stderr.write("Please enter a valid filename for config.")
         sys.exit(1)
 
-    # Read and wash incoming data
-    file_data = open_marc_file(input_filename)
-    washed_data = wash_for_xml(wash_for_utf8(file_data))
-
-    # Transform MARCXML to record structure
-    records = create_records(washed_data)
     action_dict = read_actions_configuration_file(config_path)
-    insert_records = []
-    append_records = []
-    correct_records = []
-    holdingpen_records = []
+    insert_writer = MARCXMLWriter("%s.insert.xml" % (input_filename,))
+    append_writer = MARCXMLWriter("%s.append.xml" % (input_filename,))
+    correct_writer = MARCXMLWriter("%s.correct.xml" % (input_filename,))
+    holdingpen_writer = MARCXMLWriter("%s.holdingpen.xml" % (input_filename,))
+    writers = (insert_writer, append_writer, correct_writer, holdingpen_writer)
 
-    for rec in records:
-        record = rec[0]
-        if record is None:
-            sys.stderr.write("Record is None: %s" % (rec[2],))
-            sys.exit(1)
-        # Perform various checks to determine an suitable action to be taken for
-        # that particular record. Whether it will be inserted, discarded or replacing
-        # existing records
-        #
-        # Firstly, is the record already in the database?
-        if skip_recid_check:
-            recid = None
-        else:
-            recid = retrieve_rec_id(record, "")
-
-        if not recid or recid == -1:
-            # Try again with p_r_s
-            arxiv_id = get_minimal_arxiv_id(record)
-            if arxiv_id:
-                results = perform_request_search(p="reportnumber:%s" % (arxiv_id,), of='id')
-                if len(results) > 0:
-                    # FIXME: Ambiguous results may happen. Now just taking first result..
-                    recid = results[0]
-
-        # 773 RefExtract PubNote extraction
-        for field in record_get_field_instances(record, '773'):
-            for value in field_get_subfield_values(field, 'x'):
-                extract = extract_journal_reference(value)
-                if extract:
-                    subfields = [('x', value)]
-                    if extract.get('volume', False):
-                        subfields.append(('v', str(extract['volume'])))
-                    if extract.get('title', False):
-                        subfields.append(('p', str(extract['title'])))
-                    if extract.get('year', False):
-                        subfields.append(('y', str(extract['year'])))
-                    if extract.get('page', False):
-                        subfields.append(('c', str(extract['page'])))
-                    new_field = create_field(subfields, global_position=field[4])
-                    record_replace_field(record, '773', new_field, field[4])
-                    break
-
-        if not recid or recid == -1:
-            # Record (probably) does not exist, flag for inserting into database
-            # FIXME: Add some automatic deny/accept parameters, perhaps also bibmatch call
-            insert_records.append(record)
-        else:
-            # Record exists, fetch existing record
-            existing_record = get_record(recid)
-            if existing_record is None:
-                # Did not find existing record in database
-                holdingpen_records.append(record)
-                continue
+    pubnote_cache = PubnoteCache(PUBNOTE_CACHE_FILE, get_refextract_kbs_version())
+    pubnote_cache.load()
+    record_index = HarvestedRecordIndex(HARVESTED_RECORDS_INDEX_FILE)
+    record_index.open()
+    unchanged_count = 0
 
-            # We remove 500 field temporary/brief entry from revision if record already exists
-            fields_500 = record_get_field_instances(record, '500', ind1="%", ind2="%")
-            if fields_500 is not None:
-                field_positions = []
-                for field in fields_500:
-                    subfields = field_get_subfield_instances(field)
-                    for subfield in subfields:
-                        if re.match("^.?((temporary|brief) entry).?$", subfield[1].lower(), re.IGNORECASE):
-                            field_positions.append((field[1], field[2], field[4]))
-
-                for ind1, ind2, pos in field_positions:
-                    record_delete_field(record, '500', ind1=ind1, ind2=ind2, field_position_global=pos)
-
-            # Now compare new version with existing one, returning a diff[tag] = (diffcode, [..])
-            # None - if field is the same for both records
-            # ('r',) - field missing from input record, ignored ATM
-            # ('a',) - new field added, should be updated with append
-            # ('c', difference_comparison) -> if field field_id exists in both records, but it's value has changed
-            #                              -> uploaded with correct if accepted
-            fields_to_add = []
-            fields_to_correct = []
-            holdingpen = False
-
-            difference = record_diff(existing_record, record, compare_subfields=match_subfields)
-            for tag, diff in difference.iteritems():
-                if diff is None:
-                    # No difference in tag
-                    continue
-                diff_code = diff[0]
-                new_field_list = record_get_field_instances(record, tag, ind1="%", ind2="%")
-                existing_field_list = record_get_field_instances(existing_record, tag, ind1="%", ind2="%")
-                if tag == "245" and diff_code == "c":
-                    # Special handling of field 245. We add title to 245 iff origin and original is arXiv
-                    field = record_get_field_instances(record, tag, ind1="%", ind2="%")[0]
-                    if has_field_origin(new_field_list, "arXiv", "9") and has_field_origin(existing_field_list, "arXiv", "9"):
-                        fields_to_correct.append((tag, [field]))
-                    else:
-                        holdingpen = True
-                    # Check for duplicates and add title update as 246
-                    field_list_246 = record_get_field_instances(existing_record, "246", ind1="%", ind2="%")
-                    if not has_field(field, field_list_246):
-                        fields_to_add.append(("246", [field]))
-                else:
-                    corrected_fields = []
-                    if has_field_origin(new_field_list, "arXiv", "9") \
-                       and has_field_origin(existing_field_list, "arXiv", "9"):
-                        for field in existing_field_list:
-                            if not "arXiv" in field_get_subfield_values(field, "9"):
-                                corrected_fields.append(field)
-                        for field in new_field_list:
-                            if not has_field(field, corrected_fields):
-                                corrected_fields.append(field)
-
-                    action = get_action(tag, diff_code, action_dict)
-                    if action == 'holdingpen' and not holdingpen:
-                        holdingpen = True
-
-                    if action == 'correct' or len(corrected_fields) > 0:
-                        if len(corrected_fields) == 0:
-                            corrected_fields = new_field_list
-                        fields_to_correct.append((tag, corrected_fields))
-
-                    if action == 'append':
-                        # Before appending we are checking if there are any duplicate fields already
-                        # FIXME: Not needed when BibUpload treats duplicate fields nicely
-                        original_fields = record_get_field_instances(existing_record, tag, ind1="%", ind2="%")
-                        new_fields = record_get_field_instances(record, tag, ind1="%", ind2="%")
-
-                        # We need to remove position from the picture before comparison
-                        original_fields = [field[:-1] for field in original_fields]
-                        added_fields = [field[:-1] for field in new_fields if field[:-1] not in original_fields]
-
-                        fields_to_add.append((tag, added_fields))
-
-            # Lets add any extracted 'append' or 'correct' fields
-            if len(fields_to_add) > 0:
-                #Check if DOI is included in fields_to_add
-                fields_without_DOI = []
-                record_with_DOI = {}
-                for tag, value in fields_to_add:
-                    if tag == '024':
-                        DOI_field = [(tag, value)]
-                        #Create record just with DOI field
-                        record_with_DOI = create_record_from_list(recid, DOI_field)
-                    else:
-                        fields_without_DOI.append((tag, value))
-                # Append extra DOI record
-                append_records.append(create_record_from_list(recid, fields_without_DOI))
-                if record_with_DOI:
-                    append_records.append(record_with_DOI)
-
-            if len(fields_to_correct) > 0:
-                correct_records.append(create_record_from_list(recid, fields_to_correct))
-            if holdingpen:
-                if "FFT" in record:
-                    del record["FFT"]
-                holdingpen_records.append(record)
-
-    # Output results. Create new files, if necessary.
-    write_record_to_file("%s.insert.xml" % (input_filename,), insert_records)
-    sys.stdout.write("Number of records to insert:  %d\n" % (len(insert_records),))
-
-    write_record_to_file("%s.append.xml" % (input_filename,), append_records)
-    sys.stdout.write("Number of records to append fields: %d:\n" % (len(append_records),))
-
-    write_record_to_file("%s.correct.xml" % (input_filename,), correct_records)
-    sys.stdout.write("Number of records to correct fields: %d:\n" % (len(correct_records),))
-
-    write_record_to_file("%s.holdingpen.xml" % (input_filename,), holdingpen_records)
-    sys.stdout.write("Number of records to the holding pen: %d\n" % (len(holdingpen_records),))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, set_action_dict, (action_dict,))
+    else:
+        pool = None
+        set_action_dict(action_dict)
+
+    # Read, wash and transform incoming data to record structures
+    # incrementally, handling the records block by block
+    for block in chunks(get_records_from_file(input_filename), RECORDS_BLOCK_SIZE):
+        records = []
+        for rec in block:
+            if rec[0] is None:
+                sys.stderr.write("Record is None: %s" % (rec[2],))
+                for writer in writers:
+                    writer.discard()
+                record_index.close()
+                if pool is not None:
+                    pool.terminate()
+                sys.exit(1)
+            # Re-delivered records which did not change need no action
+            if record_index.is_unchanged(rec[0]) and not force:
+                unchanged_count += 1
+            else:
+                records.append(rec[0])
+
+        for results in filter_records(records, skip_recid_check,
+                                      pool, pubnote_cache):
+            for writer, writer_records in zip(writers, results[:4]):
+                for record in writer_records:
+                    writer.write(record)
+            for message in results[4]:
+                sys.stderr.write(message)
+            pubnote_cache.add(results[5])
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # Output results. Files are only created if necessary.
+    insert_writer.close()
+    sys.stdout.write("Number of records to insert:  %d\n" % (insert_writer.count,))
+
+    append_writer.close()
+    sys.stdout.write("Number of records to append fields: %d:\n" % (append_writer.count,))
+
+    correct_writer.close()
+    sys.stdout.write("Number of records to correct fields: %d:\n" % (correct_writer.count,))
+
+    holdingpen_writer.close()
+    sys.stdout.write("Number of records to the holding pen: %d\n" % (holdingpen_writer.count,))
+
+    sys.stdout.write("Number of unchanged records skipped: %d\n" % (unchanged_count,))
+
+    record_index.save()
+    pubnote_cache.save()
+    sys.stdout.write("Pubnote cache hits: %d of %d (%.1f%%)\n" %
+                     (pubnote_cache.hits, pubnote_cache.hits + pubnote_cache.misses,
+                      pubnote_cache.get_hit_rate()))
 
     sys.exit(0)
 if __name__ == '__main__':
@@ -0,0 +1,534 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for bibfilter_oaiarXiv2inspire."""
+
+import os
+import copy
+import shutil
+import cPickle
+import anydbm
+import sqlite3
+import unittest
+from tempfile import mkstemp, mkdtemp
+
+from invenio.testutils import make_test_suite, run_test_suite
+from invenio.bibrecord import record_add_field, create_records, record_xml_output
+from invenio.bibmerge_differ import record_diff, match_subfields
+from invenio.dbquery import serialize_via_marshal
+
+import bibfilter_oaiarXiv2inspire
+from bibfilter_oaiarXiv2inspire import (has_field,
+                                        record_diff_codes,
+                                        match_existing_records,
+                                        filter_record,
+                                        get_records,
+                                        get_records_from_file,
+                                        PubnoteCache,
+                                        HarvestedRecordIndex,
+                                        get_record_hash,
+                                        CFG_OAI_ID_FIELD,
+                                        CFG_BIBUPLOAD_EXTERNAL_SYSNO_TAG,
+                                        CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG,
+                                        CFG_BIBUPLOAD_EXTERNAL_OAIID_PROVENANCE_TAG)
+
+
+def linear_has_field(field, field_list):
+    """ has_field as it was before FieldMatcher, comparing the field with
+    every field of the list """
+    if len(field_list) > 0:
+        for subfields, ind1, ind2, value, dummy in field_list:
+            if (ind1, ind2, value) == field[1:4]:
+                for sub in subfields:
+                    if sub not in field[0]:
+                        break
+                else:
+                    return True
+    return False
+
+
+def make_record(authors, ind1=" "):
+    """ Returns an arXiv-like record with the given 700 authors """
+    record = {}
+    record_add_field(record, "001", controlfield_value="123")
+    record_add_field(record, "037", subfields=[("9", "arXiv"),
+                                               ("a", "arXiv:1301.0001"),
+                                               ("c", "hep-ph")])
+    record_add_field(record, "100", subfields=[("a", "Doe, J."),
+                                               ("u", "CERN")])
+    record_add_field(record, "245", subfields=[("9", "arXiv"),
+                                               ("a", "A title")])
+    for name, affiliation in authors:
+        subfields = [("a", name)]
+        if affiliation:
+            subfields.append(("u", affiliation))
+        record_add_field(record, "700", ind1=ind1, subfields=subfields)
+    return record
+
+
+AUTHORS = [("Smith, A.", "CERN"), ("Jones, B.", "DESY"),
+           ("Brown, C.", None), ("Smith, A.", "SLAC")]
+
+
+def get_variants():
+    """ Returns the records to compare with make_record(AUTHORS) """
+    reordered = make_record(list(reversed(AUTHORS)))
+    duplicated = make_record(AUTHORS + AUTHORS[:2])
+    changed = make_record(AUTHORS[:1] + [("Jones, B. B.", "DESY")] + AUTHORS[2:])
+    affiliation = make_record(AUTHORS[:2] + [("Brown, C.", "FNAL")] + AUTHORS[3:])
+    indicators = make_record(AUTHORS, ind1="1")
+    fewer = make_record(AUTHORS[:2])
+    no_authors = make_record([])
+    added = make_record(AUTHORS)
+    record_add_field(added, "520", subfields=[("9", "arXiv"),
+                                              ("a", "An abstract")])
+    return [make_record(AUTHORS), reordered, duplicated, changed,
+            affiliation, indicators, fewer, no_authors, added]
+
+
+class HasFieldTest(unittest.TestCase):
+    """
+    Testing the hashed has_field against the linear one.
+    """
+
+    def test_same_as_linear_has_field(self):
+        """bibfilter_oaiarXiv2inspire - has_field gives the result of the linear search"""
+        records = get_variants()
+        for record in records:
+            for other in records:
+                for tag in ("100", "245", "700"):
+                    field_list = other.get(tag, [])
+                    for field in record.get(tag, []):
+                        self.assertEqual(has_field(field, field_list),
+                                         linear_has_field(field, field_list))
+
+    def test_subfield_subsets(self):
+        """bibfilter_oaiarXiv2inspire - has_field with reordered, fewer and extra subfields"""
+        field_list = [([("a", "Smith, A."), ("u", "CERN")], " ", " ", "", 5),
+                      ([("a", "Jones, B.")], "1", " ", "", 6)]
+        fields = [([("u", "CERN"), ("a", "Smith, A.")], " ", " ", "", 1),
+                  ([("a", "Smith, A.")], " ", " ", "", 1),
+                  ([("a", "Smith, A."), ("u", "CERN"), ("v", "x")], " ", " ", "", 1),
+                  ([("a", "Jones, B."), ("u", "DESY")], "1", " ", "", 1),
+                  ([("a", "Jones, B.")], " ", " ", "", 1),
+                  ([], " ", " ", "", 1)]
+        for field in fields:
+            self.assertEqual(has_field(field, field_list),
+                             linear_has_field(field, field_list))
+        empty_list = field_list + [([], " ", " ", "", 7)]
+        for field in fields:
+            self.assertEqual(has_field(field, empty_list),
+                             linear_has_field(field, empty_list))
+        self.assertEqual(has_field(fields[0], []), False)
+
+
+class RecordDiffCodesTest(unittest.TestCase):
+    """
+    Testing record_diff_codes against bibrecord's record_diff.
+    """
+
+    def assertSameCodes(self, rec1, rec2):
+        expected = [(tag, diff and (diff[0],))
+                    for tag, diff in record_diff(rec1, rec2,
+                                                 compare_subfields=match_subfields).items()]
+        self.assertEqual(record_diff_codes(rec1, rec2).items(), expected)
+
+    def test_same_as_record_diff(self):
+        """bibfilter_oaiarXiv2inspire - record_diff_codes gives the codes of record_diff"""
+        records = get_variants()
+        for record in records:
+            for other in records:
+                self.assertSameCodes(record, other)
+
+    def test_records_not_modified(self):
+        """bibfilter_oaiarXiv2inspire - record_diff_codes does not modify the records"""
+        records = get_variants()
+        originals = copy.deepcopy(records)
+        for record in records:
+            for other in records:
+                record_diff_codes(record, other)
+        self.assertEqual(records, originals)
+
+
+class FakeDatabase(object):
+    """ In-memory SQLite database with the bibrec and bibXXx tables, whose
+    run_sql stands for the one of invenio.dbquery """
+    def __init__(self):
+        self.db = sqlite3.connect(":memory:")
+        self.db.execute("CREATE TABLE bibrec (id INTEGER PRIMARY KEY)")
+        self.db.execute("CREATE TABLE bibfmt (id_bibrec INT, format TEXT, "
+                        "value BLOB)")
+        for prefix in range(100):
+            self.db.execute("CREATE TABLE bib%02dx (id INTEGER PRIMARY KEY, "
+                            "tag TEXT, value TEXT)" % (prefix,))
+            self.db.execute("CREATE TABLE bibrec_bib%02dx (id_bibrec INT, "
+                            "id_bibxxx INT, field_number INT)" % (prefix,))
+
+    def add_record(self, recid, fields):
+        """ Adds a record with the given list of fields, every field being
+        a list of (tag, value), ex. [("035__9", "arXiv"), ("035__a", ...)] """
+        self.db.execute("INSERT INTO bibrec VALUES (?)", (recid,))
+        for field_number, field in enumerate(fields):
+            for tag, value in field:
+                table = "bib%sx" % (tag[:2],)
+                bibxxx = self.db.execute("INSERT INTO %s (tag, value) VALUES (?, ?)"
+                                         % (table,), (tag, value)).lastrowid
+                self.db.execute("INSERT INTO bibrec_%s VALUES (?, ?, ?)" % (table,),
+                                (recid, bibxxx, field_number + 1))
+
+    def add_recstruct(self, recid, value):
+        """ Adds the serialized structure of a record """
+        self.db.execute("INSERT INTO bibfmt VALUES (?, 'recstruct', ?)",
+                        (recid, sqlite3.Binary(value)))
+
+    def run_sql(self, sql, param=None):
+        return tuple(self.db.execute(sql.replace("%s", "?"),
+                                     tuple(param or ())).fetchall())
+
+
+def add_tag(record, tag, subfields):
+    """ Adds a field with the given full tag (ex. 035__a) to the record """
+    record_add_field(record, tag[:3], ind1=tag[3].replace("_", " "),
+                     ind2=tag[4].replace("_", " "), subfields=subfields)
+
+
+class MatchExistingRecordsTest(unittest.TestCase):
+    """
+    Testing the matching of harvested records with the existing ones, with
+    run_sql answered by an in-memory database.
+    """
+
+    def setUp(self):
+        self.database = FakeDatabase()
+        add = self.database.add_record
+        add(1, [[("037__a", "arXiv:1301.0001")]])
+        add(2, [[(CFG_BIBUPLOAD_EXTERNAL_SYSNO_TAG, "SYSNO-2")]])
+        add(3, [[(CFG_BIBUPLOAD_EXTERNAL_OAIID_PROVENANCE_TAG, "arXiv"),
+                 (CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG, "oai:arXiv.org:1301.0003")]])
+        add(4, [[(CFG_BIBUPLOAD_EXTERNAL_OAIID_PROVENANCE_TAG, "CDS"),
+                 (CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG, "oai:arXiv.org:1301.0004")]])
+        add(5, [[(CFG_OAI_ID_FIELD, "oai:inspirehep.net:5")]])
+        add(6, [[("0247_2", "DOI"), ("0247_a", "10.1000/6")]])
+        add(7, [[("037__a", "arXiv:1301.0007")]])
+        add(8, [[("037__a", "arXiv:1301.0007")]])
+        add(9, [[("037__a", "arXiv:1301.0009")], [("980__c", "DELETED")]])
+        self.originals = (bibfilter_oaiarXiv2inspire.run_sql,
+                          bibfilter_oaiarXiv2inspire.get_field_tags)
+        bibfilter_oaiarXiv2inspire.run_sql = self.database.run_sql
+        bibfilter_oaiarXiv2inspire.get_field_tags = \
+            lambda name: {"reportnumber": ["037__a", "088__a"]}[name]
+
+    def tearDown(self):
+        bibfilter_oaiarXiv2inspire.run_sql, \
+            bibfilter_oaiarXiv2inspire.get_field_tags = self.originals
+
+    def make_record(self, arxiv_id, recid=None, sysno=None, oai_id=None,
+                    local_oai_id=None, doi=None):
+        """ Returns a harvested record with the given identifiers """
+        record = {}
+        if recid:
+            record_add_field(record, "001", controlfield_value=str(recid))
+        if oai_id:
+            add_tag(record, CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG, oai_id)
+        else:
+            add_tag(record, "035__a", [("9", "arXiv"),
+                                       ("a", "oai:arXiv.org:%s" % (arxiv_id,))])
+        if sysno:
+            add_tag(record, CFG_BIBUPLOAD_EXTERNAL_SYSNO_TAG,
+                    [(CFG_BIBUPLOAD_EXTERNAL_SYSNO_TAG[5], sysno)])
+        if local_oai_id:
+            add_tag(record, CFG_OAI_ID_FIELD, [(CFG_OAI_ID_FIELD[5], local_oai_id)])
+        if doi:
+            add_tag(record, "0247_a", [("2", "DOI"), ("a", doi)])
+        return record
+
+    def external_oai_id(self, provenance, value):
+        """ Returns the subfields of an external OAI ID field """
+        return [(CFG_BIBUPLOAD_EXTERNAL_OAIID_PROVENANCE_TAG[5], provenance),
+                (CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG[5], value)]
+
+    def test_matching_order(self):
+        """bibfilter_oaiarXiv2inspire - match_existing_records follows bibupload's order"""
+        records = [
+            # 001 first
+            self.make_record("1301.0007", recid=1, sysno="SYSNO-2"),
+            # Unknown 001, then system number
+            self.make_record("1301.0007", recid=999, sysno="SYSNO-2",
+                             oai_id=self.external_oai_id("arXiv", "oai:arXiv.org:1301.0003")),
+            # External OAI ID with the same provenance
+            self.make_record("1301.0003", local_oai_id="oai:inspirehep.net:5",
+                             oai_id=self.external_oai_id("arXiv", "oai:arXiv.org:1301.0003")),
+            # External OAI ID with another provenance, then local OAI ID
+            self.make_record("1301.0004", local_oai_id="oai:inspirehep.net:5",
+                             doi="10.1000/6",
+                             oai_id=self.external_oai_id("arXiv", "oai:arXiv.org:1301.0004")),
+            # DOI before report number
+            self.make_record("1301.0001", doi="10.1000/6"),
+            # Report number, with and without the arXiv: prefix
+            self.make_record("1301.0001"),
+            # Deleted records are not matched
+            self.make_record("1301.0009"),
+            self.make_record("1301.9999")]
+        self.assertEqual(match_existing_records(records),
+                         [[1], [2], [3], [5], [6], [1], [], []])
+
+    def test_ambiguous_match(self):
+        """bibfilter_oaiarXiv2inspire - match_existing_records returns all the ambiguous matches"""
+        records = [self.make_record("1301.0007")]
+        self.assertEqual(match_existing_records(records), [[7, 8]])
+        results = filter_record((records[0], [7, 8], None, {}))
+        self.assertEqual(results[:4], ([], [], [], [records[0]]))
+        self.assertEqual(results[4], ["Ambiguous match for 1301.0007: records 7, 8. "
+                                      "Sent to holding pen.\n"])
+
+    def test_skip_recid_check(self):
+        """bibfilter_oaiarXiv2inspire - match_existing_records by arXiv ID only"""
+        records = [self.make_record("1301.0001", recid=2, sysno="SYSNO-2",
+                                    doi="10.1000/6"),
+                   self.make_record("1301.0003",
+                                    oai_id=self.external_oai_id("arXiv", "oai:arXiv.org:1301.0003"))]
+        self.assertEqual(match_existing_records(records, skip_recid_check=True),
+                         [[1], []])
+
+
+class GetRecordsTest(unittest.TestCase):
+    """
+    Testing the bulk reading of the existing records.
+    """
+
+    def setUp(self):
+        self.database = FakeDatabase()
+        self.database.add_recstruct(1, serialize_via_marshal(make_record(AUTHORS)))
+        self.database.add_recstruct(2, "corrupted")
+        self.fetched = []
+        self.originals = (bibfilter_oaiarXiv2inspire.run_sql,
+                          bibfilter_oaiarXiv2inspire.get_record,
+                          bibfilter_oaiarXiv2inspire.CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE)
+        bibfilter_oaiarXiv2inspire.run_sql = self.database.run_sql
+        bibfilter_oaiarXiv2inspire.get_record = self.get_record
+
+    def tearDown(self):
+        bibfilter_oaiarXiv2inspire.run_sql, \
+            bibfilter_oaiarXiv2inspire.get_record, \
+            bibfilter_oaiarXiv2inspire.CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE = \
+            self.originals
+
+    def get_record(self, recid):
+        self.fetched.append(recid)
+        return make_record(AUTHORS[:recid])
+
+    def test_serialized_structures(self):
+        """bibfilter_oaiarXiv2inspire - get_records reads the serialized structures"""
+        bibfilter_oaiarXiv2inspire.CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE = 1
+        records = get_records([1, 2, 3])
+        self.assertEqual(records, {1: make_record(AUTHORS),
+                                   2: make_record(AUTHORS[:2]),
+                                   3: make_record(AUTHORS[:3])})
+        # Corrupted and missing structures are rebuilt by get_record
+        self.assertEqual(sorted(self.fetched), [2, 3])
+
+    def test_without_serialized_structures(self):
+        """bibfilter_oaiarXiv2inspire - get_records ignores the structures bibupload does not keep"""
+        bibfilter_oaiarXiv2inspire.CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE = 0
+        records = get_records([1, 2])
+        self.assertEqual(records, {1: make_record(AUTHORS[:1]),
+                                   2: make_record(AUTHORS[:2])})
+        self.assertEqual(sorted(self.fetched), [1, 2])
+
+
+class GetRecordsFromFileTest(unittest.TestCase):
+    """
+    Testing the incremental reading of the harvested MARCXML.
+    """
+
+    def setUp(self):
+        records = [make_record(AUTHORS), make_record([("Müller, J.", "Zürich")]),
+                   make_record([], ind1="1")]
+        self.xml = '<?xml version="1.0" encoding="UTF-8"?>\n<collection>\n%s\n</collection>\n' % \
+            ("\n".join([record_xml_output(record) for record in records]),)
+        fd, self.filename = mkstemp(prefix="bibfilter_oaiarXiv2inspire_tests_",
+                                    suffix=".xml")
+        os.write(fd, self.xml)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_same_as_create_records(self):
+        """bibfilter_oaiarXiv2inspire - get_records_from_file gives the records of create_records"""
+        expected = create_records(self.xml)
+        self.assertEqual(len(expected), 3)
+        first_record_end = self.xml.index("</record>")
+        # Chunk boundaries inside the records, tags and multibyte characters
+        for chunk_size in range(1, 40) + [first_record_end, first_record_end + 3,
+                                          len(self.xml), 1024 * 1024]:
+            self.assertEqual(list(get_records_from_file(self.filename, chunk_size)),
+                             expected)
+
+
+class PubnoteCacheTest(unittest.TestCase):
+    """
+    Testing the persistent cache of parsed publication notes.
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp(prefix="bibfilter_oaiarXiv2inspire_tests_")
+        # The cache directory is created when saving
+        self.filename = os.path.join(self.directory, "bibharvest", "pubnotes.cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load_cache(self, version="1", size=10):
+        cache = PubnoteCache(self.filename, version, size)
+        cache.load()
+        return cache
+
+    def test_save_and_load(self):
+        """bibfilter_oaiarXiv2inspire - PubnoteCache keeps the parsed pubnotes across runs"""
+        cache = self.load_cache()
+        self.assertEqual(cache.get(["Phys.Rev. 88 (2013) 123"]), {})
+        cache.add({"Phys.Rev. 88 (2013) 123": ("Phys.Rev.", "88", "2013", "123"),
+                   "Unparsable": None})
+        cache.save()
+
+        cache = self.load_cache()
+        self.assertEqual(cache.get(["Phys.Rev. 88 (2013) 123", "Unparsable", "Other"]),
+                         {"Phys.Rev. 88 (2013) 123": ("Phys.Rev.", "88", "2013", "123"),
+                          "Unparsable": None})
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertAlmostEqual(cache.get_hit_rate(), 200.0 / 3)
+
+    def test_version_change(self):
+        """bibfilter_oaiarXiv2inspire - PubnoteCache is invalidated by a new knowledge base version"""
+        cache = self.load_cache()
+        cache.add({"Phys.Rev. 88 (2013) 123": ("Phys.Rev.", "88", "2013", "123")})
+        cache.save()
+        cache = self.load_cache(version="2")
+        self.assertEqual(cache.get(["Phys.Rev. 88 (2013) 123"]), {})
+        self.assertEqual(cache.entries, {})
+
+    def test_size_bound(self):
+        """bibfilter_oaiarXiv2inspire - PubnoteCache keeps the most recently used pubnotes"""
+        cache = self.load_cache(size=2)
+        cache.add({"first": 1})
+        cache.add({"second": 2})
+        cache.add({"third": 3})
+        # Using the oldest entry makes it the most recent one
+        cache.get(["first"])
+        cache.save()
+        cache = self.load_cache(size=2)
+        self.assertEqual(sorted(cache.entries.keys()), ["first", "third"])
+
+    def test_unusable_file(self):
+        """bibfilter_oaiarXiv2inspire - PubnoteCache starts afresh from an unusable file"""
+        os.makedirs(os.path.dirname(self.filename))
+        for data in ("not a pickle", "cos\nnothing_here\n.", cPickle.dumps([1, 2]),
+                     cPickle.dumps({"version": "1"})):
+            cache_file = open(self.filename, "wb")
+            cache_file.write(data)
+            cache_file.close()
+            cache = self.load_cache()
+            self.assertEqual(cache.entries, {})
+            self.assertEqual(cache.uses, 0)
+
+
+class HarvestedRecordIndexTest(unittest.TestCase):
+    """
+    Testing the persistent index of the records already filtered.
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp(prefix="bibfilter_oaiarXiv2inspire_tests_")
+        # The index directory is created when opening
+        self.filename = os.path.join(self.directory, "bibharvest", "records.db")
+        self.record = make_record(AUTHORS)
+        record_add_field(self.record, "035", subfields=[("9", "arXiv"),
+                                                        ("a", "oai:arXiv.org:1301.0001")])
+        record_add_field(self.record, "FFT", subfields=[("a", "http://arxiv.org/pdf/1301.0001v2")])
+        self.changed_record = copy.deepcopy(self.record)
+        record_add_field(self.changed_record, "520", subfields=[("9", "arXiv"),
+                                                                ("a", "An abstract")])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open_index(self):
+        index = HarvestedRecordIndex(self.filename)
+        index.open()
+        return index
+
+    def test_unchanged_after_save(self):
+        """bibfilter_oaiarXiv2inspire - HarvestedRecordIndex recognizes the saved records"""
+        index = self.open_index()
+        self.assertFalse(index.is_unchanged(self.record))
+        index.save()
+
+        index = self.open_index()
+        self.assertTrue(index.is_unchanged(self.record))
+        self.assertTrue(index.is_unchanged(copy.deepcopy(self.record)))
+        self.assertFalse(index.is_unchanged(self.changed_record))
+        index.save()
+
+        index = self.open_index()
+        self.assertFalse(index.is_unchanged(self.record))
+        self.assertTrue(index.is_unchanged(self.changed_record))
+        index.close()
+
+    def test_nothing_recorded_without_save(self):
+        """bibfilter_oaiarXiv2inspire - HarvestedRecordIndex records nothing for a failed run"""
+        index = self.open_index()
+        self.assertFalse(index.is_unchanged(self.record))
+        index.close()
+
+        index = self.open_index()
+        self.assertFalse(index.is_unchanged(self.record))
+        index.save()
+        index = self.open_index()
+        self.assertFalse(index.is_unchanged(self.changed_record))
+        # The run seeing the changed record fails
+        index.close()
+
+        index = self.open_index()
+        self.assertTrue(index.is_unchanged(self.record))
+        index.close()
+
+    def test_entry(self):
+        """bibfilter_oaiarXiv2inspire - HarvestedRecordIndex entries and records without arXiv ID"""
+        index = self.open_index()
+        self.assertFalse(index.is_unchanged(make_record(AUTHORS)))
+        index.is_unchanged(self.record)
+        index.save()
+        db = anydbm.open(self.filename, "r")
+        try:
+            self.assertEqual(db.keys(), ["1301.0001"])
+            dummy, version, content_hash = db["1301.0001"].split(" ")
+        finally:
+            db.close()
+        self.assertEqual(version, "2")
+        self.assertEqual(content_hash, get_record_hash(self.record))
+
+
+TEST_SUITE = make_test_suite(HasFieldTest, RecordDiffCodesTest,
+                             MatchExistingRecordsTest, GetRecordsTest,
+                             GetRecordsFromFileTest, PubnoteCacheTest,
+                             HarvestedRecordIndexTest)
+
+if __name__ == '__main__':
+    run_test_suite(TEST_SUITE)
@@ -13,8 +13,11 @@ import os
 import sys
 import re
 import getopt
+import cPickle
+import multiprocessing
 
-from itertools import product
+from itertools import islice, imap
+from xml.parsers.expat import ExpatError
 
 try:
     import json
@@ -27,21 +30,22 @@ from invenio.apsharvest_utils import (unzip,
 from invenio.filedownloadutils import (download_url,
                                        InvenioFileDownloadError)
 from invenio.config import (CFG_ETCDIR,
+                            CFG_CACHEDIR,
                             CFG_TMPSHAREDDIR)
-from invenio.bibrecord import (create_record,
-                               record_get_field_instances,
+from invenio.bibrecord import (record_get_field_instances,
                                record_add_field,
-                               record_xml_output,
                                record_get_field_values,
                                record_delete_field,
                                record_delete_fields,
                                record_replace_field,
                                field_get_subfield_instances,
                                create_field,
-                               record_strip_controlfields)
-from invenio.search_engine import perform_request_search
+                               record_strip_controlfields,
+                               CFG_BIBRECORD_KEEP_SINGLETONS)
+from invenio.marcxmlutils import MARCXMLWriter
 from invenio.plotextractor_converter import convert_images
 from invenio.bibtask import write_message
+from invenio.bibtaskutils import get_external_ids
 
 # NB: For future reference, elementtree.ElementTree is depreciated after
 # Python 2.4, Inspire instances on higher Python versions should use xml.etree
@@ -49,7 +53,11 @@ from invenio.bibtask import write_message
 try:
     import elementtree.ElementTree as ET
 except ImportError:
-    from xml.etree import ElementTree as ET
+    try:
+        # The C implementation parses large harvests much faster
+        from xml.etree import cElementTree as ET
+    except ImportError:
+        from xml.etree import ElementTree as ET
 
 #python2.4 compatibility layer. Function any() is not included in 2.4
 try:
@@ -63,9 +71,24 @@ except NameError:
 
 
 CONFIG_FILE = 'oaicds_bibfilter_config.json'
+CONFIG_CACHE_FILE = os.path.join(CFG_CACHEDIR, "bibharvest",
+                                 "oaicds_bibfilter_config.cache")
 CONF_SERVER = 'localhost'
-CONFIG = {}
+RULES = None
+# Report number prefixes of the records going to the NOTE collection
+NOTE_REPORT_NUMBER_PREFIXES = ('ATLAS-CONF-', 'CMS-PAS-', 'ATL-', 'CMS-DP-',
+                               'ALICE-INT-', 'LHCb-PUB-')
+# 035 values (in lower case) of the identifiers which are not kept
+FORBIDDEN_035_VALUES = ('cercer', 'inspire', 'xx', 'cern annual report',
+                        'cmscms', 'wai01')
+# Words found in 980__a (in upper case) -> collection of the record
+COLLECTION_KEYWORDS = {'NOTE': 'NOTE',
+                       'THESIS': 'THESIS',
+                       'CONFERENCEPAPER': 'ConferencePaper'}
+CDS_ID_MAP = None
 PRINT_OUT = False
+# Number of records read ahead of the processes filtering them
+FILTER_BLOCK_SIZE = 1000
 
 # ==============================| Main |==============================
 
@@ -76,23 +99,31 @@ def main(args):
     decription:     Program to filter and analyse MARCXML records
                     harvested from external OAI sources, in particular CDS.
     usage:
-                    bibfilter_oaicds2inspire [-nh] MARCXML-FILE
+                    bibfilter_oaicds2inspire [-nh] [-j N] MARCXML-FILE
     options:
                 -n  forces the script not to check if the record exists in the database
                     (useful when re-harvesting existing record)
+                -j  number of processes filtering the records to insert (default: 1)
     """
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "nh", [])
+        opts, args = getopt.getopt(sys.argv[1:], "nhj:", [])
     except getopt.GetoptError, err_obj:
         sys.stderr.write("Error:" + err_obj + "\n")
         print usage
         sys.exit(1)
 
     skip_recid_check = False
+    processes = 1
 
     for opt, opt_value in opts:
         if opt in ['-n']:
             skip_recid_check = True
+        if opt in ['-j']:
+            try:
+                processes = int(opt_value)
+            except ValueError:
+                sys.stderr.write("Error: -j expects a number of processes\n")
+                sys.exit(1)
         if opt in ['-h']:
             print usage
             sys.exit(0)
@@ -113,87 +144,157 @@ def main(args):
         sys.exit(1)
 
     load_config(config_path)
+    load_cds_id_map()
 
     # Hack to activate UTF-8
     reload(sys)
     sys.setdefaultencoding("utf8")
     assert sys.getdefaultencoding() == "utf8"
 
-    record_tree, next_process, header_subs = clean_xml(input_filename)
-    records, deleted_records = next_process(record_tree, header_subs)
-    insert_records = []
-    append_records = []
-    error_records = []
+    if input_filename[-4:].lower() == '.xml':
+        output_filename = input_filename[:-4]
+    else:
+        output_filename = input_filename
+    insert_writer = MARCXMLWriter("%s.insert.xml" % (output_filename,))
+    append_writer = MARCXMLWriter("%s.append.xml" % (output_filename,))
+    error_writer = MARCXMLWriter("%s.errors.xml" % (output_filename,))
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, load_config, (config_path,))
+    else:
+        pool = None
+
+    records = get_records_to_insert(iterparse_records(input_filename),
+                                    append_writer, error_writer,
+                                    skip_recid_check)
+    # Step 2: Appply filter to transform CDS MARC to Inspire MARC
+    for record in imap_in_blocks(apply_filter, records, pool):
+        insert_writer.write(record)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # Output results. Files are only created if necessary.
+    insert_writer.close()
+    _print("%s.insert.xml" % (output_filename,))
+    _print("Number of records to insert:  %d\n"
+           % (insert_writer.count,))
+    append_writer.close()
+    _print("%s.append.xml" % (output_filename,))
+    _print("Number of records to append:  %d\n"
+           % (append_writer.count,))
+    error_writer.close()
+    _print("%s.errors.xml" % (output_filename,))
+    _print("Number of records with errors:  %d\n"
+           % (error_writer.count,))
+
+
+# ==============================| Functions |==============================
+
+
+def get_records_to_insert(records, append_writer, error_writer,
+                          skip_recid_check=False):
+    """ Matches the given records to those already in Inspire, yielding
+    the ones to insert. Records to delete are written with append_writer,
+    records without 001 with error_writer.
+
+    @param records: iterator over (record, deleted) tuples, as returned by
+                    iterparse_records
+    """
+    for record, deleted in records:
+        if deleted:
+            recid = record_get_field_values(record, tag="035", code="a")[0].split(":")[-1]
+            res = attempt_record_match(recid)
+            if res:
+                # Record exists and we should then delete it
+                _print("Record %s exists. Delete it" % (recid,))
+                append_writer.write(record)
+            continue
 
-    for record in records:
         # Step 1: Attempt to match the record to those already in Inspire
         try:
             recid = record['001'][0][3]
             res = attempt_record_match(recid)
-        except (KeyError, IndexError) as err:
+        except (KeyError, IndexError):
             _print('Error: Cannot process record without 001:recid')
-            error_records.append(record)
+            error_writer.write(record)
             continue
 
         if skip_recid_check or not res:
             _print("Record %s does not exist: inserting" % (recid,))
             # No record found
-            # Step 2: Appply filter to transform CDS MARC to Inspire MARC
-            insert_records.append(apply_filter(record))
-            #insert_records.append(record)
+            yield record
         else:
             _print("Record %s found: %r" % (recid, res))
 
-    for record in deleted_records:
-        recid = record_get_field_values(record, tag="035", code="a")[0].split(":")[-1]
-        res = attempt_record_match(recid)
-        if res:
-            # Record exists and we should then delete it
-            _print("Record %s exists. Delete it" % (recid,))
-            append_records.append(record)
-
-    # Output results. Create new files, if necessary.
-    if input_filename[-4:].lower() == '.xml':
-        input_filename = input_filename[:-4]
-
-
-    write_record_to_file("%s.insert.xml" % (input_filename,), insert_records)
-    _print("%s.insert.xml" % (input_filename,))
-    _print("Number of records to insert:  %d\n"
-           % (len(insert_records),))
-    write_record_to_file("%s.append.xml" % (input_filename,), append_records)
-    _print("%s.append.xml" % (input_filename,))
-    _print("Number of records to append:  %d\n"
-           % (len(append_records),))
-    write_record_to_file("%s.errors.xml" % (input_filename,), error_records)
-    _print("%s.errors.xml" % (input_filename,))
-    _print("Number of records with errors:  %d\n"
-           % (len(append_records),))
-
 
-# ==============================| Functions |==============================
-
-
-def write_record_to_file(filename, record_list):
+def imap_in_blocks(function, values, pool=None, block_size=FILTER_BLOCK_SIZE):
+    """ Applies function to the given values in the given process pool, if
+    any, yielding the results in the order of the values. The values are
+    taken block by block, so that they are not all read ahead of the
+    processes. The next block is read and submitted before the results of
+    the current one are drained, so that the processes are kept busy.
     """
-    Writes a new MARCXML file to specified path from a list of records.
-    """
-    if len(record_list) > 0:
-        out = []
-        out.append("<collection>")
-        for record in record_list:
-            if record != {}:
-                out.append(record_xml_output(record))
-        out.append("</collection>")
-        if len(out) > 2:
-            file_fd = open(filename, 'w')
-            file_fd.write("\n".join(out))
-            file_fd.close()
-
-
-def load_config(json_file=CONFIG_FILE):
-    """ Loads configuration from JSON file """
-    _print('Loading config from %s' % json_file, verbose=5)
+    values = iter(values)
+    if pool is None:
+        for result in imap(function, values):
+            yield result
+        return
+    pending = None
+    while True:
+        block = list(islice(values, block_size))
+        if block:
+            results = pool.imap(function, block, 10)
+        else:
+            results = None
+        if pending is not None:
+            for result in pending:
+                yield result
+        if results is None:
+            break
+        pending = results
+
+
+class FilterRules(object):
+    """ Rules used by apply_filter, compiled once from the translation tables
+    of the JSON configuration and from the report number prefixes, forbidden
+    035 values and collection keywords above """
+    def __init__(self, tables,
+                 note_report_number_prefixes=NOTE_REPORT_NUMBER_PREFIXES,
+                 forbidden_035_values=FORBIDDEN_035_VALUES,
+                 collection_keywords=COLLECTION_KEYWORDS):
+        # Name of the table -> dictionary of CDS value -> Inspire value
+        self.tables = tables
+        self.note_report_number = re.compile("|".join(
+            [re.escape(prefix) for prefix in note_report_number_prefixes]))
+        self.forbidden_035_values = frozenset(forbidden_035_values)
+        self.collection_keywords = collection_keywords
+        self.collection_keyword = re.compile("|".join(
+            [re.escape(keyword) for keyword in collection_keywords]),
+            re.IGNORECASE)
+
+    def get_collections(self, values):
+        """ Returns the set of collections named by the given 980__a values """
+        collections = set([])
+        for value in values:
+            for keyword in self.collection_keyword.findall(value):
+                collections.add(self.collection_keywords[keyword.upper()])
+        return collections
+
+    def is_note_report_number(self, value):
+        """ Checks if the report number is the one of a note """
+        return self.note_report_number.match(value) is not None
+
+    def is_forbidden_035_value(self, value):
+        """ Checks if the 035 value, in any case, is a forbidden one """
+        return value.lower() in self.forbidden_035_values
+
+
+def read_config_tables(json_file):
+    """ Reads the translation tables from the JSON configuration file
+    Returns: dictionary, name of the table -> dictionary of
+             CDS value -> Inspire value """
     try:
         handle = open(json_file, 'r')
         conf = json.load(handle)
@@ -202,8 +303,7 @@ def load_config(json_file=CONFIG_FILE):
         _print("FATAL ERROR: Could not read config file.")
         sys.exit(1)
 
-    global CONFIG
-    CONFIG = {'config': {}}
+    tables = {}
     for key, values in conf['config'].iteritems():
         parse_dict = {}
         for di in values:
@@ -211,23 +311,84 @@ def load_config(json_file=CONFIG_FILE):
                 parse_dict[di['cds']] = di['inspire']
             except KeyError:
                 _print("ERROR: Could not parse dictionary pair %s" % repr(di))
-        CONFIG['config'][key] = parse_dict
+        tables[key] = parse_dict
+    return tables
+
+
+def read_config_cache(json_file, mtime, cache_file=CONFIG_CACHE_FILE):
+    """ Returns the translation tables cached for the configuration file
+    with given modification time, or None """
+    try:
+        handle = open(cache_file, 'rb')
+        try:
+            data = cPickle.load(handle)
+        finally:
+            handle.close()
+    except (IOError, EOFError, cPickle.UnpicklingError, ValueError,
+            TypeError, AttributeError, ImportError, KeyError, IndexError):
+        # No usable cache, the tables are read again
+        return None
+    if isinstance(data, dict) and \
+       data.get('config_file') == os.path.abspath(json_file) and \
+       data.get('mtime') == mtime and isinstance(data.get('tables'), dict):
+        return data['tables']
+    return None
+
+
+def write_config_cache(json_file, mtime, tables, cache_file=CONFIG_CACHE_FILE):
+    """ Caches the translation tables of the configuration file with given
+    modification time """
+    temporary_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    try:
+        directory = os.path.dirname(cache_file)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle = open(temporary_file, 'wb')
+        try:
+            cPickle.dump({'config_file': os.path.abspath(json_file),
+                          'mtime': mtime,
+                          'tables': tables}, handle, -1)
+        finally:
+            handle.close()
+        os.rename(temporary_file, cache_file)
+    except (IOError, OSError), err:
+        _print("Could not cache config in %s: %s" % (cache_file, err),
+               verbose=5)
+
+
+def load_config(json_file=CONFIG_FILE):
+    """ Loads configuration from JSON file, or from its cache if the file
+    did not change since, and compiles the rules of the filter """
+    _print('Loading config from %s' % json_file, verbose=5)
+    try:
+        mtime = os.path.getmtime(json_file)
+    except OSError:
+        _print("FATAL ERROR: Could not read config file.")
+        sys.exit(1)
+
+    tables = read_config_cache(json_file, mtime)
+    if tables is None:
+        tables = read_config_tables(json_file)
+        write_config_cache(json_file, mtime, tables)
+
+    global RULES
+    RULES = FilterRules(tables)
 
 
 def get_languages():
-    return CONFIG['config']['languages']
+    return RULES.tables['languages']
 
 
 def get_journals():
-    return CONFIG["config"]["journals"]
+    return RULES.tables["journals"]
 
 
 def get_experiments():
-    return CONFIG["config"]["experiments"]
+    return RULES.tables["experiments"]
 
 
 def get_categories():
-    return CONFIG['config']['categories']
+    return RULES.tables['categories']
 
 
 def determine_collection(setspec):
@@ -235,180 +396,187 @@ def determine_collection(setspec):
     return setspec.split(':')[-1:][0].upper()
 
 
-def element_tree_to_record(tree, header_subs=None):
-    marcxml = ET.tostring(tree.getroot(), encoding="utf-8")
-    record, status, errors = create_record(marcxml)
-    if errors:
-        _print(str(status))
-    return [record], []
-
-
-def element_tree_collection_to_records(tree, header_subs=None):
-    """ Takes an ElementTree and converts the nodes
-    into BibRecord records so they can be worked with.
-    This function is for a tree root of collection as such:
-    <collection>
-        <record>
-            <!-- MARCXML -->
-        </record>
-        <record> ... </record>
-    </collection>
+def _element_text(element):
+    """ Returns the text of the element as a UTF-8 string """
+    text = element.text
+    if text is None:
+        return ''
+    if isinstance(text, unicode):
+        return text.encode("utf-8")
+    return text
+
+
+def element_to_record(record_element, keep_singletons=CFG_BIBRECORD_KEEP_SINGLETONS):
+    """ Builds the BibRecord structure of a MARCXML record element
+    directly from the element, instead of serializing it and parsing it
+    again with create_record, giving the same structure: controlfields
+    first, then datafields, numbered in this order.
+
+    @param record_element: Element: MARCXML record node, with or without
+                           namespace
+    @param keep_singletons: keep empty fields and subfields, as create_record
+
+    @return: dictionary, BibRecord structure
     """
-    records = []
-    collection = tree.getroot()
-    for record_element in collection.getchildren():
-        marcxml = ET.tostring(record_element, encoding="utf-8")
-        record, status, errors = create_record(marcxml)
-        if errors:
-            _print(str(status))
-        records.append(record)
-    return records, []
-
-
-def element_tree_oai_to_records(tree, header_subs=None):
-    """ Takes an ElementTree and converts the nodes
-    into BibRecord records so they can be worked with.
-    This expects a clean OAI response with the tree root as ListRecords or GetRecord
-    and record as the subtag like so:
-    <ListRecords|GetRecord>
-        <record>
-            <header>
-                <!-- Record Information -->
-            </header>
-            <metadata>
-                <record>
-                    <!-- MARCXML -->
-                </record>
-            </metadata>
-        </record>
-        <record> ... </record>
-    </ListRecords|GetRecord>
-
-    @param tree: ElementTree: Tree object corresponding to GetRecord node from
-                              OAI request
+    record = {}
+    field_position_global = 0
+    datafields = []
+    for element in record_element.getiterator():
+        name = element.tag.split('}')[-1]
+        if name == 'controlfield':
+            tag = element.attrib.get('tag', '!')
+            text = _element_text(element)
+            if text or keep_singletons:
+                field_position_global += 1
+                record.setdefault(tag, []).append(([], ' ', ' ', text,
+                                                   field_position_global))
+        elif name == 'datafield':
+            datafields.append(element)
+
+    for datafield in datafields:
+        tag = datafield.attrib.get('tag', '!')
+        ind1 = datafield.attrib.get('ind1', '!')
+        ind2 = datafield.attrib.get('ind2', '!')
+        if ind1 in ('', '_'):
+            ind1 = ' '
+        if ind2 in ('', '_'):
+            ind2 = ' '
+        subfields = []
+        for element in datafield.getiterator():
+            if element.tag.split('}')[-1] == 'subfield':
+                code = element.attrib.get('code', '!')
+                text = _element_text(element)
+                if text or keep_singletons:
+                    subfields.append((code, text))
+        if subfields or keep_singletons:
+            field_position_global += 1
+            record.setdefault(tag, []).append((subfields, ind1, ind2, '',
+                                               field_position_global))
+    return record
+
+
+def oai_record_element_to_record(record_element, header_subs=()):
+    """ Converts an OAI record node into a BibRecord, or into a record
+    deleting the CDS record if its header has status="deleted".
+
+    @param record_element: Element: OAI record node, without namespace
     @param header_subs: OAI header subfields, if any
 
-    @return: (record_list, deleted_list) A tuple, with first a list of BibRecords
-             found and second a list of BibRecords to delete.
+    @return: (record, deleted) A tuple of the BibRecord and whether it is
+             a record to delete.
     """
-    records = []
-    deleted_records = []
-    if not header_subs:
-        header_subs = []
-    # Make it a tuple, this information should not be changed
-    header_subs = tuple(header_subs)
-
-    oai_records = tree.getroot()
-    for record_element in oai_records.getchildren():
-        header = record_element.find('header')
-
-        # Add to OAI subfield
-        datestamp = header.find('datestamp')
-        identifier = header.find('identifier')
-        identifier = identifier.text
-
-        # The record's subfield is based on header information
-        subs = list(header_subs)
-        subs.append(("a", identifier))
-        subs.append(("d", datestamp.text))
-
-        if "status" in header.attrib and header.attrib["status"] == "deleted":
-            # Record was deleted - create delete record
-            recid = identifier.split(":")[-1]
-            deleted_record = {}
-            record_add_field(deleted_record, "035", subfields=[("9", "CDS"), ("a", recid)])
-            record_add_field(deleted_record, "037", subfields=subs)
-            record_add_field(deleted_record, "980", subfields=[("c", "DELETED")])
-            deleted_records.append(deleted_record)
-            _print("Record has been deleted: %s" % (identifier,))
-            continue
+    header = record_element.find('header')
 
-        marc_root = record_element.find('metadata').find('record')
-        marcxml = ET.tostring(marc_root, encoding="utf-8")
-        record, status, errors = create_record(marcxml)
-        if status == 1:
-            # Add OAI request information
-            record_add_field(record, "035", subfields=subs)
-            records.append(record)
-        else:
-            _print("ERROR: Could not create record from %s" % (identifier,))
-            _print(" * %r" % (errors,))
-    return records, deleted_records
+    # Add to OAI subfield
+    datestamp = header.find('datestamp')
+    identifier = header.find('identifier')
+    identifier = identifier.text
 
+    # The record's subfield is based on header information
+    subs = list(header_subs)
+    subs.append(("a", identifier))
+    subs.append(("d", datestamp.text))
 
-def get_request_subfields(root):
-    """
-    Builds a basic 035 subfield with basic information from the OAI-PMH request.
+    if "status" in header.attrib and header.attrib["status"] == "deleted":
+        # Record was deleted - create delete record
+        recid = identifier.split(":")[-1]
+        deleted_record = {}
+        record_add_field(deleted_record, "035", subfields=[("9", "CDS"), ("a", recid)])
+        record_add_field(deleted_record, "037", subfields=subs)
+        record_add_field(deleted_record, "980", subfields=[("c", "DELETED")])
+        _print("Record has been deleted: %s" % (identifier,))
+        return deleted_record, True
 
-    @param root: ElementTree root node
+    marc_root = record_element.find('metadata').find('record')
+    record = element_to_record(marc_root)
+    # Add OAI request information
+    record_add_field(record, "035", subfields=subs)
+    return record, False
 
-    @return: list of subfield tuples [(..),(..)]
-    """
-    request = root.find('request')
-    responsedate = root.find('responseDate')
 
-    subs = [("9", request.text),
-            ("h", responsedate.text),
-            ("m", request.attrib["metadataPrefix"])]
-    return subs
+def _local_name(tag):
+    """ Returns the tag of an element without namespace """
+    return tag.split('}')[-1]
 
 
-def clean_xml(xml):
-    """
-    Cleans MARCXML harvested from OAI, allowing in
-    to be used with BibUpload or BibRecord
+def iterparse_records(xml_file):
+    """ Parses an OAI-PMH response (ListRecords or GetRecord), a MARCXML
+    collection or a single MARCXML record incrementally, yielding the
+    records one at a time as they are parsed, so that large harvests are
+    processed in constant memory.
+
+    Namespaces are stripped from the elements as they are parsed, and the
+    elements of every record are dropped once it has been converted.
 
-    @param xml: either XML as a string or path to an XML file
+    @param xml_file: path to, or file object of, the XML to parse
 
-    @return: ElementTree of clean data
+    @return: iterator over (record, deleted) tuples, see
+             oai_record_element_to_record
     """
+    # Elements from the root to the element being parsed. Their tags keep
+    # their namespace until they are completely parsed.
+    path = []
+    root_tag = None
+    header_subs = None
+    found_records = False
     try:
-        if os.path.isfile(xml):
-            tree = ET.parse(xml)
-        else:
-            _print("Warning: input is not a valid file, attempting to parse " +
-                   "input as XML...")
-            tree = ET.fromstring(xml)
-    except Exception, e:
+        for event, element in ET.iterparse(xml_file, events=("start", "end")):
+            if event == "start":
+                if root_tag is None:
+                    root_tag = _local_name(element.tag).lower()
+                path.append(element)
+                continue
+
+            path.pop()
+            element.tag = _local_name(element.tag)
+            if not path:
+                # End of the document
+                if root_tag == 'record':
+                    yield element_to_record(element), False
+                break
+
+            parent_tag = _local_name(path[-1].tag)
+            if root_tag == 'record':
+                # Single MARCXML record, converted as a whole at the end
+                continue
+            if root_tag == 'collection':
+                if len(path) == 1 and element.tag == 'record':
+                    yield element_to_record(element), False
+                    element.clear()
+                    path[-1].remove(element)
+            elif len(path) == 1 and element.tag in ('ListRecords', 'GetRecord'):
+                found_records = True
+            elif len(path) == 2 and element.tag == 'record' and \
+                    parent_tag in ('ListRecords', 'GetRecord'):
+                if header_subs is None:
+                    # The request is given before the records
+                    header_subs = tuple(get_request_subfields(path[0]))
+                yield oai_record_element_to_record(element, header_subs)
+                element.clear()
+                path[-1].remove(element)
+    except (SyntaxError, ExpatError):
         _print("ERROR: Could not read OAI XML, aborting filter!")
-        raise e
-    root = tree.getroot()
-    strip_xml_namespace(root)
-    if root.tag.lower() == 'collection':
-        return ET.ElementTree(root), element_tree_collection_to_records, None
-    elif root.tag.lower() == 'record':
-        new_root = ET.Element('collection')
-        new_root.append(root)
-        return ET.ElementTree(new_root), element_tree_to_record, None
-
-    header_subs = get_request_subfields(root)
-
-    records = root.find('ListRecords')
-    if records is None:
-        records = root.find('GetRecord')
-    if records is None:
-        raise ValueError("Cannot find ListRecords or GetRecord!")
+        raise
 
-    return ET.ElementTree(records), element_tree_oai_to_records, header_subs
+    if root_tag not in (None, 'record', 'collection') and not found_records:
+        raise ValueError("Cannot find ListRecords or GetRecord!")
 
 
-def strip_xml_namespace(root):
+def get_request_subfields(root):
     """
-    Strips out namespace data from an ElementTree
-    This function is recursive and will traverse all
-    subnodes to the root element
+    Builds a basic 035 subfield with basic information from the OAI-PMH request.
 
-    @param root: the root element
+    @param root: ElementTree root node
 
-    @return: the same root element, minus namespace
+    @return: list of subfield tuples [(..),(..)]
     """
-    try:
-        root.tag = root.tag.split('}')[1]
-    except IndexError:
-        pass
+    request = root.find('request')
+    responsedate = root.find('responseDate')
 
-    for element in root.getchildren():
-        strip_xml_namespace(element)
+    subs = [("9", request.text),
+            ("h", responsedate.text),
+            ("m", request.attrib["metadataPrefix"])]
+    return subs
 
 
 def apply_filter(rec):
@@ -436,27 +604,16 @@ def apply_filter(rec):
             record_delete_fields(rec, tag)
 
     # 980 Determine Collections
-    collections = set([])
-    for value in record_get_field_values(rec, '980', code='a'):
-        if 'NOTE' in value.upper():
-            collections.add('NOTE')
-        if 'THESIS' in value.upper():
-            collections.add('THESIS')
-        if 'CONFERENCEPAPER' in value.upper():
-            collections.add('ConferencePaper')
-
+    collections = RULES.get_collections(record_get_field_values(rec, '980',
+                                                                code='a'))
 
     if is_published(rec):
         collections.add("PUBLISHED")
         collections.add("CITEABLE")
 
     if not 'NOTE' in collections:
-        # TODO: Move this to a KB
-        kb = ['ATLAS-CONF-', 'CMS-PAS-', 'ATL-', 'CMS-DP-',
-              'ALICE-INT-', 'LHCb-PUB-']
-        values = record_get_field_values(rec, "088", code='a')
-        for val, rep in product(values, kb):
-            if val.startswith(rep):
+        for val in record_get_field_values(rec, "088", code='a'):
+            if RULES.is_note_report_number(val):
                 collections.add('NOTE')
                 break
 
@@ -503,19 +660,13 @@ def apply_filter(rec):
 
     # 035 Externals
     scn_035_fields = record_get_field_instances(rec, '035')
-    forbidden_values = ["cercer",
-                        "inspire",
-                        "xx",
-                        "cern annual report",
-                        "cmscms",
-                        "wai01"]
     for field in scn_035_fields:
         subs = field_get_subfields(field)
         if '9' in subs:
             if not 'a' in subs:
                 continue
             for sub in subs['9']:
-                if sub.lower() in forbidden_values:
+                if RULES.is_forbidden_035_value(sub):
                     break
             else:
                 # No forbidden values (We did not "break")
@@ -526,7 +677,7 @@ def apply_filter(rec):
                     continue
         if 'a' in subs:
             for sub in subs['a']:
-                if sub.lower() in forbidden_values:
+                if RULES.is_forbidden_035_value(sub):
                     record_delete_field(rec, tag="035",
                                         field_position_global=field[4])
 
@@ -830,9 +981,24 @@ def field_swap_subfields(field, subs):
     return subs, field[1], field[2], field[3], field[4]
 
 
+def load_cds_id_map():
+    """ Loads the map of CDS record ID -> list of Inspire record IDs, from
+    the 035 fields having both $$9CDS and $$a<CDS record ID>, loaded at
+    once. Deleted records are left out. """
+    _print('Loading CDS record IDs', verbose=5)
+    global CDS_ID_MAP
+    CDS_ID_MAP = {}
+    for cds_id, recid in get_external_ids('CDS'):
+        CDS_ID_MAP.setdefault(cds_id, []).append(recid)
+    for recids in CDS_ID_MAP.itervalues():
+        recids.sort()
+
+
 def attempt_record_match(recid):
     """ Tries to find out if the record is already in Inspire """
-    return perform_request_search(p="035:CDS and 035:%s" % (recid,), of="id")
+    if CDS_ID_MAP is None:
+        load_cds_id_map()
+    return CDS_ID_MAP.get(str(recid), [])
 
 
 def is_published(record):
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+"""
+    name:           bibfilter_oaicds2inspire_benchmark
+    decription:     Benchmark of bibfilter_oaicds2inspire on a synthetic
+                    CDS OAI-PMH dump.
+
+                    Generates a ListRecords response with the given number
+                    of CDS-like records (some of them deleted) and runs the
+                    filter on it with every given number of processes,
+                    reporting the records filtered per second and checking
+                    that all the runs write the same files.
+
+                    No record is matched against the database: every record
+                    is inserted, so apply_filter runs on all of them.
+                    Run it from the bibharvest source directory, next to
+                    bibfilter_oaicds2inspire.py and its JSON configuration.
+    usage:
+                    bibfilter_oaicds2inspire_benchmark [options]
+    options:
+                -n, --records=NUM     number of records in the dump (default: 50000)
+                -j, --processes=LIST  comma separated numbers of processes to run
+                                      the filter with (default: 1,4)
+                -k, --keep            keep the working directory
+                -h, --help            print this help and exit
+"""
+
+import os
+import sys
+import time
+import getopt
+import shutil
+import hashlib
+
+from tempfile import mkdtemp
+
+import bibfilter_oaicds2inspire
+
+LANGUAGES = ("eng", "fre", "ger", "ita", "spa")
+CATEGORIES = ("Particle Physics - Experiment", "Particle Physics - Theory",
+              "Detectors and Experimental Techniques", "Nuclear Physics")
+EXPERIMENTS = (("CERN LHC", "ATLAS"), ("CERN LHC", "CMS"), ("CERN LHC", "LHCb"))
+JOURNALS = ("Phys. Rev. D", "Phys. Lett. B", "Eur. Phys. J. C", "J. High Energy Phys.")
+REPORT_NUMBERS = ("ATLAS-CONF-2013-%03d", "CMS-PAS-EXO-13-%03d",
+                  "CERN-PH-EP-2013-%03d", "LHCb-PUB-2013-%03d")
+COLLECTIONS = ("ARTICLE", "PREPRINT", "THESIS", "ConferencePaper", "NOTE")
+
+
+def generate_record(number):
+    """ Returns the MARCXML of the synthetic CDS record with given number """
+    cds_id = 1000000 + number
+    experiment = EXPERIMENTS[number % len(EXPERIMENTS)]
+    out = ['<record xmlns="http://www.loc.gov/MARC21/slim">',
+           '<controlfield tag="001">%d</controlfield>' % (cds_id,),
+           '<controlfield tag="005">20130101120000.0</controlfield>',
+           '<datafield tag="035" ind1=" " ind2=" "><subfield code="9">SPIRES</subfield>'
+           '<subfield code="a">%d</subfield></datafield>' % (number,),
+           '<datafield tag="037" ind1=" " ind2=" "><subfield code="a">arXiv:1301.%05d</subfield></datafield>' % (number % 100000,),
+           '<datafield tag="041" ind1=" " ind2=" "><subfield code="a">%s</subfield></datafield>' % (LANGUAGES[number % len(LANGUAGES)],),
+           '<datafield tag="088" ind1=" " ind2=" "><subfield code="a">%s</subfield></datafield>' % (REPORT_NUMBERS[number % len(REPORT_NUMBERS)] % (number % 1000,),),
+           '<datafield tag="100" ind1=" " ind2=" "><subfield code="a">Bloggs, J K</subfield>'
+           '<subfield code="u">CERN</subfield></datafield>',
+           '<datafield tag="245" ind1=" " ind2=" "><subfield code="a">Search for new physics in sample %d</subfield></datafield>' % (number,),
+           '<datafield tag="260" ind1=" " ind2=" "><subfield code="c">2013</subfield></datafield>',
+           '<datafield tag="269" ind1=" " ind2=" "><subfield code="c">%d Mar 2013</subfield></datafield>' % (number % 28 + 1,),
+           '<datafield tag="300" ind1=" " ind2=" "><subfield code="a">%d p</subfield></datafield>' % (number % 50 + 5,),
+           '<datafield tag="520" ind1=" " ind2=" "><subfield code="a">%s</subfield></datafield>' % ("Abstract text. " * 20,),
+           '<datafield tag="650" ind1="1" ind2="7"><subfield code="a">%s</subfield></datafield>' % (CATEGORIES[number % len(CATEGORIES)],),
+           '<datafield tag="693" ind1=" " ind2=" "><subfield code="a">%s</subfield><subfield code="e">%s</subfield></datafield>' % experiment,
+           '<datafield tag="710" ind1=" " ind2=" "><subfield code="g">%s Collaboration</subfield>'
+           '<subfield code="5">PH-EP</subfield></datafield>' % (experiment[1],),
+           '<datafield tag="773" ind1=" " ind2=" "><subfield code="p">%s</subfield>'
+           '<subfield code="v">%d</subfield><subfield code="c">%d</subfield></datafield>' % (JOURNALS[number % len(JOURNALS)], number % 90 + 1, number),
+           '<datafield tag="856" ind1="4" ind2=" "><subfield code="u">http://cds.cern.ch/record/%d/files/paper.ps.gz</subfield></datafield>' % (cds_id,),
+           '<datafield tag="980" ind1=" " ind2=" "><subfield code="a">%s</subfield></datafield>' % (COLLECTIONS[number % len(COLLECTIONS)],)]
+    for author in range(number % 40):
+        out.append('<datafield tag="700" ind1=" " ind2=" "><subfield code="a">Author%d, A B</subfield>'
+                   '<subfield code="u">Institute %d</subfield></datafield>' % (author, author % 7))
+    out.append('</record>')
+    return ''.join(out)
+
+
+def generate_dump(filename, number_of_records):
+    """ Writes a CDS OAI-PMH ListRecords response with the given number of
+    records, one in twenty of them deleted. """
+    dump = open(filename, 'w')
+    dump.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">\n'
+               '<responseDate>2013-05-01T10:00:00Z</responseDate>\n'
+               '<request verb="ListRecords" metadataPrefix="marcxml">http://cds.cern.ch/oai2d</request>\n'
+               '<ListRecords>\n')
+    for number in xrange(number_of_records):
+        header = '<identifier>oai:cds.cern.ch:%d</identifier>' \
+                 '<datestamp>2013-04-01T00:00:00Z</datestamp>' % (1000000 + number,)
+        if number % 20 == 19:
+            dump.write('<record><header status="deleted">%s</header></record>\n' % (header,))
+        else:
+            dump.write('<record><header>%s<setSpec>cern:experiment</setSpec></header>'
+                       '<metadata>%s</metadata></record>\n' % (header, generate_record(number)))
+    dump.write('</ListRecords>\n</OAI-PMH>\n')
+    dump.close()
+
+
+def run_filter(input_filename, processes, etcdir):
+    """ Runs the filter on the given file with the given number of processes.
+
+    @return: elapsed seconds
+    """
+    module = bibfilter_oaicds2inspire
+    originals = {'CFG_ETCDIR': module.CFG_ETCDIR,
+                 'load_cds_id_map': module.load_cds_id_map,
+                 'CDS_ID_MAP': module.CDS_ID_MAP}
+    module.CFG_ETCDIR = etcdir
+    # Nothing is matched: every record goes through apply_filter
+    module.load_cds_id_map = lambda: None
+    module.CDS_ID_MAP = {}
+    argv, stdout = sys.argv, sys.stdout
+    sys.argv = ['bibfilter_oaicds2inspire', '-j', str(processes), input_filename]
+    log = open(input_filename + '.log', 'w')
+    sys.stdout = log
+    start = time.time()
+    try:
+        module.main(sys.argv[1:])
+        elapsed = time.time() - start
+    finally:
+        sys.argv, sys.stdout = argv, stdout
+        log.close()
+        for name, value in originals.items():
+            setattr(module, name, value)
+    return elapsed
+
+
+def get_output_checksum(directory):
+    """ Returns a checksum of the files written by the filter """
+    checksum = hashlib.md5()
+    for suffix in ('insert', 'append', 'errors'):
+        filename = os.path.join(directory, 'cds_dump.%s.xml' % (suffix,))
+        if os.path.exists(filename):
+            checksum.update(open(filename).read())
+        checksum.update('\0')
+    return checksum.hexdigest()
+
+
+def run_benchmark(number_of_records=50000, processes_list=(1, 4), keep=False):
+    """ Generates the dump and runs the filter on it with every number of
+    processes.
+
+    @return: list of (processes, elapsed seconds, checksum of the output)
+    """
+    source_directory = os.path.dirname(os.path.abspath(__file__))
+    workdir = mkdtemp(prefix="bibfilter_oaicds2inspire_benchmark_")
+    etcdir = os.path.join(workdir, 'etc')
+    os.makedirs(os.path.join(etcdir, 'bibharvest'))
+    shutil.copy(os.path.join(source_directory, bibfilter_oaicds2inspire.CONFIG_FILE),
+                os.path.join(etcdir, 'bibharvest'))
+    try:
+        dump = os.path.join(workdir, 'cds_dump.xml')
+        start = time.time()
+        generate_dump(dump, number_of_records)
+        print "Generated %d records (%.1f MB) in %.2f s" % \
+              (number_of_records, os.path.getsize(dump) / 1048576.0, time.time() - start)
+
+        results = []
+        for processes in processes_list:
+            directory = os.path.join(workdir, 'run_%d' % (processes,))
+            os.mkdir(directory)
+            input_filename = os.path.join(directory, 'cds_dump.xml')
+            os.symlink(dump, input_filename)
+            elapsed = run_filter(input_filename, processes, etcdir)
+            results.append((processes, elapsed, get_output_checksum(directory)))
+    finally:
+        if keep:
+            print "Working directory kept in %s" % (workdir,)
+        else:
+            shutil.rmtree(workdir, True)
+    return results
+
+
+def print_report(number_of_records, results):
+    print "%10s %10s %12s %8s" % ("processes", "time (s)", "records/s", "speedup")
+    for processes, elapsed, dummy in results:
+        print "%10d %10.2f %12.1f %8.2f" % \
+              (processes, elapsed, elapsed and number_of_records / elapsed or 0.0,
+               elapsed and results[0][1] / elapsed or 0.0)
+    if len(set([checksum for dummy1, dummy2, checksum in results])) == 1:
+        print "All runs wrote identical files."
+    else:
+        print "ERROR: the runs wrote different files!"
+
+
+def usage(exitcode=1, msg=""):
+    if msg:
+        sys.stderr.write("Error: %s\n" % (msg,))
+    sys.stderr.write(__doc__[__doc__.index("usage"):])
+    sys.exit(exitcode)
+
+
+def main():
+    try:
+        opts, dummy = getopt.getopt(sys.argv[1:], "n:j:kh",
+                                    ["records=", "processes=", "keep", "help"])
+    except getopt.GetoptError, e:
+        usage(1, str(e))
+
+    options = {"number_of_records": 50000, "processes_list": (1, 4),
+               "keep": False}
+    try:
+        for opt, value in opts:
+            if opt in ("-n", "--records"):
+                options["number_of_records"] = int(value)
+            elif opt in ("-j", "--processes"):
+                options["processes_list"] = [int(processes) for processes in value.split(",")]
+            elif opt in ("-k", "--keep"):
+                options["keep"] = True
+            elif opt in ("-h", "--help"):
+                usage(0)
+    except ValueError, e:
+        usage(1, str(e))
+
+    results = run_benchmark(**options)
+    print_report(options["number_of_records"], results)
+
+
+if __name__ == "__main__":
+    main()
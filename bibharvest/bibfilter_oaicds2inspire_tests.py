@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for the record parsing of bibfilter_oaicds2inspire."""
+
+import os
+import shutil
+import cPickle
+import unittest
+from cStringIO import StringIO
+from itertools import imap
+from tempfile import mkdtemp
+
+from invenio.testutils import make_test_suite, run_test_suite
+from invenio.bibrecord import create_record, create_records, record_add_field
+
+from bibfilter_oaicds2inspire import (ET,
+                                      element_to_record,
+                                      iterparse_records,
+                                      imap_in_blocks,
+                                      read_config_cache,
+                                      write_config_cache)
+
+MARCXML_RECORD = """<record xmlns="http://www.loc.gov/MARC21/slim">
+<controlfield tag="001">1234567</controlfield>
+<controlfield tag="005">20130101120000.0</controlfield>
+<datafield tag="035" ind1=" " ind2=" ">
+  <subfield code="9">SPIRES</subfield>
+  <subfield code="a">4321</subfield>
+</datafield>
+<datafield tag="100" ind1="_" ind2="_">
+  <subfield code="a">Müller, Jürgen</subfield>
+  <subfield code="u">CERN</subfield>
+</datafield>
+<datafield tag="245" ind1="" ind2="0">
+  <subfield code="a">Étude des désintégrations du méson B</subfield>
+  <subfield code="b"></subfield>
+</datafield>
+<datafield tag="650" ind1="1" ind2="7">
+  <subfield code="2">SzGeCERN</subfield>
+  <subfield code="a">Particle Physics - Experiment</subfield>
+</datafield>
+<datafield tag="700" ind1=" " ind2=" ">
+  <subfield code="a"></subfield>
+</datafield>
+<datafield tag="980" ind1=" " ind2=" ">
+  <subfield code="a">ARTICLE</subfield>
+</datafield>
+</record>"""
+
+OAI_LIST_RECORDS = """<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<responseDate>2013-05-01T10:00:00Z</responseDate>
+<request verb="ListRecords" metadataPrefix="marcxml">http://cds.cern.ch/oai2d</request>
+<ListRecords>
+<record>
+  <header>
+    <identifier>oai:cds.cern.ch:1234567</identifier>
+    <datestamp>2013-04-01T00:00:00Z</datestamp>
+    <setSpec>cern:experiment</setSpec>
+  </header>
+  <metadata>%s</metadata>
+</record>
+<record>
+  <header status="deleted">
+    <identifier>oai:cds.cern.ch:7654321</identifier>
+    <datestamp>2013-04-02T00:00:00Z</datestamp>
+  </header>
+</record>
+</ListRecords>
+</OAI-PMH>""" % (MARCXML_RECORD,)
+
+
+class ElementToRecordTest(unittest.TestCase):
+    """
+    Testing the conversion of MARCXML elements to BibRecord structures.
+    """
+
+    def test_same_as_create_record(self):
+        """bibfilter_oaicds2inspire - element_to_record gives the record of create_record"""
+        record = element_to_record(ET.fromstring(MARCXML_RECORD))
+        self.assertEqual(record, create_record(MARCXML_RECORD)[0])
+
+    def test_same_as_create_record_without_singletons(self):
+        """bibfilter_oaicds2inspire - element_to_record drops empty subfields as create_record"""
+        record = element_to_record(ET.fromstring(MARCXML_RECORD),
+                                   keep_singletons=False)
+        self.assertEqual(record,
+                         create_record(MARCXML_RECORD, keep_singletons=False)[0])
+        self.assertFalse('700' in record)
+        self.assertEqual(record['245'][0][0],
+                         [('a', 'Étude des désintégrations du méson B')])
+
+    def test_indicators_and_text(self):
+        """bibfilter_oaicds2inspire - element_to_record indicators and UTF-8 text"""
+        record = element_to_record(ET.fromstring(MARCXML_RECORD))
+        subfields, ind1, ind2, dummy, dummy = record['100'][0]
+        self.assertEqual((ind1, ind2), (' ', ' '))
+        self.assertEqual(subfields[0], ('a', 'Müller, Jürgen'))
+        self.assertTrue(isinstance(subfields[0][1], str))
+        self.assertEqual(record['245'][0][1:3], (' ', '0'))
+
+
+class IterparseRecordsTest(unittest.TestCase):
+    """
+    Testing the incremental parsing of OAI-PMH responses and MARCXML.
+    """
+
+    def test_list_records(self):
+        """bibfilter_oaicds2inspire - iterparse_records on ListRecords with a deleted record"""
+        records = list(iterparse_records(StringIO(OAI_LIST_RECORDS)))
+        self.assertEqual([deleted for dummy, deleted in records], [False, True])
+
+        expected = create_record(MARCXML_RECORD)[0]
+        record_add_field(expected, "035",
+                         subfields=[('9', 'http://cds.cern.ch/oai2d'),
+                                    ('h', '2013-05-01T10:00:00Z'),
+                                    ('m', 'marcxml'),
+                                    ('a', 'oai:cds.cern.ch:1234567'),
+                                    ('d', '2013-04-01T00:00:00Z')])
+        self.assertEqual(records[0][0], expected)
+
+        deleted_record = records[1][0]
+        self.assertEqual(deleted_record['035'][0][0],
+                         [('9', 'CDS'), ('a', '7654321')])
+        self.assertEqual(deleted_record['037'][0][0][-2:],
+                         [('a', 'oai:cds.cern.ch:7654321'),
+                          ('d', '2013-04-02T00:00:00Z')])
+        self.assertEqual(deleted_record['980'][0][0], [('c', 'DELETED')])
+
+    def test_collection(self):
+        """bibfilter_oaicds2inspire - iterparse_records on a MARCXML collection"""
+        collection = '<collection xmlns="http://www.loc.gov/MARC21/slim">' \
+                     '%s%s</collection>' % (MARCXML_RECORD, MARCXML_RECORD)
+        records = list(iterparse_records(StringIO(collection)))
+        expected = [(record, False) for record, dummy1, dummy2
+                    in create_records(collection)]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records, expected)
+
+    def test_bare_record(self):
+        """bibfilter_oaicds2inspire - iterparse_records on a single MARCXML record"""
+        records = list(iterparse_records(StringIO(MARCXML_RECORD)))
+        self.assertEqual(records, [(create_record(MARCXML_RECORD)[0], False)])
+
+    def test_missing_records(self):
+        """bibfilter_oaicds2inspire - iterparse_records without ListRecords"""
+        response = '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">' \
+                   '<responseDate>2013-05-01T10:00:00Z</responseDate>' \
+                   '<error code="noRecordsMatch"/></OAI-PMH>'
+        self.assertRaises(ValueError, list, iterparse_records(StringIO(response)))
+
+
+class RecordingPool(object):
+    """ Stands for a process pool, recording the blocks submitted to it """
+    def __init__(self, events):
+        self.events = events
+
+    def imap(self, function, block, chunksize=1):
+        self.events.append(('submit', block))
+        return imap(function, block)
+
+
+class ImapInBlocksTest(unittest.TestCase):
+    """
+    Testing the block by block mapping of the filter over the records.
+    """
+
+    def test_without_pool(self):
+        """bibfilter_oaicds2inspire - imap_in_blocks without a pool"""
+        self.assertEqual(list(imap_in_blocks(abs, [-1, 2, -3], block_size=2)),
+                         [1, 2, 3])
+        self.assertEqual(list(imap_in_blocks(abs, [], block_size=2)), [])
+
+    def test_next_block_submitted_before_draining(self):
+        """bibfilter_oaicds2inspire - imap_in_blocks keeps the next block in flight"""
+        events = []
+        pool = RecordingPool(events)
+        for result in imap_in_blocks(abs, [-1, 2, -3, 4, -5], pool, 2):
+            events.append(('result', result))
+        self.assertEqual(events, [('submit', [-1, 2]),
+                                  ('submit', [-3, 4]),
+                                  ('result', 1), ('result', 2),
+                                  ('submit', [-5]),
+                                  ('result', 3), ('result', 4),
+                                  ('result', 5)])
+
+
+class ConfigCacheTest(unittest.TestCase):
+    """
+    Testing the cache of the translation tables of the configuration.
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp(prefix="bibfilter_oaicds2inspire_tests_")
+        self.json_file = os.path.join(self.directory, "config.json")
+        # The cache directory is created when writing
+        self.cache_file = os.path.join(self.directory, "bibharvest", "config.cache")
+        self.tables = {'languages': {'eng': 'English'}}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_and_read(self):
+        """bibfilter_oaicds2inspire - read_config_cache returns the tables of the same configuration"""
+        write_config_cache(self.json_file, 1000.0, self.tables, self.cache_file)
+        self.assertEqual(read_config_cache(self.json_file, 1000.0, self.cache_file),
+                         self.tables)
+        self.assertEqual(read_config_cache(self.json_file, 1001.0, self.cache_file),
+                         None)
+        self.assertEqual(read_config_cache(self.json_file + ".other", 1000.0,
+                                           self.cache_file), None)
+
+    def test_unusable_cache(self):
+        """bibfilter_oaicds2inspire - read_config_cache ignores unusable cache files"""
+        self.assertEqual(read_config_cache(self.json_file, 1000.0, self.cache_file),
+                         None)
+        os.makedirs(os.path.dirname(self.cache_file))
+        for data in ("", "not a pickle", "cos\nnothing_here\n.",
+                     "cno_such_module_here\nname\n.", cPickle.dumps([1, 2]),
+                     cPickle.dumps({'config_file': os.path.abspath(self.json_file),
+                                    'mtime': 1000.0, 'tables': None})):
+            handle = open(self.cache_file, 'wb')
+            handle.write(data)
+            handle.close()
+            self.assertEqual(read_config_cache(self.json_file, 1000.0,
+                                               self.cache_file), None)
+
+
+TEST_SUITE = make_test_suite(ElementToRecordTest, IterparseRecordsTest,
+                             ImapInBlocksTest, ConfigCacheTest)
+
+if __name__ == '__main__':
+    run_test_suite(TEST_SUITE)
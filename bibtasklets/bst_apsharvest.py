@@ -31,8 +31,12 @@ import traceback
 import re
 import datetime
 import shutil
+import hashlib
+import zipfile
+import threading
+import Queue
 
-from lxml import etree
+from tempfile import mkdtemp
 
 from invenio.jsonutils import json
 from invenio.shellutils import split_cli_ids_arg, \
@@ -46,45 +50,54 @@ from invenio.bibtask import task_update_status, \
     task_set_task_param
 from invenio.config import CFG_TMPSHAREDDIR, CFG_SITE_SUPPORT_EMAIL
 from invenio.bibdocfile import open_url
-from invenio.search_engine import perform_request_search, search_pattern
+from invenio.search_engine import perform_request_search
 from invenio.bibformat_engine import BibFormatObject
-from invenio.filedownloadutils import download_url, InvenioFileDownloadError
+from invenio.filedownloadutils import InvenioFileDownloadError
 from invenio.apsharvest_dblayer import fetch_last_updated, \
     get_all_new_records, \
     get_all_modified_records, \
     store_last_updated, \
-    can_launch_bibupload
-from invenio.apsharvest_utils import (unzip,
-                                      find_and_validate_md5_checksums,
+    can_launch_bibupload, \
+    get_dois_from_recids, \
+    get_recids_from_dois
+from invenio.apsharvest_utils import (read_zip_validating_md5_checksums,
                                       get_temporary_file,
                                       InvenioFileChecksumError,
-                                      remove_dtd_information,
-                                      convert_xml_using_saxon,
+                                      remove_dtd_information_from_string,
+                                      get_xml_attribute_values,
+                                      convert_xml_using_saxon_batch,
                                       APSHarvesterConversionError,
                                       create_records_from_file,
                                       validate_date,
                                       get_file_modified_date,
-                                      compare_datetime_to_iso8601_date)
+                                      compare_datetime_to_iso8601_date,
+                                      DownloadCache,
+                                      HarvestJournal,
+                                      HarvestMetrics,
+                                      download_url_conditionally)
+from invenio.threadutils import HostRateLimiter, threaded_imap
 
 from invenio.apsharvest_config import CFG_APSHARVEST_FULLTEXT_URL, \
+    CFG_APSHARVEST_API_URL, \
+    CFG_APSHARVEST_PAGE_SIZE, \
     CFG_APSHARVEST_SEARCH_COLLECTION, \
     CFG_APSHARVEST_RECORD_DOI_TAG, \
     CFG_APSHARVEST_MD5_FILE, \
     CFG_APSHARVEST_FFT_DOCTYPE, \
-    CFG_APSHARVEST_REQUEST_TIMEOUT, \
+    CFG_APSHARVEST_MAX_PARALLEL, \
+    CFG_APSHARVEST_REQUESTS_PER_SECOND, \
+    CFG_APSHARVEST_CACHE_SIZE, \
     CFG_APSHARVEST_BUNCH_SIZE, \
+    CFG_APSHARVEST_SUBMISSION_BACKLOG, \
+    CFG_APSHARVEST_JOURNAL_BATCH_SIZE, \
+    CFG_APSHARVEST_PROMETHEUS_FILE, \
     CFG_APSHARVEST_XSLT, \
+    CFG_APSHARVEST_XSLT_BATCH_SIZE, \
     CFG_APSHARVEST_EMAIL, \
     CFG_APSHARVEST_APS_DIR
 from invenio.docextract_record import BibRecord, BibRecordControlField
 
 
-class APSHarvesterSearchError(Exception):
-    """Exception raised when more then one record is found while DOI matching.
-    """
-    pass
-
-
 class APSHarvesterConnectionError(Exception):
     """Exception raised when unable to connect to APS servers.
     """
@@ -97,43 +110,69 @@ class APSHarvesterSubmissionError(Exception):
     pass
 
 
-class APSHarvesterFileExits(Exception):
-    """Exception raised when local file is the newest.
-    """
-    pass
-
-
 CFG_WORKDIR = os.path.join(CFG_TMPSHAREDDIR, "apsharvest")
 
+# Time, bytes and items of every stage of the current harvest run
+HARVEST_METRICS = HarvestMetrics()
+
 
 class APSRecordList(list):
     """
     Class representing the list of records to harvest.
+
+    A record is only added once, it is identified by its record ID and by
+    its DOI (records harvested from APS may not have a record ID yet).
     """
     def __init__(self):
         super(APSRecordList, self).__init__()
-        self.recids = []
+        self.recids = set()
+        self.dois = set()
 
     def append(self, record):
         """
         Append a APSRecord to the list if it is not already there.
         """
-        if record.recid not in self.recids:
-            super(APSRecordList, self).append(record)
-            self.recids.append(record.recid)
+        if record.recid is not None and record.recid in self.recids:
+            return
+        if record.doi and record.doi in self.dois:
+            return
+        super(APSRecordList, self).append(record)
+        if record.recid is not None:
+            self.recids.add(record.recid)
+        if record.doi:
+            self.dois.add(record.doi)
 
 
 class APSRecord(object):
     """
     Class representing a record to harvest.
+
+    If no DOI is given (None), it is fetched from the record in the
+    database. Use an empty string for records known to have no DOI.
+
+    The BibRecord structure is only created when it is first needed.
     """
+    __slots__ = ('recid', 'doi', 'date', 'last_modified', '_record')
+
     def __init__(self, recid, doi=None, date=None, last_modified=None):
         self.recid = recid
-        self.doi = doi or get_doi_from_record(self.recid)
+        if doi is None:
+            doi = get_doi_from_record(recid)
+        self.doi = doi
         self.date = date
-        self.record = BibRecord(recid or None)
+        self._record = None
         self.last_modified = last_modified
 
+    def _get_record(self):
+        if self._record is None:
+            self._record = BibRecord(self.recid or None)
+        return self._record
+
+    def _set_record(self, record):
+        self._record = record
+
+    record = property(_get_record, _set_record)
+
     def add_metadata(self, marcxml_file):
         """
         Adds metadata from given file. Removes any DTD definitions
@@ -164,7 +203,8 @@ class APSRecord(object):
 def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
                    update_mode="email", from_date="", until_date=None,
                    metadata="yes", fulltext="yes", hidden="yes", match="no",
-                   reportonly="no", threshold_date=None, devmode="no"):
+                   reportonly="no", threshold_date=None, devmode="no",
+                   max_parallel=""):
     """
     Task to download APS metadata + fulltext given a list of arguments.
 
@@ -274,9 +314,15 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
 
     @param devmode: Activate devmode. Full verbosity and no uploads/mails.
     @type devmode: string
+
+    @param max_parallel: number of fulltext downloads to run in parallel.
+                         Defaults to CFG_APSHARVEST_MAX_PARALLEL.
+    @type max_parallel: string
     """
     # This is the list of APSRecord objects to be harvested.
     final_record_list = APSRecordList()
+    HARVEST_METRICS.reset()
+    harvest_from_date = None
 
     task_update_progress("Parsing input parameters")
 
@@ -324,6 +370,18 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
     else:
         reportonly = False
 
+    if max_parallel:
+        try:
+            max_parallel = int(max_parallel)
+            if max_parallel < 1:
+                raise ValueError("must be a positive number")
+        except ValueError, e:
+            write_message("Error parsing max_parallel: %s" % (str(e),),
+                          stream=sys.stderr)
+            return 1
+    else:
+        max_parallel = CFG_APSHARVEST_MAX_PARALLEL
+
     if threshold_date:
         # Input from user. Validate date
         try:
@@ -337,7 +395,7 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
     if from_date:
         # We get records from APS directly
         new_harvest_date = None
-        perpage = 100
+        perpage = CFG_APSHARVEST_PAGE_SIZE
 
         # Are we harvesting from last time or a specific date?
         if from_date == "last":
@@ -374,7 +432,11 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
             status_message += " until today"
         write_message(status_message)
 
-        final_record_list = harvest_aps(harvest_from_date, until_date, perpage)
+        final_record_list = harvest_aps(harvest_from_date, until_date, perpage,
+                                        max_parallel)
+        if reportonly:
+            # We need all the pages to report the number of records
+            final_record_list = list(final_record_list)
     else:
         # We use any given IDs or records from the system.
 
@@ -383,14 +445,14 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
             write_message("Parsing DOIs...")
 
             # We are doing DOIs, we need to get record ids
-            for doi in dois.split(','):
-                doi = doi.strip()
-                try:
-                    recid = get_record_from_doi(doi)
-                except APSHarvesterSearchError, e:
+            dois = [doi.strip() for doi in dois.split(',')]
+            found_recids, errors = get_records_from_dois(dois)
+            for doi in dois:
+                if doi in errors:
                     write_message("Error while getting recid from %s: %s" %
-                                  (doi, str(e)))
+                                  (doi, errors[doi]))
                     continue
+                recid = found_recids.get(doi)
                 if not recid:
                     # Record not found on the system, we harvest from APS
                     write_message("No recid found, we get record from APS")
@@ -402,8 +464,8 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
 
             # We are doing rec ids
             recids = split_cli_ids_arg(recids)
-            for recid in recids:
-                final_record_list.append(APSRecord(recid))
+            for record in get_aps_records_from_recids(recids):
+                final_record_list.append(record)
 
         if query:
             write_message("Performing a search query...")
@@ -414,8 +476,8 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
                                             of='id',
                                             rg=0,
                                             wl=0)
-            for recid in result:
-                final_record_list.append(APSRecord(recid))
+            for record in get_aps_records_from_recids(result):
+                final_record_list.append(record)
 
         if records in ("new", "modified", "both"):
             write_message("Fetching records to update...")
@@ -435,33 +497,59 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
                 records_found.extend(get_all_modified_records(since=last_date,
                                                               last_recid=last_recid))
 
+            dates = {}
             for recid, date in records_found:
-                final_record_list.append(APSRecord(recid, date=date))
-
-    write_message("Found %d record(s) to download." % (len(final_record_list),))
-
-    if reportonly:
-        write_message("'Report-only' mode. We exit now.")
-        return
-
-    if not final_record_list:
-        # No records to harvest, quit.
-        write_message("Nothing to harvest.")
-        return
+                dates.setdefault(recid, date)
+            for record in get_aps_records_from_recids([recid for recid, dummy
+                                                       in records_found],
+                                                      dates):
+                final_record_list.append(record)
+
+    if isinstance(final_record_list, list):
+        write_message("Found %d record(s) to download." % (len(final_record_list),))
+
+        if reportonly:
+            write_message("'Report-only' mode. We exit now.")
+            return
+
+        if not final_record_list:
+            # No records to harvest, quit.
+            write_message("Nothing to harvest.")
+            return
+    else:
+        # Records from APS are downloaded while the next pages are fetched
+        write_message("Downloading records as they are received from APS.")
 
     # Create working directory if not exists
     if not os.path.exists(CFG_WORKDIR):
         os.makedirs(CFG_WORKDIR)
 
+    # Identifies the harvest run, to resume it if it is interrupted. The
+    # resolved from date is used, so that every from_date="last" harvest
+    # after a completed one starts a new journal.
+    job_key = hashlib.md5(repr((dois, recids, query, records, new_mode,
+                                update_mode, harvest_from_date, until_date,
+                                metadata, fulltext, hidden, match,
+                                threshold_date))).hexdigest()
+
+    # Work already done by an interrupted run with the same parameters
+    journal = HarvestJournal(os.path.join(CFG_WORKDIR,
+                                          "apsharvest_journal_%s.json" % (job_key,)),
+                             batch_size=CFG_APSHARVEST_JOURNAL_BATCH_SIZE)
+    if len(journal):
+        write_message("Resuming interrupted harvest (%d records in journal)" %
+                      (len(journal),))
+
     #2: Fetch fulltext/metadata XML and upload bunches of records as configured
     count = 0
-    taskid = 0
     records_harvested = []
     records_to_insert = []
     records_to_update = []
     records_failed = []
+    submitter = APSRecordSubmitter(devmode=devmode, journal=journal)
     for record, error_message in perform_fulltext_harvest(final_record_list, metadata,
-                                                          fulltext, hidden, threshold_date):
+                                                          fulltext, hidden, threshold_date,
+                                                          max_parallel, journal):
         if error_message:
             records_failed.append((record, error_message))
             continue
@@ -469,6 +557,8 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
         count += 1
         # When in BibUpload mode, check if we are on the limit and ready to submit
         if len(records_harvested) == CFG_APSHARVEST_BUNCH_SIZE:
+            store_last_updated_for_records(records_harvested)
+            journal.flush()
 
             # Go over next bunch and add to totals
             if match:
@@ -479,43 +569,26 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
                 records_to_insert.extend(records_harvested)
 
             if new_mode != "email":
-                # Submit new records
-                record_filename = generate_xml_for_records(records_to_insert,
-                                                           suffix="_insert.xml")
-                taskid = submit_records(record_filename,
-                                        records_to_insert,
-                                        new_mode,
-                                        devmode=devmode)
-                if not taskid:
-                    # Something went wrong
-                    err_string = "New records (%s)" \
-                                 " were not submitted correctly" % \
-                                 (record_filename,)
-                    raise APSHarvesterSubmissionError(err_string)
+                # Queue new records for submission
+                submitter.submit(records_to_insert, "_insert.xml", new_mode)
                 records_to_insert = []
 
             if update_mode != "email":
-                # Submit records to be updated
-                record_filename = generate_xml_for_records(records_to_update,
-                                                           suffix="_update.xml")
-                taskid = submit_records(record_filename, records_to_update,
-                                        update_mode,
-                                        silent=records and True or False,
-                                        devmode=devmode)
-                if not taskid:
-                    # Something went wrong
-                    err_string = "Existing records (%s)" \
-                                 " were not submitted correctly" % \
-                                 (record_filename,)
-                    raise APSHarvesterSubmissionError(err_string)
+                # Queue records to be updated for submission
+                submitter.submit(records_to_update, "_update.xml",
+                                 update_mode,
+                                 silent=records and True or False)
                 records_to_update = []
             # Reset
             records_harvested = []
 
-        task_sleep_now_if_required(can_stop_too=not records_harvested)
+        task_sleep_now_if_required(can_stop_too=not records_harvested
+                                   and submitter.is_idle())
 
     # Check for any remains
     if records_harvested or records_to_update or records_to_insert:
+        store_last_updated_for_records(records_harvested)
+        journal.flush()
         if match:
             new_records, existing_records = check_records(records_harvested)
             records_to_insert.extend(new_records)
@@ -524,26 +597,17 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
             records_to_insert.extend(records_harvested)
 
         if records_to_insert:
-            record_filename = generate_xml_for_records(records_to_insert,
-                                                       suffix="_insert.xml")
-            taskid = submit_records(record_filename, records_to_insert,
-                                    new_mode, taskid,
-                                    silent=records and True or False,
-                                    devmode=devmode)
-            if not taskid:
-                # Something went wrong
-                write_message("Records were not submitted correctly")
+            submitter.submit(records_to_insert, "_insert.xml", new_mode,
+                             silent=records and True or False,
+                             fatal=False)
 
         if records_to_update:
-            record_filename = generate_xml_for_records(records_to_update,
-                                                       suffix="_update.xml")
-            taskid = submit_records(record_filename, records_to_update,
-                                    update_mode, taskid,
-                                    silent=records and True or False,
-                                    devmode=devmode)
-            if not taskid:
-                # Something went wrong
-                write_message("Records were not submitted correctly")
+            submitter.submit(records_to_update, "_update.xml", update_mode,
+                             silent=records and True or False,
+                             fatal=False)
+
+    # Wait for all the submissions to be done
+    submitter.finish()
 
     if records_failed:
         body = "\n".join(["%s failed with error: %s"
@@ -560,17 +624,36 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
                            new_harvest_date,
                            name="apsharvest_api_download")
 
+    # The harvest run is complete, it does not need to be resumed
+    journal.remove()
+
     # We are done
     write_message("Harvested %d records. (%d failed)" % (count, len(records_failed)))
+    HARVEST_METRICS.set_value("records_harvested", count)
+    HARVEST_METRICS.set_value("records_failed", len(records_failed))
+    write_metrics(HARVEST_METRICS)
+
+
+def write_metrics(metrics):
+    """
+    Writes the metrics of the harvest run as JSON next to the harvested
+    records, and to CFG_APSHARVEST_PROMETHEUS_FILE if configured.
+    """
+    metrics_file = os.path.join(CFG_WORKDIR, "apsharvest_metrics_%s.json" %
+                                (time.strftime("%Y%m%d_%H%M%S"),))
+    try:
+        metrics.write_json(metrics_file)
+        write_message("Metrics of the harvest written to %s" % (metrics_file,))
+        if CFG_APSHARVEST_PROMETHEUS_FILE:
+            metrics.write_prometheus(CFG_APSHARVEST_PROMETHEUS_FILE)
+    except (IOError, OSError), e:
+        write_message("Error writing metrics: %s" % (str(e),), stream=sys.stderr)
 
 
 def APS_connect(from_param, until_param=None, page=1, perpage=100):
     """
     Manages connection to APS site and return connector.
     """
-    host = 'http://harvest.aps.org'
-    function = '/content/journals/articles'
-
     from_param = 'from=' + str(from_param)
     params = "?" + from_param
     if(until_param):
@@ -579,7 +662,7 @@ def APS_connect(from_param, until_param=None, page=1, perpage=100):
         params += until_param
 
     params += "&page=" + str(page) + "&per_page=" + str(perpage)
-    url_to_open = host + function + params
+    url_to_open = CFG_APSHARVEST_API_URL + params
     retries = 0
     while retries < 5:
         retries += 1
@@ -597,17 +680,41 @@ def APS_connect(from_param, until_param=None, page=1, perpage=100):
             raise
 
 
-def harvest_aps(from_param, until_param, perpage):
+def get_aps_page(from_param, until_param, page, perpage):
     """
-    Performs a request to APS API servers retrieving JSON.
+    Fetches one page of the APS articles API.
+
+    @return: tuple of (connection, list of article dictionaries)
     """
-    page = 1
-    last_page = 1
+    start = time.time()
     conn = APS_connect(from_param, until_param, page, perpage)
     if not conn:
+        HARVEST_METRICS.add("api_paging", time.time() - start,
+                            succeeded=0, failed=1)
         write_message("Fatal Error: Cannot reach APS servers. Aborting.")
         raise APSHarvesterConnectionError("Cannot connect to APS servers")
-    if conn.headers['link']:
+    page_data = conn.next()
+    data = json.loads(page_data)
+    HARVEST_METRICS.add("api_paging", time.time() - start, len(page_data))
+    write_message("Data received from APS (page %d): \n%s" % (page, data),
+                  verbose=5)
+    return conn, data
+
+
+def harvest_aps(from_param, until_param, perpage,
+                max_parallel=CFG_APSHARVEST_MAX_PARALLEL):
+    """
+    Performs a request to APS API servers retrieving JSON.
+
+    This is a generator yielding APSRecord objects in page order. Once the
+    number of pages is known from the first page, the remaining pages are
+    fetched by up to max_parallel threads while the records of earlier
+    pages are already being processed.
+    """
+    next_page = 2
+    last_page = 1
+    conn, data = get_aps_page(from_param, until_param, 1, perpage)
+    if conn.headers.get('link'):
         links = conn.headers['link'].split(",")
         for l in links:
             if l.find('rel="next"') > 0:
@@ -615,23 +722,22 @@ def harvest_aps(from_param, until_param, perpage):
             if l.find('rel="last"') > 0:
                 last_page = int(re.search(r'(?<=(page=))\w+', l).group(0))
 
-    # Fetch first page of data
-    data = json.loads(conn.next())
-    write_message("Data received from APS: \n%s" % (data,), verbose=5)
-    records = []
+    # First page of data
     for d in data:
-        records.append(APSRecord(None, d["doi"], last_modified=d['last_modified_at']))
+        yield APSRecord(None, d["doi"], last_modified=d['last_modified_at'])
 
     # Check for more pages
     if last_page > 1:
-        for pagenum in range(next_page, last_page+1):
-            conn = APS_connect(from_param, until_param, pagenum, perpage)
-            data = json.loads(conn.next())
-            write_message("Data received from APS: \n%s" % (data,), verbose=5)
+        def fetch_page(pagenum):
+            """ Fetches the articles of one page. """
+            return get_aps_page(from_param, until_param, pagenum, perpage)[1]
+
+        for dummy, data in threaded_imap(fetch_page,
+                                         xrange(next_page, last_page + 1),
+                                         max_parallel,
+                                         ordered=True):
             for d in data:
-                records.append(APSRecord(None, d["doi"], last_modified=d['last_modified_at']))
-
-    return records
+                yield APSRecord(None, d["doi"], last_modified=d['last_modified_at'])
 
 
 def check_records(records):
@@ -642,17 +748,19 @@ def check_records(records):
     @return: a tuple of (new_records, existing_records)
     @rtype: tuple
     """
-    # We check if any records already exists
+    # We check if any records already exists, all at once
+    found_recids, errors = get_records_from_dois([record.doi for record in records
+                                                  if not record.recid])
     new_records = []
     existing_records = []
     for record in records:
         # Do we already have the record id perhaps?
         if not record.recid:
-            try:
-                record.recid = get_record_from_doi(record.doi)
-            except APSHarvesterSearchError, e:
+            record.recid = found_recids.get(record.doi)
+            if record.doi in errors:
+                e = errors[record.doi]
                 write_message("Error while getting recid from %s: %s" %
-                              (record.doi, str(e)))
+                              (record.doi, e))
 
                 # Problem detected, send mail immediately:
                 problem_rec = generate_xml_for_records(records=[record],
@@ -674,12 +782,14 @@ def check_records(records):
 
 
 def generate_xml_for_records(records, prefix="apsharvest_result_",
-                             suffix=".xml", directory=CFG_WORKDIR,
+                             suffix=".xml", directory=None,
                              pretty=True):
     """
     Given a list of APSRecord objects, generate a MARCXML containing Metadata
-    and FFT for all of them.
+    and FFT for all of them. The file is written to CFG_WORKDIR by default.
     """
+    if directory is None:
+        directory = CFG_WORKDIR
     new_filename = get_temporary_file(prefix=prefix,
                                       suffix=suffix,
                                       directory=directory)
@@ -752,7 +862,7 @@ def submit_bibupload_for_records(mode, new_filename, silent):
 
 
 def submit_records(records_filename, records_list, mode, taskid=0,
-                   silent=False, devmode=False):
+                   silent=False, devmode=False, can_sleep=True):
     """
     Performs the logic to submit given file (filepath) of records
     either by e-mail or using BibUpload with given mode.
@@ -778,6 +888,10 @@ def submit_records(records_filename, records_list, mode, taskid=0,
     @param silent: do not update the modification date of the records
     @type silent: bool
 
+    @param can_sleep: allow the task to be put to sleep while waiting. Must
+                      be False when called outside of the main thread.
+    @type can_sleep: bool
+
     @return: returns the given taskid upon submission, or True/False from email.
     """
     # Check if we should create bibupload or e-mail
@@ -820,10 +934,13 @@ def submit_records(records_filename, records_list, mode, taskid=0,
             if taskid != 0:
                 write_message("Going to wait for %d to finish" % (taskid,))
 
+            start = time.time()
             while not can_launch_bibupload(taskid):
                 # Lets wait until the previously launched task exits.
-                task_sleep_now_if_required(can_stop_too=False)
+                if can_sleep:
+                    task_sleep_now_if_required(can_stop_too=False)
                 time.sleep(5.0)
+            HARVEST_METRICS.add("submission_wait", time.time() - start)
 
             taskid = submit_bibupload_for_records(mode, records_filename, silent)
             write_message("Submitted BibUpload task #%s with mode %s" %
@@ -831,6 +948,146 @@ def submit_records(records_filename, records_list, mode, taskid=0,
             return taskid
 
 
+class APSRecordSubmitter(object):
+    """
+    Submits bunches of harvested records from a background thread so that
+    the harvest can go on while previously submitted BibUpload tasks run.
+
+    Bunches are submitted in the order they are given, each BibUpload task
+    waiting for the previous one to finish. At most `backlog` bunches are
+    kept waiting; submit() blocks when the backlog is full.
+
+    Submitted records are marked in the given HarvestJournal, if any.
+    """
+    def __init__(self, devmode=False,
+                 backlog=CFG_APSHARVEST_SUBMISSION_BACKLOG, journal=None):
+        self.devmode = devmode
+        self.journal = journal
+        self.taskid = 0
+        self.error = None
+        self.queue = Queue.Queue(backlog)
+        self.thread = threading.Thread(target=self._run,
+                                       name="apsharvest-submitter")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def submit(self, records_list, suffix, mode, silent=False, fatal=True):
+        """
+        Queues given records for submission with given mode.
+
+        @param records_list: list of APSRecord objects to submit
+        @type records_list: list
+
+        @param suffix: suffix of the generated XML file
+        @type suffix: string
+
+        @param mode: which submission mode is it?
+        @type mode: string
+
+        @param silent: do not update the modification date of the records
+        @type silent: bool
+
+        @param fatal: stop the harvest if the records could not be submitted
+        @type fatal: bool
+        """
+        job = (list(records_list), suffix, mode, silent, fatal)
+        while True:
+            self.check()
+            try:
+                self.queue.put(job, True, 5.0)
+                return
+            except Queue.Full:
+                task_update_progress("Waiting for submission backlog")
+                task_sleep_now_if_required(can_stop_too=False)
+
+    def is_idle(self):
+        """
+        Returns True when no submission is pending or in progress.
+        """
+        return self.queue.unfinished_tasks == 0
+
+    def check(self):
+        """
+        Raises any error encountered by the submission thread.
+        """
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+    def finish(self):
+        """
+        Waits for all queued submissions to complete and stops the thread.
+        """
+        while True:
+            self.check()
+            try:
+                self.queue.put(None, True, 5.0)
+                break
+            except Queue.Full:
+                task_sleep_now_if_required(can_stop_too=False)
+        while self.thread.isAlive():
+            self.thread.join(5.0)
+            task_sleep_now_if_required(can_stop_too=False)
+        self.check()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is not None:
+                    # Previous error not yet reported: skip further bunches
+                    continue
+                records_list, suffix, mode, silent, fatal = job
+                try:
+                    start = time.time()
+                    record_filename = generate_xml_for_records(records_list,
+                                                               suffix=suffix)
+                    if record_filename:
+                        HARVEST_METRICS.add("xml_generation",
+                                            time.time() - start,
+                                            os.path.getsize(record_filename))
+                    else:
+                        HARVEST_METRICS.add("xml_generation",
+                                            time.time() - start,
+                                            succeeded=0, failed=1)
+                    res = submit_records(record_filename, records_list,
+                                         mode, self.taskid, silent=silent,
+                                         devmode=self.devmode,
+                                         can_sleep=False)
+                    if not res:
+                        # Something went wrong
+                        err_string = "Records (%s) were not submitted" \
+                                     " correctly" % (record_filename,)
+                        if fatal:
+                            raise APSHarvesterSubmissionError(err_string)
+                        write_message(err_string)
+                    else:
+                        if mode != "email":
+                            self.taskid = res
+                        if self.journal is not None:
+                            for record in records_list:
+                                if record.doi:
+                                    self.journal.mark(record.doi, "submitted")
+                            self.journal.flush()
+                except Exception:
+                    self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+
+def write_file(filepath, data):
+    """
+    Writes given data to a new file.
+    """
+    fd = open(filepath, 'w')
+    try:
+        fd.write(data)
+    finally:
+        fd.close()
+
+
 def submit_records_via_mail(subject, body, toaddr=CFG_APSHARVEST_EMAIL):
     """
     Performs the call to mailutils.send_email to attach XML and submit
@@ -851,94 +1108,203 @@ def submit_records_via_mail(subject, body, toaddr=CFG_APSHARVEST_EMAIL):
                       content=body)
 
 
+def download_records(record_list, max_parallel=CFG_APSHARVEST_MAX_PARALLEL,
+                     url_template=None,
+                     directory=None,
+                     rate=CFG_APSHARVEST_REQUESTS_PER_SECOND,
+                     cache_size=CFG_APSHARVEST_CACHE_SIZE):
+    """
+    Downloads the fulltext bagit archive of every APSRecord in given list
+    using a pool of max_parallel download threads. Requests are limited to
+    `rate` requests per second per host.
+
+    Downloaded archives are kept in a DownloadCache of at most cache_size
+    bytes in given directory. An archive is not requested again when the
+    last modification date given by the APS API did not change, otherwise
+    it is requested conditionally and the cached archive is used if APS
+    answers 304 Not Modified.
+
+    The URL template and directory default to CFG_APSHARVEST_FULLTEXT_URL
+    and CFG_WORKDIR.
+
+    Yields tuples of (APSRecord, path to downloaded file, error_message) in
+    the order the downloads finish.
+    """
+    if url_template is None:
+        url_template = CFG_APSHARVEST_FULLTEXT_URL
+    if directory is None:
+        directory = CFG_WORKDIR
+    rate_limiter = HostRateLimiter(rate, capacity=max_parallel)
+    cache = DownloadCache(directory, cache_size,
+                          index_filename="apsharvest_download_cache.json")
+
+    def download(record):
+        """ Downloads the archive of a single record. """
+        if not record.doi:
+            return None, "No DOI found for record %s" % (record.recid or "",)
+
+        url = url_template % {'doi': record.doi}
+        filename = "%s.zip" % (record.doi.replace('/', '_'),)
+        result_file = os.path.join(directory, filename)
+        cached_file = cache.get_path(record.doi, filename)
+        if cached_file and record.last_modified and \
+                cache.get_value(record.doi, "aps_last_modified") == record.last_modified:
+            # APS did not change the archive since we downloaded it
+            write_message("File exists at %s" % (result_file,), verbose=2)
+            cache.touch(record.doi)
+            HARVEST_METRICS.add("download_cached")
+            return result_file, ""
+        if not cached_file and os.path.exists(result_file) and record.last_modified:
+            # File downloaded before the cache existed, lets see if it is the same
+            file_last_modified = get_file_modified_date(result_file)
+            if not compare_datetime_to_iso8601_date(file_last_modified,
+                                                    record.last_modified):
+                # File is not older than APS version, we should not download.
+                write_message("File exists at %s" % (result_file,), verbose=2)
+                cache.store(record.doi, filename,
+                            aps_last_modified=record.last_modified)
+                HARVEST_METRICS.add("download_cached")
+                return result_file, ""
+
+        headers = {}
+        if cached_file:
+            headers = cache.get_conditional_headers(record.doi)
+        rate_limiter.wait(url)
+        write_message("Trying to save to %s" % (result_file,), verbose=5)
+        start = time.time()
+        try:
+            downloaded, response_headers = \
+                download_url_conditionally(url=url,
+                                           download_to_file=result_file,
+                                           headers=headers,
+                                           content_type="zip",
+                                           retry_count=5,
+                                           timeout=60.0)
+        except InvenioFileDownloadError:
+            HARVEST_METRICS.add("download", time.time() - start,
+                                succeeded=0, failed=1)
+            return None, "URL could not be opened: %s" % (url,)
+        except StandardError, e:
+            HARVEST_METRICS.add("download", time.time() - start,
+                                succeeded=0, failed=1)
+            if 'urlopen' in str(e) or 'URL could not be opened' in str(e):
+                return None, "URL could not be opened: %s" % (url,)
+            raise
+        if downloaded:
+            HARVEST_METRICS.add("download", time.time() - start,
+                                os.path.getsize(result_file))
+            write_message("Downloaded %s to %s" % (url, result_file), verbose=2)
+            cache.store(record.doi, filename, response_headers,
+                        aps_last_modified=record.last_modified)
+        else:
+            HARVEST_METRICS.add("download", time.time() - start)
+            write_message("Not modified, using %s" % (result_file,), verbose=2)
+            cache.touch(record.doi)
+        return result_file, ""
+
+    try:
+        for record, (result_file, error_message) in threaded_imap(download,
+                                                                   record_list,
+                                                                   max_parallel):
+            yield record, result_file, error_message
+    finally:
+        cache.save()
+
+
 def perform_fulltext_harvest(record_list, add_metadata, attach_fulltext,
-                             hidden_fulltext, threshold_date=None):
+                             hidden_fulltext, threshold_date=None,
+                             max_parallel=CFG_APSHARVEST_MAX_PARALLEL,
+                             journal=None):
     """
-    For every record in given list APSRecord(record ID, DOI, date last
-    updated), yield a APSRecord with added FFT dictionary containing URL to
+    For every record in given list (or generator) of APSRecord(record ID,
+    DOI, date last updated), yield a APSRecord with added FFT dictionary containing URL to
     fulltext/metadata XML downloaded locally.
 
+    The downloads are done in parallel by download_records() and the records
+    are processed further as soon as their download is finished. Metadata is
+    converted for batches of CFG_APSHARVEST_XSLT_BATCH_SIZE records at a time.
+
     If a download is unsucessful, an error message is given.
 
+    When a HarvestJournal is given, the progress of every record is marked
+    in it. Records submitted by a previous run are skipped, and records it
+    already converted are not downloaded and converted again.
+
     @return: tuple of (APSRecord, error_message)
     """
     count = 0
-    request_end = None
-    request_start = None
-    for record in record_list:
+    harvested_batch = []
+    # The list of records may be a generator of unknown length
+    total = None
+    if isinstance(record_list, list):
+        total = len(record_list)
+
+    # Records converted by a previous run, waiting to be yielded
+    resumed = []
+
+    def records_to_download():
+        """ Skips the records already harvested by a previous run. """
+        for record in record_list:
+            if journal is not None and record.doi:
+                if journal.has_reached(record.doi, "submitted"):
+                    write_message("Skipping %s, already submitted" %
+                                  (record.doi,), verbose=2)
+                    continue
+                if journal.has_reached(record.doi, "converted"):
+                    fulltext_file = journal.get_value(record.doi, "fulltext")
+                    converted_file = journal.get_value(record.doi, "metadata")
+                    if (not attach_fulltext or fulltext_file and
+                            os.path.exists(fulltext_file)) and \
+                            (not add_metadata or converted_file and
+                             os.path.exists(converted_file)):
+                        resumed.append((record, fulltext_file, converted_file))
+                        continue
+            yield record
+
+    def resume_records():
+        """ Completes the records converted by a previous run. """
+        while resumed:
+            record, fulltext_file, converted_file = resumed.pop(0)
+            write_message("Using converted files of %s from previous run" %
+                          (record.recid or record.doi,), verbose=2)
+            if add_metadata:
+                record.add_metadata(converted_file)
+            if attach_fulltext:
+                record.add_fft(fulltext_file, hidden_fulltext)
+            yield record, ""
+
+    for record, result_file, error_message in download_records(records_to_download(),
+                                                               max_parallel):
+        for result in resume_records():
+            yield result
         task_sleep_now_if_required(can_stop_too=False)
-        # Unless this is the first request, lets sleep a bit
-        if request_end and request_start:
-            request_dt = request_end-request_start
-            write_message("Checking request time (%d)" % (request_dt,), verbose=3)
-            if count and request_dt > 0 and request_dt < CFG_APSHARVEST_REQUEST_TIMEOUT:
-                write_message("Intiating sleep for %.1f seconds" % (request_dt,), verbose=3)
-                time.sleep(request_dt)
-
         count += 1
-        task_update_progress("Harvesting record (%d/%d)" % (count,
-                                                            len(record_list)))
-
-        if not record.doi:
-            msg = "No DOI found for record %d" % (record.recid or "",)
-            write_message("Error: %s" % (msg,), stream=sys.stderr)
-            yield record, msg
-            continue
-
-        url = CFG_APSHARVEST_FULLTEXT_URL % {'doi': record.doi}
-        result_file = os.path.join(CFG_WORKDIR,
-                                   "%s.zip" % (record.doi.replace('/', '_')))
-        try:
-            request_start = time.time()
-            if os.path.exists(result_file):
-                # File already downloaded recently, lets see if it is the same
-                file_last_modified = get_file_modified_date(result_file)
-                if not compare_datetime_to_iso8601_date(file_last_modified, record.last_modified):
-                    # File is not older than APS version, we should not download.
-                    raise APSHarvesterFileExits
-
-            write_message("Trying to save to %s" % (result_file,), verbose=5)
-
-            result_file = download_url(url=url,
-                                       download_to_file=result_file,
-                                       content_type="zip",
-                                       retry_count=5,
-                                       timeout=60.0)
-            write_message("Downloaded %s to %s" % (url, result_file), verbose=2)
-        except InvenioFileDownloadError, e:
-            msg = "URL could not be opened: %s" % (url,)
-            write_message("Error: %s" % (msg,),
-                          stream=sys.stderr)
-            yield record, msg
-            continue
-
-        except APSHarvesterFileExits:
-            write_message("File exists at %s" % (result_file,), verbose=2)
+        if total is None:
+            task_update_progress("Harvesting record (%d)" % (count,))
+        else:
+            task_update_progress("Harvesting record (%d/%d)" % (count, total))
 
-        except StandardError, e:
-            if 'urlopen' in str(e) or 'URL could not be opened' in str(e):
-                msg = "URL could not be opened: %s" % (url,)
-                write_message("Error: %s" % (msg,),
-                              stream=sys.stderr)
+        if error_message:
+            write_message("Error: %s" % (error_message,), stream=sys.stderr)
+            if record.doi:
                 write_message("No fulltext found for %s" %
-                             (record.recid or record.doi,))
-                yield record, msg
-                continue
-            raise
-        finally:
-            request_end = time.time()
-
-        # Unzip the compressed file
-        unzipped_folder = unzip(result_file)
+                              (record.recid or record.doi,))
+            yield record, error_message
+            continue
 
-        # Validate the checksum of the compressed fulltext file.
+        # Read the compressed file and validate the checksums of its files.
+        start = time.time()
         try:
-            checksum_validated_files = find_and_validate_md5_checksums(
-                in_folder=unzipped_folder,
+            checksum_validated_files = read_zip_validating_md5_checksums(
+                result_file,
                 md5key_filename=CFG_APSHARVEST_MD5_FILE)
-        except InvenioFileChecksumError, e:
+            HARVEST_METRICS.add("unzip_checksum", time.time() - start,
+                                os.path.getsize(result_file))
+        except (InvenioFileChecksumError, zipfile.BadZipfile), e:
+            HARVEST_METRICS.add("unzip_checksum", time.time() - start,
+                                succeeded=0, failed=1)
             info_msg = "Skipping %s in %s" % \
-                        (record.recid or record.doi, unzipped_folder)
+                        (record.recid or record.doi, result_file)
             msg = "Error while validating checksum: %s\n%s\n%s" % \
                   (info_msg, str(e), traceback.format_exc()[:-1])
             write_message(msg)
@@ -946,32 +1312,33 @@ def perform_fulltext_harvest(record_list, add_metadata, attach_fulltext,
             continue
         if not checksum_validated_files:
             write_message("Warning: No files found to perform checksum"
-                          " validation on inside %s" % (unzipped_folder,))
-        elif len(checksum_validated_files) != 1 or \
-                not 'fulltext.xml' in checksum_validated_files[0]:
+                          " validation on inside %s" % (result_file,))
+        if len(checksum_validated_files) != 1 or \
+                not 'fulltext.xml' in checksum_validated_files[0][0]:
             msg = "Warning: No fulltext file found inside %s for %s" % \
-                  (unzipped_folder, record.recid or record.doi)
+                  (result_file, record.recid or record.doi)
             write_message(msg)
             yield record, msg
             continue
 
         # We have the fulltext file as fulltext.xml as expected.
-        fulltext_file = checksum_validated_files[0]
+        fulltext_data = checksum_validated_files[0][1]
+        if journal is not None:
+            journal.mark(record.doi, "downloaded")
 
         write_message("Harvested record %s (%s)" %
                      (record.recid or "new record", count))
-        write_message("File: %s" % (fulltext_file,), verbose=2)
 
         # Check if published date is after treshold:
         if threshold_date:
             write_message("Checking the threshold...", verbose=3)
-            parsed_xml_tree = etree.parse(fulltext_file)
             # Looking for the published tag
-            try:
-                published_date = parsed_xml_tree.find('meta/history/published').values().pop()
-            except AttributeError:
+            published_values = get_xml_attribute_values(fulltext_data,
+                                                        'meta/history/published')
+            if not published_values:
                 write_message("Warning: Unable to find published tag, continuing...")
             else:
+                published_date = published_values.pop()
                 if published_date < threshold_date:
                     # The published date is beyond the threshold, we continue
                     msg = "Warning: Article published beyond threshold: %s" % (record.doi,)
@@ -981,41 +1348,138 @@ def perform_fulltext_harvest(record_list, add_metadata, attach_fulltext,
                 else:
                     write_message("OK. Record is below the threshold.", verbose=3)
 
+        # Only write the files we need to disk
+        record_directory = mkdtemp(prefix="apsharvest_unzip_", dir=CFG_WORKDIR)
+        fulltext_file = None
+        if attach_fulltext:
+            fulltext_file = os.path.join(record_directory, "fulltext.xml")
+            write_file(fulltext_file, fulltext_data)
+            write_message("File: %s" % (fulltext_file,), verbose=2)
+        cleaned_fulltext_file = None
         if add_metadata:
             # Remove any DTD info in the file before converting
-            cleaned_fulltext_file = remove_dtd_information(fulltext_file)
+            cleaned_fulltext_file = os.path.join(record_directory,
+                                                 "fulltext_cleaned.xml")
+            start = time.time()
+            cleaned_fulltext_data = remove_dtd_information_from_string(fulltext_data)
+            HARVEST_METRICS.add("dtd_strip", time.time() - start,
+                                len(fulltext_data))
+            write_file(cleaned_fulltext_file, cleaned_fulltext_data)
+
+        # Records are converted in batches to start the converter only once
+        harvested_batch.append((record, fulltext_file, cleaned_fulltext_file))
+        if not add_metadata or len(harvested_batch) >= CFG_APSHARVEST_XSLT_BATCH_SIZE:
+            for result in process_harvested_records(harvested_batch,
+                                                    add_metadata,
+                                                    attach_fulltext,
+                                                    hidden_fulltext,
+                                                    journal):
+                yield result
+            harvested_batch = []
 
-            # Generate Metadata,FFT and yield it
-            try:
-                convert_xml_using_saxon(cleaned_fulltext_file,
-                                        CFG_APSHARVEST_XSLT)
+    # Check for any remains
+    for result in resume_records():
+        yield result
+    for result in process_harvested_records(harvested_batch, add_metadata,
+                                            attach_fulltext, hidden_fulltext,
+                                            journal):
+        yield result
 
-                # Conversion is a success. Let's derive location of converted file
-                source_directory = os.path.dirname(cleaned_fulltext_file)
+
+def process_harvested_records(harvested_batch, add_metadata, attach_fulltext,
+                              hidden_fulltext, journal=None):
+    """
+    Converts the metadata of a batch of harvested records using one run of
+    the XSLT converter, then attaches the fulltext. Successfully converted
+    records are marked in the given HarvestJournal, if any.
+
+    @param harvested_batch: list of (APSRecord, path to fulltext file,
+                            path to fulltext file without DTD information)
+    @type harvested_batch: list
+
+    @return: yields tuples of (APSRecord, error_message)
+    """
+    if not harvested_batch:
+        return
+
+    # Converted file of every record, None if the conversion failed
+    converted_files = {}
+    conversion_messages = {}
+    batch_error = None
+    if add_metadata:
+        cleaned_fulltext_files = [cleaned_fulltext_file for dummy1, dummy2,
+                                  cleaned_fulltext_file in harvested_batch]
+        start = time.time()
+        converted_directory = None
+        try:
+            converted_directory, conversion_messages = \
+                convert_xml_using_saxon_batch(cleaned_fulltext_files,
+                                              CFG_APSHARVEST_XSLT)
+        except APSHarvesterConversionError, e:
+            # The whole batch failed
+            batch_error = str(e)
+        for record, dummy1, dummy2 in harvested_batch:
+            converted_files[record.doi] = None
+            if converted_directory:
+                # The converted file is named after the DOI by the XSLT
                 path_to_converted = "%s%s%s.xml" % \
-                                    (source_directory,
+                                    (converted_directory,
                                      os.sep,
                                      record.doi.replace('/', '_'))
+                if os.path.exists(path_to_converted):
+                    converted_files[record.doi] = path_to_converted
+        failed = len([path for path in converted_files.values() if not path])
+        HARVEST_METRICS.add("xslt", time.time() - start,
+                            sum([os.path.getsize(cleaned_fulltext_file)
+                                 for cleaned_fulltext_file in cleaned_fulltext_files]),
+                            succeeded=len(cleaned_fulltext_files) - failed,
+                            failed=failed)
+
+    for record, fulltext_file, cleaned_fulltext_file in harvested_batch:
+        path_to_converted = None
+        if add_metadata:
+            # Generate Metadata,FFT and yield it
+            path_to_converted = converted_files[record.doi]
+            messages = conversion_messages.get(cleaned_fulltext_file)
+            if not path_to_converted:
+                error = batch_error or messages or \
+                    "No converted file found for %s" % (cleaned_fulltext_file,)
+                msg = "Metadata conversion failed: %s" % (error,)
+                write_message(msg, stream=sys.stderr)
+                record.add_metadata(None)
+                yield record, msg
+            else:
+                if messages:
+                    write_message("Converter messages for %s: %s" %
+                                  (cleaned_fulltext_file, messages), verbose=2)
                 write_message("Converted fulltext for %s" %
                              (record.recid or "new record"), verbose=2)
                 write_message("File: %s" % (path_to_converted,), verbose=2)
                 record.add_metadata(path_to_converted)
-            except APSHarvesterConversionError, e:
-                msg = "Metadata conversion failed: %s\n%s" % \
-                      (str(e), traceback.format_exc()[:-1])
-                write_message(msg, stream=sys.stderr)
-                record.add_metadata(None)
-                yield record, msg
 
         if attach_fulltext:
             record.add_fft(fulltext_file, hidden_fulltext)
 
-        if record.date:
-            store_last_updated(record.recid, record.date, name="apsharvest")
+        if journal is not None and (path_to_converted or not add_metadata):
+            journal.mark(record.doi, "converted", fulltext=fulltext_file,
+                         metadata=path_to_converted)
 
         yield record, ""
 
 
+def store_last_updated_for_records(records):
+    """
+    Stores the highest record ID and date of the given harvested records
+    in xtrJOB with a single update.
+    """
+    dated_records = [record for record in records if record.date]
+    if not dated_records:
+        return
+    store_last_updated(max([record.recid for record in dated_records]),
+                       max([record.date for record in dated_records]),
+                       name="apsharvest")
+
+
 def get_doi_from_record(recid):
     """
     Given a record ID we fetch it from the DB and return
@@ -1039,25 +1503,50 @@ def get_doi_from_record(recid):
                 continue
 
 
-def get_record_from_doi(doi):
+def get_records_from_dois(dois):
     """
-    Given a DOI we fetch the record from the DB and return
-    tuple of record id and last record update.
+    Given a list of DOIs we fetch the matching records from the DB, with one
+    query per bunch of DOIs instead of one search per DOI.
 
-    @param doi: DOI identifier to match a record against
-    @type doi: string/int
+    @param dois: DOI identifiers to match records against
+    @type dois: list
 
-    @return: record ID of record found
-    @rtype: int
+    @return: tuple of (dictionary of DOI -> record ID for DOIs matching a
+             record, dictionary of DOI -> error message for DOIs matching
+             more than one record)
+    @rtype: tuple
     """
-    if not doi:
-        return
+    found_recids = {}
+    errors = {}
+    dois = [doi for doi in dois if doi]
+    if not dois:
+        return found_recids, errors
+    for doi, recids in get_recids_from_dois(dois,
+                                            CFG_APSHARVEST_RECORD_DOI_TAG).iteritems():
+        if len(recids) != 1:
+            errors[doi] = "DOI mismatch: %s did not find only 1 record: %s" % \
+                          (doi, ",".join([str(recid) for recid in recids]))
+        else:
+            found_recids[doi] = int(recids[0])
+    return found_recids, errors
 
-    # Search pattern returns intbitset, lets make it a list instead
-    recids = list(search_pattern(p=doi, f=CFG_APSHARVEST_RECORD_DOI_TAG, m='e'))
-    if not recids:
-        return
-    elif len(recids) != 1:
-        raise APSHarvesterSearchError("DOI mismatch: %s did not find only 1 record: %s" %
-                                      ",".join(recids))
-    return int(recids[0])
+
+def get_aps_records_from_recids(recids, dates=None):
+    """
+    Creates APSRecord objects for given record IDs. The DOIs of all the
+    records are fetched at once instead of loading every record.
+
+    @param recids: record IDs of records containing a DOI
+    @type recids: list
+
+    @param dates: optional dictionary of record ID -> date last updated
+    @type dates: dict
+
+    @return: list of APSRecord objects
+    @rtype: list
+    """
+    if dates is None:
+        dates = {}
+    dois = get_dois_from_recids(recids, CFG_APSHARVEST_RECORD_DOI_TAG)
+    return [APSRecord(recid, dois.get(recid, ""), date=dates.get(recid))
+            for recid in recids]
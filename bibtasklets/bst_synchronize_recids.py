@@ -25,7 +25,7 @@ executable on both CDS and Inspire.
 
 Methodology:
  1. Get IDs from the remote instance (ie CDS) that map to records in Inspire
- 2. Search those IDs locally (ie "035:<ID>")
+ 2. Look those IDs up in the local 035 fields, loaded at once
  3a. If the local record exists, check that it's 035 field matches remote IDs
      -> Update or append locally as needed to correct the record.
  3b. If not, get the remote record and extract other identifiers. Do local
@@ -35,23 +35,32 @@ Methodology:
 
 import os
 import time
+import socket
+import httplib
+import urllib
+import urlparse
 import traceback
+import Queue
 
 from cStringIO import StringIO
-from urllib2 import HTTPError
+
+try:
+    from xml.etree import cElementTree as ET
+except ImportError:
+    from xml.etree import ElementTree as ET
 
 from invenio.config import (CFG_TMPSHAREDDIR,
                             CFG_CERN_SITE, CFG_INSPIRE_SITE)
 from invenio.search_engine import perform_request_search
+from invenio.intbitset import intbitset
 from invenio.bibtask import (write_message,
                              task_update_progress,
                              task_sleep_now_if_required)
 from invenio.bibrecord import (record_add_field, record_add_subfield_into,
-                               record_xml_output, create_record,
-                               record_get_field_values)
+                               record_xml_output, record_get_field_values)
 from invenio.invenio_connector import InvenioConnector
-from invenio.filedownloadutils import download_url, InvenioFileDownloadError
-from invenio.bibtaskutils import ChunkedBibUpload
+from invenio.bibtaskutils import ChunkedBibUpload, get_external_ids
+from invenio.threadutils import TokenBucket, threaded_imap
 
 # LOOK AT ALL THE LOVELY VARIABLES!
 SCRIPT_NAME = "bst_synchronize_recids"
@@ -59,6 +68,12 @@ NOW = time.strftime('%Y-%m-%d_%Hh%Mm%Ss')
 LOG_DIR = CFG_TMPSHAREDDIR
 LOG_FILE = "%s_%s.log" % (SCRIPT_NAME, NOW)
 BATCH_SIZE = 400
+# Remote records asked for in one search request
+FETCH_SIZE = 100
+# Search requests sent to the remote instance at the same time
+FETCH_PARALLEL = 4
+# Search requests per second sent to the remote instance, 0 for no limit
+FETCH_RATE = 2
 
 if CFG_INSPIRE_SITE:
     LOCAL_INSTANCE = "Inspire"
@@ -81,7 +96,9 @@ elif CFG_CERN_SITE:
 # Begin!
 def bst_synchronize_recids(search_terms=SEARCH_TERMS, log_dir=None,
                            collection=COLLECTION, batch_size=BATCH_SIZE,
-                           debug=False, remote_ids=None):
+                           debug=False, remote_ids=None,
+                           fetch_parallel=FETCH_PARALLEL,
+                           fetch_rate=FETCH_RATE):
     """Synchronize record IDs between the CERN Document Server (CDS) and Inspire
 
 This BibTasklet is intended to be a general purpose replacement for
@@ -107,8 +124,14 @@ Parameters:
          (Default false)
  remote_ids - Comma seperated values of remote IDs, if this is
               specified, remote IDs will not be searched for.
+ fetch_parallel - How many requests for remote records to send at once
+                  (Default 4)
+ fetch_rate - How many requests per second to send to the remote
+              instance at most, 0 for no limit
+              (Default 2)
     """
     configure_globals(search_terms, log_dir, debug)
+    fetcher = RemoteRecordFetcher(REMOTE_URL, rate=float(fetch_rate))
     _print("All messages will be logged to %s/%s" % (LOG_DIR, LOG_FILE))
 
     if not remote_ids:
@@ -122,7 +145,12 @@ Parameters:
     task_update_progress("Matching remote IDs to local records")
     missing_ids = match_remote_ids(remote_ids)
 
-    count_appends, count_problems = match_missing_ids(missing_ids, batch_size)
+    try:
+        count_appends, count_problems = match_missing_ids(missing_ids,
+                                                          batch_size, fetcher,
+                                                          int(fetch_parallel))
+    finally:
+        fetcher.close()
 
     _print("======================== FINAL SCORE ========================", 1)
     _print(" Records matched: %d" % (len(remote_ids)-len(missing_ids)), 1)
@@ -229,30 +257,126 @@ def generate_marc_to_append(local, remote):
 
 # =========================| Minor Functions |=========================
 
-def get_remote_record(recid):
-    """ For a given remote record ID, we download the record XML and return
-    the record in a BibRecord structure
+class RemoteRecordFetcher(object):
+    """ Downloads the 001 and 035 fields of remote records, many records per
+    request with a "recid:" OR-query, and parses them straight from the
+    response. The keep-alive connections to the remote instance are kept
+    in a pool owned by the fetcher, so that they are reused by all the
+    threads and batches of a run until close() is called. At most `rate`
+    requests per second are sent by all threads together. """
+    def __init__(self, url, rate=FETCH_RATE, timeout=61.0, retry_count=10):
+        scheme, self.host, path = urlparse.urlparse(url)[:3]
+        if scheme == "https":
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.search_path = "%s/search" % (path.rstrip("/"),)
+        self.timeout = timeout
+        self.retry_count = retry_count
+        self.bucket = TokenBucket(rate)
+        self.connections = Queue.Queue()
+
+    def get_connection(self):
+        """ Takes an idle connection from the pool, or opens a new one if
+        they are all in use """
+        try:
+            return self.connections.get_nowait()
+        except Queue.Empty:
+            return self.connection_class(self.host, timeout=self.timeout)
+
+    def release_connection(self, connection):
+        """ Puts the connection back in the pool for the next request """
+        self.connections.put(connection)
+
+    def close(self):
+        """ Closes all the idle connections, at the end of the run """
+        while True:
+            try:
+                connection = self.connections.get_nowait()
+            except Queue.Empty:
+                break
+            connection.close()
+
+    def get_records(self, recids):
+        """ Downloads the given remote records
+        Parameter:
+        (list) recids - record IDs of the remote records
+        Returns: dictionary of record ID -> BibRecord, of the records found
+        """
+        query = urllib.urlencode({"p": " or ".join(["recid:%d" % (recid,)
+                                                    for recid in recids]),
+                                  "of": "xm", "ot": "001,035",
+                                  "rg": len(recids)})
+        path = "%s?%s" % (self.search_path, query)
+        error = None
+        for dummy in range(max(self.retry_count, 1)):
+            self.bucket.consume()
+            connection = self.get_connection()
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                try:
+                    if response.status != 200:
+                        error = "HTTP error %d" % (response.status,)
+                        if response.status < 500:
+                            # Client errors will not go away by retrying
+                            break
+                        continue
+                    return parse_records(response)
+                finally:
+                    # Leave the connection ready for the next request
+                    response.read()
+                    if response.will_close:
+                        # Reopened by the next request
+                        connection.close()
+            except (httplib.HTTPException, socket.error, SyntaxError), err:
+                error = err
+                connection.close()
+            finally:
+                self.release_connection(connection)
+        raise StandardError("Could not download remote records #%d to #%d: %s"
+                            % (recids[0], recids[-1], error))
+
+
+def _local_name(tag):
+    """ Returns the tag of the XML element without namespace """
+    return tag.rsplit("}", 1)[-1]
+
+
+def _utf8(text):
+    """ Returns the text of an XML element as a UTF-8 string """
+    if isinstance(text, unicode):
+        return text.encode("utf-8")
+    return text or ""
+
+
+def parse_records(stream):
+    """ Parses the MARCXML records of the given file-like object, as they
+    are read. The values are kept as create_record gives them, as UTF-8
+    strings.
     Parameter:
-    (int) recid - record ID for remote record
-    Returns: BibRecord
+    (file) stream - MARCXML collection
+    Returns: dictionary of record ID -> BibRecord
     """
-    url = "%s/record/%d/export/xm?ot=001,035" % (REMOTE_URL, recid)
-    tmp_file = ''
-    try:
-        bibrec = None
-        tmp_file = download_url(url, retry_count=10, timeout=61.0)
-        with open(tmp_file, 'r') as temp:
-            content = temp.read()
-            bibrec, code, errors = create_record(content)
-            if code != 1 or errors:
-                _print("Warning: There were errors creating BibRec structure " +
-                       "from remote record #%d" % recid, 4)
-        os.remove(tmp_file)
-        return bibrec
-    except (StandardError, InvenioFileDownloadError, HTTPError) as err:
-        _print("Error: Could not download remote record #%d" % recid, 4)
-        _print(str(err), 4)
-        _print(traceback.format_exc(), 4)
+    records = {}
+    for dummy, element in ET.iterparse(stream):
+        if _local_name(element.tag) != "record":
+            continue
+        record = {}
+        for field in element:
+            tag = field.get("tag")
+            if _local_name(field.tag) == "controlfield":
+                record_add_field(record, tag,
+                                 controlfield_value=_utf8(field.text))
+            elif _local_name(field.tag) == "datafield":
+                subfields = [(subfield.get("code"), _utf8(subfield.text))
+                             for subfield in field]
+                record_add_field(record, tag, field.get("ind1", " "),
+                                 field.get("ind2", " "), subfields=subfields)
+        element.clear()
+        if "001" in record and record["001"][0][3].strip().isdigit():
+            records[int(record["001"][0][3])] = record
+    return records
 
 
 def extract_035_id(record):
@@ -306,34 +430,37 @@ def get_remote_ids(search_terms, collection=''):
     return recids
 
 
+def get_local_remote_ids():
+    """ Retreives the remote IDs which local records link to, ie. the
+    035__a values of the 035 fields having 035__9:<REMOTE_INSTANCE>, loaded
+    at once. Deleted records are left out.
+
+    Returns:
+     An intbitset of remote RecIDs
+    """
+    pairs = get_external_ids(REMOTE_INSTANCE)
+    remote_ids = intbitset()
+    for value, dummy in pairs:
+        value = value.strip()
+        if value.isdigit():
+            remote_ids.add(int(value))
+    _print("Found %d %s IDs in %d local 035 fields"
+           % (len(remote_ids), REMOTE_INSTANCE, len(pairs)))
+    return remote_ids
+
+
 def match_remote_ids(remote_ids):
     """ Matches remote IDs to local records, IDs that cannot be matched
     are returned as a list."""
-    per_last = -1
-
-    def percent_update(index, percent_last):
-        """ Calculates completion percentage, updates task progress """
-        per = 100 * float(index)/float(len(remote_ids))
-        if per > (percent_last + 0.5):
-            percent_last = per
-            task_update_progress("Local matching %.1f%% (%d/%d)"
-                                 % (per, index, len(remote_ids)))
-        return percent_last
-
-    missing = []
-    for i, recid in enumerate(remote_ids):
-        task_sleep_now_if_required(can_stop_too=True)
-        per_last = percent_update(i, per_last)
-        term = "035__9:%s and 035__a:%d" % (REMOTE_INSTANCE, recid)
-        result = perform_request_search(p=term)
-        if not result:
-            missing.append(recid)
+    linked = get_local_remote_ids()
+    missing = [recid for recid in remote_ids if recid not in linked]
     _print("Of %d record IDs, %d were matched, %d are missing"
            % (len(remote_ids), (len(remote_ids) - len(missing)), len(missing)))
     return missing
 
 
-def match_missing_ids(remote_ids, batch_size):
+def match_missing_ids(remote_ids, batch_size, fetcher,
+                      fetch_parallel=FETCH_PARALLEL):
     """ For ID pairings that are missing, this function splits the missing
     IDs into batches. The records are pulled from remote, the 035 field read
     and then the remote ID appended to the local record.
@@ -341,6 +468,8 @@ def match_missing_ids(remote_ids, batch_size):
     Parameters:
      remote_ids - a list of missing remote rec-ids
      batch_size - How many records to match at a time
+     fetcher - RemoteRecordFetcher downloading the remote records
+     fetch_parallel - How many requests for remote records to send at once
     Returns:
      count_appends - number of records being appended
      count_problems - number of records which could not be matched at all
@@ -358,7 +487,8 @@ def match_missing_ids(remote_ids, batch_size):
         task_update_progress("Batch %d of %d" % (i, len(batches)))
         _print("Batch %d of %d" % (i, len(batches)))
         try:
-            appends, problems = process_record_batch(batch)
+            appends, problems = process_record_batch(batch, fetcher,
+                                                     fetch_parallel)
             count_appends += len(appends)
             count_problems += len(problems)
             write_to_file('missing_ids.txt', problems, append=True)
@@ -370,21 +500,37 @@ def match_missing_ids(remote_ids, batch_size):
     return count_appends, count_problems
 
 
-def process_record_batch(batch):
+def fetch_remote_records(fetcher, recids):
+    """ Downloads the given remote records, logging failures
+    Returns: dictionary of record ID -> BibRecord, of the records fetched
+    """
+    try:
+        return fetcher.get_records(recids)
+    except StandardError, err:
+        _print("Error: %s" % (err,), 4)
+        _print(traceback.format_exc(), 4)
+        return {}
+
+
+def process_record_batch(batch, fetcher, fetch_parallel=FETCH_PARALLEL):
     """ Splitting the matching remotely job into parts, function does the
-    matching of remote records to local IDs """
+    matching of remote records to local IDs. The remote records are
+    downloaded FETCH_SIZE at a time, with fetch_parallel requests at once """
     _print("Processing batch, recid #%d to #%d" % (batch[0], batch[-1]), 4)
+    chunks = [batch[x:x+FETCH_SIZE] for x in xrange(0, len(batch), FETCH_SIZE)]
+    records = {}
+    for dummy, fetched in threaded_imap(
+            lambda chunk: fetch_remote_records(fetcher, chunk), chunks,
+            max_parallel=fetch_parallel):
+        records.update(fetched)
+        task_sleep_now_if_required(can_stop_too=True)
+
     # Local ID: Remote ID
     appends = {}
     problems = []
     for recid in batch:
-        task_sleep_now_if_required(can_stop_too=True)
-
-        # Here we are taking a rest
-        time.sleep(0.5)
-
         _print("Processing recid %d" % recid, 9)
-        record = get_remote_record(recid)
+        record = records.get(recid)
         if record is None:
             _print("Error: Could not fetch remote record %s" % (str(recid),), 5)
             continue
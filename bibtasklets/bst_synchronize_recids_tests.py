@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for the bst_synchronize_recids BibTasklet.
+
+The tests will not modify the database nor contact the remote instance.
+"""
+
+import cgi
+import shutil
+import unittest
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from tempfile import mkdtemp
+
+from invenio.testutils import make_test_suite, run_test_suite
+from invenio.bibrecord import create_record
+
+import bst_synchronize_recids
+
+
+class SynchronizeRecidsTestCase(unittest.TestCase):
+    """ Logs to a temporary directory and restores the module globals
+    replaced by the tests """
+    replaced = ()
+
+    def setUp(self):
+        self.directory = mkdtemp(prefix="bst_synchronize_recids_tests_")
+        self.originals = {}
+        for name in ("LOG_DIR",) + self.replaced:
+            self.originals[name] = getattr(bst_synchronize_recids, name)
+        bst_synchronize_recids.LOG_DIR = self.directory
+
+    def tearDown(self):
+        for name, value in self.originals.items():
+            setattr(bst_synchronize_recids, name, value)
+        shutil.rmtree(self.directory)
+
+
+class MatchRemoteIdsTest(SynchronizeRecidsTestCase):
+    """
+    Testing the matching of remote IDs with the 035 fields of the local
+    records.
+    """
+    replaced = ("get_external_ids",)
+
+    def setUp(self):
+        SynchronizeRecidsTestCase.setUp(self)
+        self.provenances = []
+        bst_synchronize_recids.get_external_ids = self.get_external_ids
+
+    def get_external_ids(self, provenance):
+        self.provenances.append(provenance)
+        return [("100", 1), (" 200 ", 2), ("300\n", 3), ("abc", 4), ("", 5),
+                ("12a", 6), ("100", 7)]
+
+    def test_get_local_remote_ids(self):
+        """bst_synchronize_recids - get_local_remote_ids keeps the numeric 035__a values"""
+        self.assertEqual(sorted(bst_synchronize_recids.get_local_remote_ids()),
+                         [100, 200, 300])
+        self.assertEqual(self.provenances, [bst_synchronize_recids.REMOTE_INSTANCE])
+
+    def test_match_remote_ids(self):
+        """bst_synchronize_recids - match_remote_ids returns the missing IDs in order"""
+        self.assertEqual(bst_synchronize_recids.match_remote_ids(
+            [500, 300, 12, 100, 400, 200, 4]), [500, 12, 400, 4])
+        self.assertEqual(bst_synchronize_recids.match_remote_ids([]), [])
+
+
+def make_remote_record(recid):
+    """ Returns the MARCXML of the remote record with given ID, linking to
+    the local record recid + 5000 """
+    return '<record><controlfield tag="001">\n%d\n</controlfield>' \
+           '<datafield tag="035" ind1=" " ind2=" ">' \
+           '<subfield code="9">%s</subfield><subfield code="a">%d</subfield>' \
+           '</datafield><datafield tag="100" ind1=" " ind2=" ">' \
+           '<subfield code="a">Müller, Jürgen</subfield><subfield code="u"></subfield>' \
+           '</datafield><datafield tag="245" ind1=" " ind2=" ">' \
+           '<subfield code="a">Étude n°%d</subfield></datafield></record>' \
+           % (recid, bst_synchronize_recids.LOCAL_INSTANCE, recid + 5000, recid)
+
+
+class RemoteSearchRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in for the search of the remote instance, answering
+    "recid:" OR-queries with keep-alive connections. Records whose ID ends
+    with 7 do not exist. The first requests for the records in
+    failures get the given status, or no answer at all for status None.
+    """
+    protocol_version = "HTTP/1.1"
+    connections = set()
+    requests = []
+    failures = {}
+
+    def do_GET(self):
+        self.connections.add(self.connection)
+        query = cgi.parse_qs(urlparse.urlparse(self.path)[4])
+        recids = [int(term.split(":")[1]) for term in query["p"][0].split(" or ")]
+        self.requests.append(recids)
+        assert query["of"] == ["xm"] and query["ot"] == ["001,035"]
+        assert query["rg"] == [str(len(recids))]
+        for recid in recids:
+            if self.failures.get(recid):
+                status = self.failures[recid].pop(0)
+                if status is None:
+                    # Drop the connection without answering
+                    self.close_connection = 1
+                    return
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        data = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+               '<collection xmlns="http://www.loc.gov/MARC21/slim">\n%s\n</collection>' % \
+               ("\n".join([make_remote_record(recid) for recid in recids
+                           if recid % 10 != 7]),)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class RemoteRecordFetcherTest(SynchronizeRecidsTestCase):
+    """
+    Testing the download of remote records from a local HTTP server.
+    """
+    replaced = ("FETCH_SIZE", "perform_request_search")
+
+    def setUp(self):
+        SynchronizeRecidsTestCase.setUp(self)
+        RemoteSearchRequestHandler.connections = set()
+        RemoteSearchRequestHandler.requests = []
+        RemoteSearchRequestHandler.failures = {}
+        self.server = ThreadingHTTPServer(("localhost", 0), RemoteSearchRequestHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.fetcher = bst_synchronize_recids.RemoteRecordFetcher(
+            "http://localhost:%d" % (self.server.server_port,), rate=0,
+            timeout=10.0, retry_count=3)
+        bst_synchronize_recids.FETCH_SIZE = 10
+        # Local records linked by remote records with IDs ending with 3
+        # do not exist
+        bst_synchronize_recids.perform_request_search = \
+            lambda p, of: int(p.split(":")[1]) % 10 != 3 and [1] or []
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+        SynchronizeRecidsTestCase.tearDown(self)
+
+    def test_process_record_batches(self):
+        """bst_synchronize_recids - process_record_batch reuses the connections of the fetcher"""
+        for first in (1, 101, 201, 301):
+            batch = range(first, first + 100)
+            appends, problems = bst_synchronize_recids.process_record_batch(
+                batch, self.fetcher, 3)
+            self.assertEqual(sorted(appends.items()),
+                             [(str(recid + 5000), recid) for recid in batch
+                              if recid % 10 not in (3, 7)])
+            self.assertEqual(problems, [recid for recid in batch if recid % 10 == 3])
+        self.assertEqual(len(RemoteSearchRequestHandler.requests), 40)
+        self.assertTrue(len(RemoteSearchRequestHandler.connections) <= 3)
+        self.fetcher.close()
+        self.assertEqual(self.fetcher.connections.qsize(), 0)
+
+    def test_same_as_create_record(self):
+        """bst_synchronize_recids - RemoteRecordFetcher gives the records of create_record"""
+        records = self.fetcher.get_records([5, 6, 7])
+        self.assertEqual(sorted(records.keys()), [5, 6])
+        for recid, record in records.items():
+            self.assertEqual(record, create_record(make_remote_record(recid))[0])
+        self.assertEqual(records[5]["245"][0][0], [("a", "Étude n°5")])
+
+    def test_error_status(self):
+        """bst_synchronize_recids - RemoteRecordFetcher retries server errors only"""
+        RemoteSearchRequestHandler.failures = {1: [503, 500], 11: [404]}
+        self.assertEqual(sorted(self.fetcher.get_records([1, 2]).keys()), [1, 2])
+        self.assertEqual(len(RemoteSearchRequestHandler.requests), 3)
+
+        self.assertRaises(StandardError, self.fetcher.get_records, [11, 12])
+        self.assertEqual(len(RemoteSearchRequestHandler.requests), 4)
+
+        RemoteSearchRequestHandler.failures = {21: [503, 503, 503]}
+        self.assertEqual(bst_synchronize_recids.fetch_remote_records(self.fetcher, [21]),
+                         {})
+        self.assertEqual(len(RemoteSearchRequestHandler.requests), 7)
+
+    def test_dropped_connection(self):
+        """bst_synchronize_recids - RemoteRecordFetcher retries after a dropped connection"""
+        self.assertEqual(self.fetcher.get_records([1]).keys(), [1])
+        RemoteSearchRequestHandler.failures = {2: [None]}
+        self.assertEqual(self.fetcher.get_records([2, 3]).keys(), [2, 3])
+        self.assertEqual(len(RemoteSearchRequestHandler.requests), 3)
+        self.assertEqual(len(RemoteSearchRequestHandler.connections), 2)
+
+
+TEST_SUITE = make_test_suite(MatchRemoteIdsTest, RemoteRecordFetcherTest)
+
+if __name__ == '__main__':
+    run_test_suite(TEST_SUITE)
@@ -4,6 +4,7 @@ import time
 from tempfile import mkstemp
 
 from invenio.dbquery import run_sql
+from invenio.intbitset import intbitset
 from invenio.config import CFG_TMPSHAREDDIR
 from invenio.bibtask import (task_low_level_submission,
                              task_sleep_now_if_required)
@@ -21,6 +22,23 @@ def loop(recids, callback):
             print 'done %s of %s' % (done + 1, len(recids))
 
 
+def get_external_ids(provenance):
+    """ Returns the (035__a, recid) pairs of the 035 fields having both
+    $$9<provenance> and $$a, for all the records at once. Deleted records
+    are left out. """
+    deleted = intbitset(run_sql("SELECT bb.id_bibrec FROM bib98x AS b "
+                                "JOIN bibrec_bib98x AS bb ON bb.id_bibxxx = b.id "
+                                "WHERE b.tag = '980__c' AND b.value = 'DELETED'"))
+    pairs = run_sql("SELECT a.value, ra.id_bibrec FROM bib03x AS a "
+                    "JOIN bibrec_bib03x AS ra ON ra.id_bibxxx = a.id "
+                    "JOIN bibrec_bib03x AS rs ON rs.id_bibrec = ra.id_bibrec "
+                    "AND rs.field_number = ra.field_number "
+                    "JOIN bib03x AS s ON s.id = rs.id_bibxxx "
+                    "WHERE a.tag = '035__a' AND s.tag = '035__9' "
+                    "AND s.value = %s", (provenance,))
+    return [(value, recid) for value, recid in pairs if recid not in deleted]
+
+
 def wait_for_task(task_id):
     sql = 'select status from schTASK where id = %s'
     while run_sql(sql, [task_id])[0][0] not in ('DONE', 'ACK', 'ACK DONE'):
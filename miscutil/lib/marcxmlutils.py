@@ -0,0 +1,51 @@
+"""
+Helpers shared by the bibfilter scripts to write MARCXML files.
+"""
+
+import os
+
+from invenio.bibrecord import record_xml_output
+
+
+class MARCXMLWriter(object):
+    """
+    Writes records to a new MARCXML file as they are given, instead of
+    keeping them in memory. The file is only created if there is any
+    non-empty record, under a temporary name until it is closed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self._file = None
+
+    def write(self, record):
+        """
+        Writes the given record to the file. Empty records are counted,
+        but not written.
+        """
+        self.count += 1
+        if record == {}:
+            return
+        if self._file is None:
+            self._file = open(self.filename + ".tmp", 'w')
+            self._file.write("<collection>")
+        self._file.write("\n" + record_xml_output(record))
+
+    def close(self):
+        """
+        Completes the file, if any record was written.
+        """
+        if self._file is not None:
+            self._file.write("\n</collection>")
+            self._file.close()
+            self._file = None
+            os.rename(self.filename + ".tmp", self.filename)
+
+    def discard(self):
+        """
+        Removes the incomplete file, if any record was written.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self.filename + ".tmp")
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for marcxmlutils library."""
+
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from invenio.testutils import make_test_suite, run_test_suite
+from invenio.bibrecord import record_add_field, create_records
+
+from marcxmlutils import MARCXMLWriter
+
+
+def make_record(title):
+    record = {}
+    record_add_field(record, "245", subfields=[("a", title)])
+    return record
+
+
+class MARCXMLWriterTest(unittest.TestCase):
+    """
+    Testing the incremental writing of MARCXML files.
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp(prefix="marcxmlutils_tests_")
+        self.filename = os.path.join(self.directory, "records.xml")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write(self):
+        """marcxmlutils - MARCXMLWriter writes the non-empty records"""
+        writer = MARCXMLWriter(self.filename)
+        writer.write(make_record("First"))
+        writer.write({})
+        writer.write(make_record("Second"))
+        self.assertFalse(os.path.exists(self.filename))
+        writer.close()
+        self.assertEqual(writer.count, 3)
+        self.assertEqual([record for record, dummy1, dummy2
+                          in create_records(open(self.filename).read())],
+                         [make_record("First"), make_record("Second")])
+        self.assertEqual(os.listdir(self.directory), ["records.xml"])
+
+    def test_no_records(self):
+        """marcxmlutils - MARCXMLWriter creates no file without records"""
+        writer = MARCXMLWriter(self.filename)
+        writer.write({})
+        writer.close()
+        self.assertEqual(writer.count, 1)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_discard(self):
+        """marcxmlutils - MARCXMLWriter leaves no file when discarded"""
+        writer = MARCXMLWriter(self.filename)
+        writer.write(make_record("First"))
+        writer.discard()
+        self.assertEqual(os.listdir(self.directory), [])
+        # Discarding and closing again does nothing
+        writer.discard()
+        writer.close()
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+TEST_SUITE = make_test_suite(MARCXMLWriterTest)
+
+if __name__ == '__main__':
+    run_test_suite(TEST_SUITE)
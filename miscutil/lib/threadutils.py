@@ -0,0 +1,151 @@
+"""
+Helpers to run work in bounded pools of threads, at a limited rate.
+"""
+
+import sys
+import time
+import threading
+import Queue
+import urlparse
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket used to limit the rate of requests.
+
+    The bucket is refilled with `rate` tokens per second, up to `capacity`
+    tokens. A rate of 0 (or less) disables the limit.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(max(capacity, 1))
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """
+        Takes the given number of tokens from the bucket, sleeping until
+        enough tokens are available.
+        """
+        if self.rate <= 0:
+            return
+        while True:
+            self.lock.acquire()
+            try:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            finally:
+                self.lock.release()
+            time.sleep(wait)
+
+
+class HostRateLimiter(object):
+    """
+    Keeps one TokenBucket per host so that requests to different hosts
+    do not throttle each other.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        """
+        Blocks until a request to the host of the given URL is allowed.
+        """
+        host = urlparse.urlparse(url)[1]
+        self.lock.acquire()
+        try:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.capacity)
+                self.buckets[host] = bucket
+        finally:
+            self.lock.release()
+        bucket.consume()
+
+
+def threaded_imap(function, iterable, max_parallel=4, ordered=False):
+    """
+    Lazily applies function to every item of iterable using a bounded pool
+    of worker threads, yielding tuples of (item, result).
+
+    The iterable is consumed in the calling thread, and never more than
+    2 * max_parallel items are in flight (or waiting to be yielded), so it
+    can be a generator producing items while results are being consumed.
+
+    If ordered is True, results are yielded in the order of the input,
+    otherwise as soon as they are ready.
+
+    Any exception raised by function is re-raised in the calling thread.
+    """
+    if max_parallel <= 1:
+        for item in iterable:
+            yield item, function(item)
+        return
+
+    in_queue = Queue.Queue()
+    out_queue = Queue.Queue()
+
+    def worker():
+        while True:
+            job = in_queue.get()
+            if job is None:
+                break
+            index, item = job
+            try:
+                out_queue.put((index, item, function(item), None))
+            except Exception:
+                out_queue.put((index, item, None, sys.exc_info()))
+
+    threads = []
+    for dummy in range(max_parallel):
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+
+    try:
+        items = iter(iterable)
+        exhausted = False
+        submitted = 0
+        yielded = 0
+        completed = {}
+        while True:
+            while not exhausted and submitted - yielded < 2 * max_parallel:
+                try:
+                    item = items.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_queue.put((submitted, item))
+                submitted += 1
+            if yielded == submitted:
+                break
+            try:
+                # Use a timeout so that signals are still handled
+                index, item, result, exc_info = out_queue.get(True, 1.0)
+            except Queue.Empty:
+                continue
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if not ordered:
+                yielded += 1
+                yield item, result
+                continue
+            completed[index] = (item, result)
+            while yielded in completed:
+                item, result = completed.pop(yielded)
+                yielded += 1
+                yield item, result
+    finally:
+        for dummy in threads:
+            in_queue.put(None)